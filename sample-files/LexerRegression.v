@@ -0,0 +1,27 @@
+Require Import Coq.Strings.String.
+Open Scope string_scope.
+
+(* A comment (* with a nested comment. *) and a period. *)
+Definition quoted := "a (* not a comment *) and a period. in a string".
+Definition doubled := "a ""doubled"" quote. ".
+
+Definition with_stars := 2 * 3 * (4 * 5) - 1 + 2.
+
+Lemma bullets : True /\ (True /\ True) /\ True.
+Proof.
+  split; [|split].
+  - exact I.
+  (* A comment before a bullet *) - split.
+    + exact I.
+    + exact I.
+  - { exact I. }
+Qed.
+
+Lemma nested_bullets : (True /\ True) /\ True.
+Proof.
+  split.
+  { split.
+    * exact I.
+    * exact I. }
+  -- exact I.
+Qed.
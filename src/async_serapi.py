@@ -0,0 +1,395 @@
+#!/usr/bin/env python3.7
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# A version of SerapiInstance for asyncio. Instead of a reader thread
+# and a message queue per coq process, each instance reads sertop's
+# output stream directly from coroutines, so one event loop can drive
+# many sertops at once. The interface is the same as SerapiInstance's,
+# except that everything which talks to coq is a coroutine, including
+# the context properties (proof_context, full_context, fullContext,
+# goals, hypotheses), which become methods.
+#
+# Commands are always sent lock-step; instances run side by side
+# instead of pipelining within one. What to make of each message is
+# decided by the helpers in serapi_instance, which SerapiInstance uses
+# too, so this only does the reading and writing.
+
+import asyncio
+import contextlib
+import re
+import signal
+import subprocess
+
+from typing import List, Any, Optional, AsyncIterator
+
+from sexpdata import dumps, Symbol
+
+from serapi_instance import (AckError, CompletedError, CoqExn, BadResponse,
+                             TimeoutError, CoqAnomaly, Subgoal, FullContext,
+                             TacticHistory, isBreakMessage, isBreakAnswer,
+                             preprocess_command, kill_comments, parse_hyps,
+                             exception_handling, check_ack, check_completed,
+                             parse_added_state, is_processed_feedback,
+                             check_feedbacks_end, parse_cancel_feedback,
+                             parse_cancelled, classify_interrupt_response,
+                             goals_answer_in_proof, extract_proof_context,
+                             parse_print_answer, goal_term_sexps,
+                             full_context_from_terms, full_context_from_pp,
+                             count_pp_goals, record_tactic)
+from util import eprint
+import sexp_reader
+
+# Goals can print to very long lines
+stream_limit = 1 << 28
+
+class AsyncSerapiInstance:
+    # Use create (or AsyncSerapiContext) to make one, since starting
+    # sertop has to be awaited.
+    def __init__(self, timeout : int = 30) -> None:
+        self._proc : asyncio.subprocess.Process
+        self.timeout = timeout
+        self._in_proof = False
+        self._goals_str : Optional[str] = None
+        self._full_context : Optional[FullContext] = None
+        self.cur_state = 0
+        self.tactic_history = TacticHistory()
+        self.debug = False
+        self.quiet = False
+
+    @classmethod
+    async def create(cls, coq_command : List[str], includes : str, prelude : str,
+                     timeout : int = 30) -> 'AsyncSerapiInstance':
+        coq = cls(timeout)
+        coq._proc = await asyncio.create_subprocess_exec(
+            *coq_command, cwd=prelude,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, limit=stream_limit)
+        await coq.discard_feedback()
+        await coq.exec_includes(includes, prelude)
+        await coq.unset_printing_notations()
+        return coq
+
+    async def send_flush(self, cmd : str) -> None:
+        assert self._proc.stdin
+        self._proc.stdin.write(cmd.encode('utf-8'))
+        await self._proc.stdin.drain()
+    async def send_acked(self, cmd : str) -> None:
+        await self.send_flush(cmd)
+        await self.get_ack()
+
+    async def ask(self, cmd : str) -> Any:
+        await self.send_acked(cmd)
+        msg = await self.get_message()
+        await self.get_completed()
+        return msg
+
+    # Run a command, like SerapiInstance.run_stmt
+    async def run_stmt(self, stmt : str, timeout : Optional[int] = None) -> None:
+        if timeout:
+            old_timeout = self.timeout
+            self.timeout = timeout
+        if re.match(r"\s*[{]\s*", stmt):
+            await self.run_stmt("Unshelve.")
+        eprint("Running statement: " + stmt.lstrip('\n'),
+               guard=self.debug)
+        stmt = stmt.replace("\\", "\\\\")
+        stmt = stmt.replace("\"", "\\\"")
+        try:
+            for stm in preprocess_command(kill_comments(stmt)):
+                if re.match(r"\s*[{]\s*", stm):
+                    context_before = await self.full_context()
+                else:
+                    context_before = None
+                await self.add_and_exec(stm)
+                self.tactic_history = record_tactic(self.tactic_history, stm,
+                                                    self._in_proof, context_before)
+        except (CoqExn, BadResponse, AckError, CompletedError, TimeoutError) as e:
+            await self.handle_exception(e, stmt)
+        finally:
+            if timeout:
+                self.timeout = old_timeout
+
+    async def add_and_exec(self, stm : str) -> None:
+        await self.send_acked("(Add () \"{}\")\n".format(stm))
+        self.cur_state = await self.get_next_state()
+        await self.get_completed()
+        await self.send_acked("(Exec {})\n".format(self.cur_state))
+        await self.get_feedbacks()
+        await self.get_proof_context()
+
+    async def handle_exception(self, e : Exception, stmt : str) -> None:
+        eprint("Problem running statement: {}\n{}".format(stmt, e),
+               guard=(not self.quiet or self.debug))
+        handling = exception_handling(e, stmt)
+        if handling.cancel:
+            self.tactic_history.addTactic(stmt)
+        if handling.get_completed:
+            await self.get_completed()
+        if handling.cancel:
+            await self.cancel_last()
+        raise handling.error
+
+    async def cancel_last(self) -> None:
+        in_proof_before = self._in_proof
+        old_subgoals : List[Subgoal] = []
+        if in_proof_before:
+            cancelled = self.tactic_history.getNextCancelled()
+            if cancelled == "}":
+                full_context = await self.full_context()
+                assert full_context
+                old_subgoals = full_context.subgoals
+            eprint(f"Cancelling {cancelled} from state {self.cur_state}",
+                   guard=self.debug)
+        else:
+            cancelled = ""
+            eprint(f"Cancelling vernac from state {self.cur_state}",
+                   guard=self.debug)
+        await self.send_acked("(Cancel ({}))".format(self.cur_state))
+        self.cur_state = await self.get_cancelled()
+        await self.get_proof_context()
+
+        if in_proof_before:
+            self.tactic_history.removeLast(old_subgoals)
+        if not self._in_proof:
+            self.tactic_history = TacticHistory()
+        if re.match(r"\s*[{]\s*", cancelled):
+            await self.cancel_last()
+
+    async def get_ack(self) -> None:
+        check_ack(await self.get_message())
+
+    async def get_completed(self) -> None:
+        check_completed(await self.get_message())
+
+    async def add_lib(self, origpath : str, logicalpath : str) -> None:
+        await self.send_acked("(Add () \"Add Rec LoadPath \\\"{}\\\" as {}.\")\n"
+                              .format(origpath, logicalpath))
+        self.cur_state = await self.get_next_state()
+        await self.get_completed()
+        await self.send_acked("(Exec {})\n".format(self.cur_state))
+        await self.discard_feedback()
+        await self.discard_feedback()
+        await self.get_completed()
+
+    async def exec_includes(self, includes_string : str, prelude : str) -> None:
+        for match_obj in re.finditer(r"-R\s*(\S*)\s*(\S*)\s*", includes_string):
+            await self.add_lib("./" + match_obj.group(1), match_obj.group(2))
+
+    async def unset_printing_notations(self) -> None:
+        await self.send_acked("(Add () \"Unset Printing Notations.\")\n")
+        self.cur_state = await self.get_next_state()
+        await self.get_completed()
+
+    async def get_next_state(self) -> int:
+        state_num = parse_added_state(await self.get_message())
+        while state_num is None:
+            state_num = parse_added_state(await self.get_message())
+        return state_num
+
+    async def discard_feedback(self) -> None:
+        feedback_message = await self.get_message()
+        while not is_processed_feedback(feedback_message):
+            feedback_message = await self.get_message()
+
+    async def get_feedbacks(self) -> List[Any]:
+        feedbacks : List[Any] = []
+        next_message = await self.get_message()
+        while(isinstance(next_message, list) and
+              next_message[0] == Symbol("Feedback")):
+            feedbacks.append(next_message)
+            next_message = await self.get_message()
+        check_feedbacks_end(next_message)
+        return feedbacks
+
+    async def get_cancelled(self) -> int:
+        try:
+            new_statenum = parse_cancel_feedback(await self.get_message())
+            parse_cancelled(await self.get_message())
+        finally:
+            await self.get_completed()
+        return new_statenum
+
+    async def read_message(self) -> Any:
+        assert self._proc.stdout
+        line = await asyncio.wait_for(self._proc.stdout.readline(), self.timeout)
+        if line == b"":
+            raise CoqAnomaly("sertop exited")
+        return sexp_reader.loads(line.decode('utf-8'),
+                                 skip_feedback_contents=True)
+
+    # Get the next message, interrupting coq if it takes longer than
+    # the timeout, the same way SerapiInstance.get_message does.
+    async def get_message(self) -> Any:
+        try:
+            return await self.read_message()
+        except asyncio.TimeoutError:
+            pass
+        eprint("Command timed out! Interrupting", guard=self.debug)
+        self._proc.send_signal(signal.SIGINT)
+        num_breaks = 1
+        try:
+            interrupt_response = await self.read_message()
+        except asyncio.TimeoutError:
+            self._proc.send_signal(signal.SIGINT)
+            num_breaks += 1
+            try:
+                interrupt_response = await self.read_message()
+            except asyncio.TimeoutError:
+                raise CoqAnomaly("Timing Out")
+
+        async def read_breaks(is_break : Any) -> None:
+            for i in range(num_breaks):
+                try:
+                    msg = await self.read_message()
+                except asyncio.TimeoutError:
+                    raise CoqAnomaly("Timing out")
+                assert is_break(msg), msg
+
+        response_kind = classify_interrupt_response(interrupt_response)
+        if response_kind == "answer":
+            await self.get_completed()
+            await read_breaks(isBreakMessage)
+            return interrupt_response
+        elif response_kind == "break":
+            raise TimeoutError("")
+        elif response_kind == "break_answer":
+            await self.get_completed()
+            raise TimeoutError("")
+        elif response_kind == "user_interrupt":
+            await read_breaks(isBreakAnswer)
+            await self.get_completed()
+            raise TimeoutError("")
+        else:
+            eprint(interrupt_response)
+            await self.get_completed()
+            return interrupt_response
+
+    async def get_proof_context(self) -> None:
+        proof_context_message = await self.ask(
+            "(Query ((sid {}) (pp ((pp_format PpStr)))) Goals)".format(self.cur_state))
+        self._in_proof = goals_answer_in_proof(proof_context_message)
+        self._goals_str = None
+        self._full_context = None
+
+    @property
+    def in_proof(self) -> bool:
+        return self._in_proof
+
+    @property
+    def prev_tactics(self) -> List[str]:
+        return self.tactic_history.getCurrentHistory()
+
+    async def proof_context(self) -> Optional[str]:
+        if not self._in_proof:
+            return None
+        return (await self.get_goals_str()).split("\n\n")[0]
+
+    async def full_context(self) -> Optional[FullContext]:
+        if not self._in_proof:
+            return None
+        if self._full_context is None:
+            await self.fetch_goals(structured=True)
+        return self._full_context
+
+    async def fullContext(self) -> FullContext:
+        full_context = await self.full_context()
+        assert full_context
+        return FullContext(full_context.subgoals +
+                           self.tactic_history.getAllBackgroundSubgoals())
+
+    async def goals(self) -> str:
+        proof_context = await self.proof_context()
+        assert isinstance(proof_context, str)
+        if proof_context == "":
+            return ""
+        return re.split("\n======+\n", proof_context)[1]
+
+    async def hypotheses(self) -> List[str]:
+        proof_context = await self.proof_context()
+        assert isinstance(proof_context, str)
+        if proof_context == "":
+            return []
+        return parse_hyps(re.split("\n======+\n", proof_context)[0])
+
+    async def count_fg_goals(self) -> int:
+        if not self._in_proof:
+            return 0
+        if self._full_context:
+            return len(self._full_context.subgoals)
+        return count_pp_goals(await self.get_goals_str())
+
+    async def get_goals_str(self) -> str:
+        if self._goals_str is None:
+            await self.fetch_goals(structured=False)
+        assert self._goals_str is not None
+        return self._goals_str
+
+    async def print_term(self, sexp : Any) -> str:
+        answer = await self.ask(f"(Print ((pp_format PpStr)) (CoqConstr {dumps(sexp)}))")
+        return parse_print_answer(answer)
+
+    # Run Unshelve to get the real goals, read them, and cancel it
+    # again, like SerapiInstance.fetch_goals
+    async def fetch_goals(self, structured : bool) -> None:
+        assert self._in_proof
+        await self.send_acked("(Add () \"Unshelve.\")\n")
+        self.cur_state = await self.get_next_state()
+        await self.get_completed()
+        await self.send_acked("(Exec {})\n".format(self.cur_state))
+        await self.discard_feedback()
+        await self.discard_feedback()
+        await self.get_completed()
+        proof_context_message = await self.ask(
+            "(Query ((sid {}) (pp ((pp_format PpStr)))) Goals)".format(self.cur_state))
+        newcontext = extract_proof_context(proof_context_message[2][1])
+        self._goals_str = newcontext
+        if structured:
+            if newcontext == "":
+                self._full_context = FullContext([])
+            else:
+                goals_message = await self.ask("(Query () Goals)")
+                try:
+                    term_strs = [await self.print_term(term_sexp) for term_sexp
+                                 in goal_term_sexps(goals_message)]
+                    self._full_context = full_context_from_terms(goals_message,
+                                                                 term_strs)
+                except CoqExn:
+                    self._full_context = full_context_from_pp(newcontext)
+        await self.send_acked("(Cancel ({}))".format(self.cur_state))
+        self.cur_state = await self.get_cancelled()
+
+    def interrupt(self) -> None:
+        self._proc.send_signal(signal.SIGINT)
+
+    async def kill(self) -> None:
+        if self._proc.returncode is None:
+            self._proc.terminate()
+        await self._proc.wait()
+
+@contextlib.asynccontextmanager
+async def AsyncSerapiContext(coq_commands : List[str], includes : str,
+                             prelude : str) -> AsyncIterator[AsyncSerapiInstance]:
+    coq = await AsyncSerapiInstance.create(coq_commands, includes, prelude)
+    try:
+        yield coq
+    finally:
+        await coq.kill()
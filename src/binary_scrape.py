@@ -0,0 +1,271 @@
+#!/usr/bin/env python3.7
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# A binary version of the scrape format. The file is a header, then a
+# section for each scraped source file, then an index. Each section
+# has a table of the distinct strings in that file, followed by the
+# commands as one flat array of 32-bit words which refer to strings by
+# their position in the table:
+#
+#   vernac:  0, string
+#   tactic:  1, #prev tactics, prev tactics..., #hyps, hyps..., goal, tactic
+#
+# The index gives the offset of each section, and the offset in its
+# command array of each proof (a vernac followed by tactics), so
+# readers can go straight to a file or proof. The strings are exactly
+# what format.read_tuple gives for the text format, so either can be
+# read into the same commands.
+
+import argparse
+import io
+import json
+import os
+import struct
+import sys
+from array import array
+
+from typing import (List, Dict, Iterable, Iterator, Optional, NamedTuple,
+                    BinaryIO, Tuple, Union)
+
+from format import ScrapedTactic, ScrapedCommand, read_tuple
+from util import eprint
+
+magic = b"PV9SCRP1"
+header_format = "<8sQ"
+header_size = struct.calcsize(header_format)
+
+VERNAC = 0
+TACTIC = 1
+
+class ProofEntry(NamedTuple):
+    lemma_statement : str
+    # Position in the section's command array
+    word_offset : int
+
+class SectionEntry(NamedTuple):
+    filename : str
+    offset : int
+    num_strings : int
+    num_words : int
+    num_commands : int
+    proofs : List[ProofEntry]
+
+def is_binary_scrape(path : Union[str, os.PathLike]) -> bool:
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(magic)) == magic
+    except (FileNotFoundError, IsADirectoryError):
+        return False
+
+class BinaryScrapeWriter:
+    def __init__(self, f : BinaryIO) -> None:
+        self.__f = f
+        self.__sections : List[SectionEntry] = []
+        f.write(struct.pack(header_format, magic, 0))
+
+    def write_file(self, filename : str, commands : Iterable[ScrapedCommand]) -> None:
+        string_ids : Dict[str, int] = {}
+        strings : List[str] = []
+        def intern(s : str) -> int:
+            string_id = string_ids.get(s)
+            if string_id is None:
+                string_id = len(strings)
+                string_ids[s] = string_id
+                strings.append(s)
+            return string_id
+        words = array('I')
+        proofs : List[ProofEntry] = []
+        num_commands = 0
+        last_vernac : Optional[Tuple[str, int]] = None
+        for command in commands:
+            num_commands += 1
+            if isinstance(command, ScrapedTactic):
+                if last_vernac:
+                    proofs.append(ProofEntry(*last_vernac))
+                    last_vernac = None
+                words.append(TACTIC)
+                words.append(len(command.prev_tactics))
+                words.extend(intern(t) for t in command.prev_tactics)
+                words.append(len(command.hypotheses))
+                words.extend(intern(h) for h in command.hypotheses)
+                words.append(intern(command.goal))
+                words.append(intern(command.tactic))
+            else:
+                last_vernac = (command, len(words))
+                words.append(VERNAC)
+                words.append(intern(command))
+        encoded_strings = [s.encode('utf-8') for s in strings]
+        lengths = array('I', [len(s) for s in encoded_strings])
+        offset = self.__f.tell()
+        self.__f.write(lengths.tobytes())
+        self.__f.write(b"".join(encoded_strings))
+        self.__f.write(words.tobytes())
+        self.__sections.append(SectionEntry(filename, offset, len(strings),
+                                            len(words), num_commands, proofs))
+
+    def close(self) -> None:
+        index_offset = self.__f.tell()
+        self.__f.write(json.dumps([[section.filename, section.offset,
+                                    section.num_strings, section.num_words,
+                                    section.num_commands,
+                                    [list(proof) for proof in section.proofs]]
+                                   for section in self.__sections]).encode('utf-8'))
+        self.__f.seek(0)
+        self.__f.write(struct.pack(header_format, magic, index_offset))
+        self.__f.seek(0, io.SEEK_END)
+
+class BinaryScrapeReader:
+    def __init__(self, path : Union[str, os.PathLike]) -> None:
+        self.__f = open(path, 'rb')
+        file_magic, index_offset = struct.unpack(header_format,
+                                                 self.__f.read(header_size))
+        assert file_magic == magic, f"{path} isn't a binary scrape file"
+        self.__f.seek(index_offset)
+        self.sections = [SectionEntry(filename, offset, num_strings, num_words,
+                                      num_commands,
+                                      [ProofEntry(*proof) for proof in proofs])
+                         for filename, offset, num_strings, num_words,
+                         num_commands, proofs
+                         in json.loads(self.__f.read().decode('utf-8'))]
+        self.__sections_by_name = {section.filename : section
+                                   for section in self.sections}
+
+    def close(self) -> None:
+        self.__f.close()
+    def __enter__(self) -> 'BinaryScrapeReader':
+        return self
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @property
+    def filenames(self) -> List[str]:
+        return [section.filename for section in self.sections]
+
+    def __len__(self) -> int:
+        return sum(section.num_commands for section in self.sections)
+
+    def __iter__(self) -> Iterator[ScrapedCommand]:
+        for section in self.sections:
+            yield from self.read_file(section.filename)
+
+    def tactics(self) -> Iterator[ScrapedTactic]:
+        for command in self:
+            if isinstance(command, ScrapedTactic):
+                yield command
+
+    def proofs(self, filename : str) -> List[str]:
+        return [proof.lemma_statement
+                for proof in self.__sections_by_name[filename].proofs]
+
+    def read_file(self, filename : str) -> List[ScrapedCommand]:
+        section = self.__sections_by_name[filename]
+        strings = self.__read_strings(section)
+        return list(decode_commands(strings,
+                                    self.__read_words(section, 0, section.num_words)))
+
+    # The commands of the proof_idx'th proof in a file, starting with
+    # the lemma statement, up to the next vernac
+    def read_proof(self, filename : str, proof_idx : int) -> List[ScrapedCommand]:
+        section = self.__sections_by_name[filename]
+        start = section.proofs[proof_idx].word_offset
+        if proof_idx + 1 < len(section.proofs):
+            end = section.proofs[proof_idx + 1].word_offset
+        else:
+            end = section.num_words
+        strings = self.__read_strings(section)
+        commands = decode_commands(strings, self.__read_words(section, start, end))
+        proof = [next(commands)]
+        for command in commands:
+            if not isinstance(command, ScrapedTactic):
+                break
+            proof.append(command)
+        return proof
+
+    def __read_strings(self, section : SectionEntry) -> List[str]:
+        self.__f.seek(section.offset)
+        lengths = array('I')
+        lengths.frombytes(self.__f.read(section.num_strings * lengths.itemsize))
+        blob = self.__f.read(sum(lengths))
+        strings : List[str] = []
+        pos = 0
+        for length in lengths:
+            strings.append(blob[pos:pos+length].decode('utf-8'))
+            pos += length
+        return strings
+
+    def __read_words(self, section : SectionEntry, start : int, end : int) -> array:
+        # The strings were just read, so the file is at the words
+        words = array('I')
+        self.__f.seek(start * words.itemsize, io.SEEK_CUR)
+        words.frombytes(self.__f.read((end - start) * words.itemsize))
+        return words
+
+def decode_commands(strings : List[str], words : array) -> Iterator[ScrapedCommand]:
+    pos = 0
+    while pos < len(words):
+        kind = words[pos]
+        if kind == VERNAC:
+            yield strings[words[pos+1]]
+            pos += 2
+        else:
+            assert kind == TACTIC
+            num_prev = words[pos+1]
+            prev_tactics = [strings[i] for i in words[pos+2:pos+2+num_prev]]
+            pos += 2 + num_prev
+            num_hyps = words[pos]
+            hyps = [strings[i] for i in words[pos+1:pos+1+num_hyps]]
+            pos += 1 + num_hyps
+            yield ScrapedTactic(prev_tactics, hyps,
+                                strings[words[pos]], strings[words[pos+1]])
+            pos += 2
+
+def read_text_scrape(path : str) -> Iterator[ScrapedCommand]:
+    with open(path, 'r') as f:
+        command = read_tuple(f)
+        while command:
+            yield command
+            command = read_tuple(f)
+
+def main(arg_list : List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Convert text scrape files into one binary scrape file")
+    parser.add_argument("output")
+    parser.add_argument("inputs", nargs="+",
+                        help="text scrape files, one section is made for each")
+    parser.add_argument("--prelude", default=None,
+                        help="directory the source file names in the index "
+                        "should be relative to")
+    parser.add_argument("--verbose", "-v", action='store_true')
+    args = parser.parse_args(arg_list)
+    with open(args.output, 'wb') as f:
+        writer = BinaryScrapeWriter(f)
+        for input_path in args.inputs:
+            filename = input_path[:-len(".scrape")] \
+                if input_path.endswith(".scrape") else input_path
+            if args.prelude:
+                filename = os.path.relpath(filename, args.prelude)
+            eprint(f"Converting {input_path}", guard=args.verbose)
+            writer.write_file(filename, read_text_scrape(input_path))
+        writer.close()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3.7
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# Checks that the command lexers in serapi_instance split files the same
+# way as the character-at-a-time versions they replaced, which are kept
+# here as the reference, and times both. By default it checks the files
+# in sample-files, which collect the tricky cases (nested comments,
+# strings, bullets, braces and ellipses).
+
+import argparse
+import glob
+import os
+import re
+import sys
+import time
+
+from tqdm import tqdm
+from typing import List, Tuple, Optional, Pattern, Match, Callable, Any
+
+import serapi_instance
+from util import eprint, mybarfmt
+
+def reference_kill_comments(string: str) -> str:
+    result = ""
+    depth = 0
+    in_quote = False
+    for i in range(len(string)):
+        if in_quote:
+            if depth == 0:
+                result += string[i]
+            if string[i] == '"' and string[i-1] != '\\':
+                in_quote = False
+        else:
+            if string[i:i+2] == '(*':
+                depth += 1
+            if depth == 0:
+                result += string[i]
+            if string[i-1:i+1] == '*)' and depth > 0:
+                depth -= 1
+            if string[i] == '"' and string[i-1] != '\\':
+               in_quote = True
+    return result
+
+def reference_split_commands(string : str) -> List[str]:
+    result = []
+    next_command = ""
+    in_quote = False
+    for i in range(len(string)):
+        if in_quote:
+            if string[i] == '"' and string[i-1] != '\\':
+                in_quote = False
+        else:
+            if string[i] == '"' and string[i-1] != '\\':
+                in_quote = True
+            if (re.match("[\{\}]", string[i]) and
+                re.fullmatch("\s*", next_command)):
+                result.append(string[i])
+                next_command = ""
+                continue
+            if (re.match("[\+\-\*]", string[i]) and
+                string[i] != string[i+1] and
+                re.fullmatch("\s*[\+\-\*]*", next_command)):
+                next_command += string[i]
+                result.append(next_command.strip())
+                next_command = ""
+                continue
+            if (re.match("\.($|\s)", string[i:i+2]) and
+                (not string[i-1] == "." or string[i-2] == ".")):
+                result.append(next_command.strip() + ".")
+                next_command = ""
+                continue
+        next_command += string[i]
+    return result
+
+def reference_read_commands_preserve(args : argparse.Namespace, file_idx : int,
+                           contents : str) -> List[str]:
+    result = []
+    cur_command = ""
+    comment_depth = 0
+    in_quote = False
+    curPos = 0
+    def search_pat(pat : Pattern) -> Tuple[Optional[Match], int]:
+        match = pat.search(contents, curPos)
+        return match, match.end() if match else len(contents) + 1
+    with tqdm(total=len(contents)+1, file=sys.stdout,
+              disable=(not args.progress),
+              position = (file_idx * 2),
+              desc="Reading file", leave=False,
+              dynamic_ncols=True, bar_format=mybarfmt) as pbar:
+      while curPos < len(contents):
+          _, next_quote = search_pat(re.compile(r"(?<!\\)\""))
+          _, next_open_comment = search_pat(re.compile(r"\(\*"))
+          _, next_close_comment = search_pat(re.compile(r"\*\)"))
+          _, next_bracket = search_pat(re.compile(r"[\{\}]"))
+          next_bullet_match, next_bullet = search_pat(re.compile(r"[\+\-\*]+(?![\)\+\-\*])"))
+          _, next_period = search_pat(re.compile(r"(?<!\.)\.($|\s)|\.\.\.($|\s)"))
+          nextPos = min(next_quote,
+                        next_open_comment, next_close_comment,
+                        next_bracket,
+                        next_bullet, next_period)
+          assert curPos < nextPos
+          next_chunk = contents[curPos:nextPos]
+          cur_command += next_chunk
+          pbar.update(nextPos - curPos)
+          if nextPos == next_quote:
+              if comment_depth == 0:
+                  in_quote = not in_quote
+          elif nextPos == next_open_comment:
+              if not in_quote:
+                  comment_depth += 1
+          elif nextPos == next_close_comment:
+              if not in_quote:
+                  comment_depth -= 1
+          elif nextPos == next_bracket:
+              if not in_quote and comment_depth == 0 and \
+                 re.match("\s*$", reference_kill_comments(cur_command[:-1])):
+                  result.append(cur_command)
+                  cur_command = ""
+          elif nextPos == next_bullet:
+              assert next_bullet_match
+              match_length = next_bullet_match.end() - next_bullet_match.start()
+              if not in_quote and comment_depth == 0 and \
+                 re.match("\s*$", reference_kill_comments(cur_command[:-match_length])):
+                  result.append(cur_command)
+                  cur_command = ""
+              assert next_bullet_match.end() >= nextPos
+          elif nextPos == next_period:
+              if not in_quote and comment_depth == 0:
+                  result.append(cur_command)
+                  cur_command = ""
+          curPos = nextPos
+      return result
+
+def timed(f : Callable[..., Any], *args : Any) -> Tuple[Any, float]:
+    start = time.time()
+    result = f(*args)
+    return result, time.time() - start
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=
+                                     "Check the command lexers against the "
+                                     "reference implementations")
+    parser.add_argument("filenames", nargs="*",
+                        default=sorted(glob.glob(os.path.join(
+                            os.path.dirname(__file__), "..", "sample-files", "*.v"))))
+    args = parser.parse_args()
+    lexer_args = argparse.Namespace(progress=False)
+    all_match = True
+    for filename in args.filenames:
+        with open(filename, 'r') as f:
+            contents = f.read()
+        checks = [("kill_comments", reference_kill_comments,
+                   serapi_instance.kill_comments, (contents,)),
+                  ("split_commands", reference_split_commands,
+                   serapi_instance.split_commands,
+                   (reference_kill_comments(contents),)),
+                  ("read_commands_preserve", reference_read_commands_preserve,
+                   serapi_instance.read_commands_preserve,
+                   (lexer_args, 0, contents))]
+        for name, reference, lexer, lexer_inputs in checks:
+            expected, reference_time = timed(reference, *lexer_inputs)
+            actual, lexer_time = timed(lexer, *lexer_inputs)
+            if actual != expected:
+                all_match = False
+                eprint(f"{filename}: {name} doesn't match the reference!")
+            else:
+                print(f"{filename}: {name} {reference_time:.3f}s -> {lexer_time:.3f}s")
+    if not all_match:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
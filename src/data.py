@@ -35,6 +35,8 @@ import random
 from tokenizer import Tokenizer, TokenizerState, \
     make_keyword_tokenizer_relevance, make_keyword_tokenizer_topk, tokenizers, get_words
 from format import read_tactic_tuple, ScrapedTactic, ScrapedCommand, read_tuple
+from binary_scrape import BinaryScrapeReader, is_binary_scrape
+from tactic_store import load_tactic_store
 from models.components import SimpleEmbedding
 
 from typing import (Tuple, NamedTuple, List, Callable, Optional,
@@ -192,6 +194,10 @@ def read_all_text_data_worker__(lines : List[str]) -> MixedDataset:
                 t = read_tuple(f)
     return list(worker_generator())
 def read_all_text_data(data_path : Path2) -> MixedDataset:
+    if is_binary_scrape(data_path):
+        with BinaryScrapeReader(data_path) as reader:
+            yield from reader
+        return
     with multiprocessing.Pool(None) as pool:
         line_chunks = file_chunks(data_path, 32768)
         data_chunks = pool.imap(read_all_text_data_worker__, line_chunks)
@@ -207,6 +213,10 @@ def read_text_data_worker__(lines : List[str]) -> RawDataset:
     return RawDataset(list(worker_generator()))
 
 def read_text_data(data_path : Path2) -> Iterable[ScrapedTactic]:
+    if is_binary_scrape(data_path):
+        with BinaryScrapeReader(data_path) as reader:
+            yield from reader.tactics()
+        return
     with multiprocessing.Pool(None) as pool:
         line_chunks = file_chunks(data_path, 32768)
         data_chunks = pool.imap(read_text_data_worker__, line_chunks)
@@ -219,8 +229,18 @@ def get_text_data(arg_values : Namespace) -> RawDataset:
     start = time.time()
     _print("Reading dataset...", end="")
     sys.stdout.flush()
-    raw_data = RawDataset(list(read_text_data(arg_values.scrape_file)))
-    filtered_data = RawDataset(list(itertools.islice(filter_data(raw_data, get_context_filter(arg_values.context_filter), arg_values), arg_values.max_tuples)))
+    if is_binary_scrape(arg_values.scrape_file):
+        # Binary scrapes are read through a memory mapped store, so
+        # that only the indices of the filtered samples are in memory
+        store = load_tactic_store(arg_values.scrape_file,
+                                  read_text_data(arg_values.scrape_file))
+        filtered_data = RawDataset(store.select(itertools.islice(
+            filter_data_indices(store, get_context_filter(arg_values.context_filter),
+                                arg_values),
+            arg_values.max_tuples)))
+    else:
+        raw_data = RawDataset(list(read_text_data(arg_values.scrape_file)))
+        filtered_data = RawDataset(list(itertools.islice(filter_data(raw_data, get_context_filter(arg_values.context_filter), arg_values), arg_values.max_tuples)))
     _print("{:.2f}s".format(time.time() - start))
     _print("Got {} input-output pairs ".format(len(filtered_data)))
     return filtered_data
@@ -235,6 +255,18 @@ def filter_data(data : RawDataset, pair_filter : ContextFilter,
             if pair_filter({"goal": goal, "hyps" : hyps}, tactic,
                            {"goal": next_goal, "hyps" : next_hyps},
                            arg_values))
+# The same as filter_data, but gives the indices of the samples that
+# pass instead of the samples
+def filter_data_indices(data : Sequence[ScrapedTactic], pair_filter : ContextFilter,
+                        arg_values : Namespace) -> Iterable[int]:
+    return (idx
+            for idx, ((prev_tactics, hyps, goal, tactic),
+                      (next_prev_tactics, next_hyps, next_goal, next_tactic)) in
+            enumerate(zip(data, itertools.chain(itertools.islice(data, 1, None),
+                                                [(None, None, None, None)])))
+            if pair_filter({"goal": goal, "hyps" : hyps}, tactic,
+                           {"goal": next_goal, "hyps" : next_hyps},
+                           arg_values))
 
 def encode_seq_seq_data(data : RawDataset,
                         context_tokenizer_type : Callable[[List[str], int], Tokenizer],
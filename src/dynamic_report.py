@@ -42,6 +42,7 @@ Text = Callable[..., None]
 Line = Callable[..., None]
 
 import serapi_instance
+from lin_cache import open_lin_cache
 from serapi_instance import (ParseError, LexError, TimeoutError,
                              BadResponse, CoqExn, CompletedError,
                              AckError, get_stem)
@@ -55,6 +56,7 @@ from syntax import syntax_highlight, strip_comments
 
 from predict_tactic import static_predictors, loadPredictorByFile, loadPredictorByName
 from models.tactic_predictor import TacticPredictor, TacticContext
+from models.memoizing_predictor import MemoizingPredictor
 
 finished_queue = queue.Queue() # type: queue.Queue[int]
 rows = queue.Queue() # type: queue.Queue[FileResult]
@@ -339,7 +341,8 @@ class Worker(threading.Thread):
                                                        self.prelude + "/" + filename),
                 self.coqargs, self.includes,
                 filename, local_filename, self.skip_nochange_tac)
-            serapi_instance.save_lin(fresh_commands, local_filename)
+            serapi_instance.save_lin(fresh_commands, local_filename,
+                                     open_lin_cache(args))
             return fresh_commands
         else:
             return loaded_commands
@@ -355,9 +358,9 @@ class Worker(threading.Thread):
 
         command_results : List[CommandResult] = []
 
-        with serapi_instance.SerapiContext(self.coqargs,
-                                           self.includes,
-                                           self.prelude) as coq:
+        with serapi_instance.PooledSerapiContext(self.coqargs,
+                                                 self.includes,
+                                                 self.prelude) as coq:
             coq.debug = self.debug
             nb_commands = len(commands)
             for i in range(nb_commands):
@@ -564,6 +567,19 @@ def main(arg_list : List[str]) -> None:
                         default=None)
     parser.add_argument('--skip-nochange-tac', default=False, const=True, action='store_const',
                         dest='skip_nochange_tac')
+    parser.add_argument('--linearize-workers', dest='linearize_workers', default=0, type=int,
+                        help="linearize the proofs of each file with this many "
+                        "coq instances at once")
+    parser.add_argument('--lin-cache', dest='lin_cache', default=None,
+                        help="a directory of linearized files to share between "
+                        "checkouts")
+    parser.add_argument('--lin-cache-size', dest='lin_cache_size', type=int, default=1024,
+                        help="the most space the linearized file cache can use, "
+                        "in megabytes")
+    parser.add_argument("--prediction-cache-size", dest="prediction_cache_size",
+                        type=int, default=0,
+                        help="Remember this many of the most recent predictions, "
+                        "to skip running the model on repeated contexts")
     parser.add_argument('filenames', nargs="+", help="proof file name (*.v)", type=Path2)
     args = parser.parse_args(arg_list)
 
@@ -595,6 +611,8 @@ def main(arg_list : List[str]) -> None:
         print("You must specify either --weightsfile or --predictor!")
         parser.print_help()
         return
+    if args.prediction_cache_size > 0:
+        net = MemoizingPredictor(net, args.prediction_cache_size)
     gresult = GlobalResult(net.getOptions())
     context_filter = args.context_filter or dict(net.getOptions())["context_filter"]
 
@@ -613,6 +631,8 @@ def main(arg_list : List[str]) -> None:
 
     write_summary(args.output, num_jobs, cur_commit,
                   args.message, args.baseline, cur_date, gresult)
+    if isinstance(net, MemoizingPredictor):
+        eprint(net.statsString())
 
 TacticResult = Tuple[str, List[str], str, List[Tuple[str, str, float]]]
 CommandResult = Union[Tuple[str], TacticResult]
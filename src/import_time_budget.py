@@ -0,0 +1,100 @@
+#!/usr/bin/env python3.7
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# Checks how long the command line entry points take to import, with
+# python -X importtime. Fails if any of them imports a predictor model
+# or sklearn at startup (those should only be imported once a model is
+# picked, through the registries in predict_tactic), or if any takes
+# longer than the budget.
+
+import argparse
+import re
+import subprocess
+import sys
+
+from typing import Dict, List, Tuple
+
+entry_modules = ["proverbot9001", "search_report", "search_file",
+                 "static_report", "dynamic_report", "scrape"]
+# The only models modules that should be imported before a predictor is
+# picked
+startup_models = ["models", "models.tactic_predictor", "models.memoizing_predictor",
+                  "models.components"]
+
+importtime_line = re.compile(r"import time:\s*(\d+)\s*\|\s*(\d+)\s*\|(\s*)(\S+)")
+
+# The cumulative import time in microseconds of each module imported
+# when importing module_name, in a fresh interpreter.
+def import_times(module_name : str) -> Dict[str, int]:
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                             f"import {module_name}"],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        print("\n".join(line for line in result.stderr.split("\n")
+                        if not importtime_line.match(line)),
+              file=sys.stderr)
+        raise RuntimeError(f"Couldn't import {module_name}")
+    times : Dict[str, int] = {}
+    for line in result.stderr.split("\n"):
+        match = importtime_line.match(line)
+        if match:
+            times[match.group(4)] = int(match.group(2))
+    return times
+
+def unwanted_imports(times : Dict[str, int]) -> List[str]:
+    return [module for module in times
+            if module.split(".")[0] == "sklearn" or
+            (module.startswith("models") and module not in startup_models)]
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=
+                                     "Check the import time of the command line tools")
+    parser.add_argument("--budget-ms", dest="budget_ms", default=3000, type=int,
+                        help="the longest any entry point can take to import")
+    parser.add_argument("--num-slowest", dest="num_slowest", default=10, type=int)
+    parser.add_argument("modules", nargs="*", default=entry_modules)
+    args = parser.parse_args()
+
+    failed = False
+    for module_name in args.modules:
+        times = import_times(module_name)
+        total_ms = times[module_name] / 1000
+        print(f"{module_name}: {total_ms:.0f}ms (budget {args.budget_ms}ms)")
+        slowest : List[Tuple[str, int]] = sorted(
+            ((module, time) for module, time in times.items()
+             if module != module_name and "." not in module),
+            key=lambda item: -item[1])[:args.num_slowest]
+        for module, time in slowest:
+            print(f"    {module}: {time / 1000:.0f}ms")
+        unwanted = unwanted_imports(times)
+        if unwanted:
+            print(f"    imports {', '.join(unwanted)} at startup")
+            failed = True
+        if total_ms > args.budget_ms:
+            print(f"    over budget by {total_ms - args.budget_ms:.0f}ms")
+            failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3.7
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# A store of linearized files that can be shared between checkouts (and
+# between machines, if it's on a shared filesystem), so that a fresh
+# checkout doesn't have to linearize everything again. Entries are
+# keyed by the contents of the source file, its path under the prelude,
+# the prelude's _CoqProject, and the version of the linearizer. Like the
+# .lin files next to the sources, the key doesn't cover the files a
+# source Requires.
+#
+# Entries are written to a temporary file and renamed into place, so
+# several processes can use the store at once without seeing half
+# written entries. Reading an entry marks it as used, and when the
+# store gets bigger than its size limit, the entries that were used
+# least recently are removed.
+
+import argparse
+import contextlib
+import hashlib
+import os
+import tempfile
+
+from typing import List, Optional, Tuple
+
+from util import hash_file
+
+# Bump this whenever a change to the linearizer changes its output, so
+# that entries from older versions aren't used.
+linearizer_version = 1
+
+# mkstemp makes files only we can read, so entries get the permissions
+# a normal file would, for the other users of the store. The umask can
+# only be read by setting it.
+umask = os.umask(0)
+os.umask(umask)
+
+class LinCache:
+    def __init__(self, path : str, max_size : int, prelude : str) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.prelude = prelude
+        coqproject_path = os.path.join(prelude, "_CoqProject")
+        self.coqproject_hash = hash_file(coqproject_path) \
+            if os.path.exists(coqproject_path) else ""
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, file_hash : str, filename : str) -> str:
+        hasher = hashlib.sha1()
+        for part in [str(linearizer_version), file_hash,
+                     os.path.relpath(filename, self.prelude), self.coqproject_hash]:
+            hasher.update(part.encode('utf-8'))
+            hasher.update(b"\0")
+        return hasher.hexdigest()
+
+    def entry_path(self, key : str) -> str:
+        return os.path.join(self.path, key[:2], key[2:] + ".lin")
+
+    def lookup(self, key : str) -> Optional[str]:
+        entry_path = self.entry_path(key)
+        try:
+            with open(entry_path, 'r') as f:
+                contents = f.read()
+        except OSError:
+            # Missing, or written by someone who didn't let us read it
+            return None
+        # The cache might be shared read-only
+        with contextlib.suppress(OSError):
+            os.utime(entry_path)
+        return contents
+
+    def store(self, key : str, contents : str) -> None:
+        entry_path = self.entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(entry_path),
+                                        suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(contents)
+            os.chmod(tmp_path, 0o666 & ~umask)
+            os.replace(tmp_path, entry_path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    # Remove the least recently used entries until the store fits in its
+    # size limit. Other processes might be removing the same entries.
+    def evict(self) -> None:
+        entries : List[Tuple[float, int, str]] = []
+        total_size = 0
+        for shard in os.scandir(self.path):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if not entry.name.endswith(".lin"):
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total_size += stat.st_size
+        if total_size <= self.max_size:
+            return
+        for mtime, size, entry_path in sorted(entries):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(entry_path)
+            total_size -= size
+            if total_size <= self.max_size:
+                break
+
+def open_lin_cache(args : argparse.Namespace) -> Optional[LinCache]:
+    if not args.lin_cache:
+        return None
+    return LinCache(args.lin_cache, args.lin_cache_size * 1024 * 1024,
+                    str(args.prelude))
@@ -39,11 +39,14 @@ from compcert_linearizer_failures import compcert_failures
 import serapi_instance
 from serapi_instance import (AckError, CompletedError, CoqExn,
                              BadResponse, TimeoutError, ParseError, NoSuchGoalError)
+from scrape_cache import proof_body_opaque
+from lin_cache import open_lin_cache
 
 from typing import (Optional, List, Iterator, Iterable, Any, Match,
-                    Tuple, Pattern, Union)
+                    Tuple, Pattern, Union, Dict, NamedTuple, Callable)
 
 from itertools import islice
+from multiprocessing.pool import ThreadPool
 
 # exception for when things go bad, but not necessarily because of the linearizer
 class LinearizerCouldNotLinearize(Exception):
@@ -87,45 +90,182 @@ def linearize_commands(args : argparse.Namespace, file_idx : int,
         # Now command_batch contains everything through the next
         # Qed/Defined.
         theorem_statement = serapi_instance.kill_comments(command_batch.pop(0))
-        theorem_name = theorem_statement.split(":")[0].strip()
-        coq.run_stmt(theorem_statement)
-        yield theorem_statement
-        if [relative_filename, theorem_name] in compcert_failures:
-            eprint("Skipping {}".format(theorem_name))
-            for command in command_batch:
-                coq.run_stmt(command)
-                yield command
-            command = next(commands_iter, None)
-            continue
+        yield from linearize_single_proof(args, coq, theorem_statement, command_batch,
+                                          filename, relative_filename,
+                                          skip_nochange_tac)
 
-        # This might not be super robust?
-        match = re.fullmatch("\s*Proof with (.*)\.", command_batch[0])
-        if match and match.group(1):
-            with_tactic = match.group(1)
-        else:
-            with_tactic = ""
+        command = next(commands_iter, None)
 
-        orig = command_batch[:]
-        command_batch = list(prelinear_desugar_tacs(command_batch))
-        try:
-            batch_handled = list(handle_with(command_batch, with_tactic))
+# Run the statement of a proof, and then linearize the proof. If it
+# can't be linearized, the original proof is run instead.
+def linearize_single_proof(args : argparse.Namespace,
+                           coq : serapi_instance.SerapiInstance,
+                           theorem_statement : str, command_batch : List[str],
+                           filename : str, relative_filename : str,
+                           skip_nochange_tac : bool) -> Iterable[str]:
+    theorem_name = theorem_statement.split(":")[0].strip()
+    coq.run_stmt(theorem_statement)
+    yield theorem_statement
+    if [relative_filename, theorem_name] in compcert_failures:
+        eprint("Skipping {}".format(theorem_name))
+        for command in command_batch:
+            coq.run_stmt(command)
+            yield command
+        return
+
+    # This might not be super robust?
+    match = re.fullmatch("\s*Proof with (.*)\.", command_batch[0])
+    if match and match.group(1):
+        with_tactic = match.group(1)
+    else:
+        with_tactic = ""
+
+    orig = command_batch[:]
+    command_batch = list(prelinear_desugar_tacs(command_batch))
+    try:
+        batch_handled = list(handle_with(command_batch, with_tactic))
+        if already_linear(batch_handled):
+            linearized_commands = list(linearize_linear_proof(coq, theorem_name,
+                                                              batch_handled,
+                                                              args.debug,
+                                                              skip_nochange_tac))
+        else:
             linearized_commands = list(linearize_proof(coq, theorem_name, batch_handled,
                                                        args.debug, skip_nochange_tac))
-            yield from linearized_commands
-        except (BadResponse, CoqExn, LinearizerCouldNotLinearize, ParseError, TimeoutError, NoSuchGoalError) as e:
-            eprint("Aborting current proof linearization!")
-            eprint("Proof of:\n{}\nin file {}".format(theorem_name, filename))
-            eprint()
-            if args.hardfail:
-                raise e
-            coq.run_stmt("Abort.")
-            coq.run_stmt(theorem_statement)
-            for command in orig:
-                if command:
-                    coq.run_stmt(command)
-                    yield command
+        yield from linearized_commands
+    except (BadResponse, CoqExn, LinearizerCouldNotLinearize, ParseError, TimeoutError, NoSuchGoalError) as e:
+        eprint("Aborting current proof linearization!")
+        eprint("Proof of:\n{}\nin file {}".format(theorem_name, filename))
+        eprint()
+        if args.hardfail:
+            raise e
+        coq.run_stmt("Abort.")
+        coq.run_stmt(theorem_statement)
+        for command in orig:
+            if command:
+                coq.run_stmt(command)
+                yield command
+
+# A proof in the skeleton of a file: its statement (with comments
+# removed, like linearize_commands does), and the rest of its commands
+# through the one that ends it.
+class SkeletonProof(NamedTuple):
+    statement : str
+    commands : List[str]
+
+# The skeleton of a file is every command outside of proofs, with each
+# proof closed as cheaply as we can: proofs whose bodies can't be seen
+# later are admitted, and the rest are run as they are.
+SkeletonStep = Union[str, SkeletonProof]
+
+def skip_proof(coq : serapi_instance.SerapiInstance, proof : SkeletonProof) -> None:
+    coq.run_stmt(proof.statement)
+    if proof.commands and proof_body_opaque(proof.commands[-1]):
+        coq.run_stmt("Admitted.")
+    else:
+        for command in proof.commands:
+            coq.run_stmt(command)
 
+# Run through the commands the way linearize_commands does, but skip
+# the proofs instead of linearizing them. Returns the skeleton, and the
+# state from right before each of its proofs.
+def find_skeleton(commands_sequence : Iterable[str],
+                  coq : serapi_instance.SerapiInstance) \
+                  -> Tuple[List[SkeletonStep], List[serapi_instance.SavedState]]:
+    skeleton : List[SkeletonStep] = []
+    saved_states : List[serapi_instance.SavedState] = []
+    commands_iter = iter(commands_sequence)
+    command = next(commands_iter, None)
+    assert command, "Got an empty sequence!"
+    while command:
+        while coq.count_fg_goals() == 0:
+            coq.run_stmt(command)
+            if coq.count_fg_goals() == 0:
+                skeleton.append(command)
+                command = next(commands_iter, None)
+                if not command:
+                    return skeleton, saved_states
+        coq.cancel_last()
+        command_batch = []
+        while command and not serapi_instance.ending_proof(command):
+            command_batch.append(command)
+            command = next(commands_iter, None)
+        if command:
+            command_batch.append(command)
+        proof = SkeletonProof(serapi_instance.kill_comments(command_batch[0]),
+                              command_batch[1:])
+        saved_states.append(coq.save_state())
+        skip_proof(coq, proof)
+        skeleton.append(proof)
         command = next(commands_iter, None)
+    return skeleton, saved_states
+
+def run_skeleton(skeleton : List[SkeletonStep],
+                 coq : serapi_instance.SerapiInstance) \
+                 -> List[serapi_instance.SavedState]:
+    saved_states : List[serapi_instance.SavedState] = []
+    for step in skeleton:
+        if isinstance(step, SkeletonProof):
+            saved_states.append(coq.save_state())
+            skip_proof(coq, step)
+        else:
+            coq.run_stmt(step)
+    return saved_states
+
+# Linearize the proofs of a file with several coq instances. The file's
+# skeleton is run once on each instance, saving the state before every
+# proof. Then each instance takes proofs from the end of the file
+# backwards, so that it can get back to the state before each one by
+# cancelling what came after it. The results go back together in
+# source order.
+def linearize_commands_parallel(args : argparse.Namespace, file_idx : int,
+                                commands_sequence : Iterable[str],
+                                coq : serapi_instance.SerapiInstance,
+                                coqargs : List[str], includes : str,
+                                filename : str, relative_filename : str,
+                                skip_nochange_tac : bool) -> List[str]:
+    skeleton, saved_states = find_skeleton(commands_sequence, coq)
+    proofs = [step for step in skeleton if isinstance(step, SkeletonProof)]
+    remaining_proofs = list(range(len(proofs)))
+    remaining_proofs_lock = threading.Lock()
+    def next_proof() -> Optional[int]:
+        with remaining_proofs_lock:
+            return remaining_proofs.pop() if remaining_proofs else None
+    def linearize_remaining(worker_coq : serapi_instance.SerapiInstance,
+                            worker_states : List[serapi_instance.SavedState]) \
+                            -> Dict[int, List[str]]:
+        results : Dict[int, List[str]] = {}
+        proof_idx = next_proof()
+        while proof_idx is not None:
+            worker_coq.restore_state(worker_states[proof_idx])
+            proof = proofs[proof_idx]
+            results[proof_idx] = list(linearize_single_proof(
+                args, worker_coq, proof.statement, list(proof.commands),
+                filename, relative_filename, skip_nochange_tac))
+            proof_idx = next_proof()
+        return results
+    def work(worker_idx : int) -> Dict[int, List[str]]:
+        if worker_idx == 0:
+            return linearize_remaining(coq, saved_states)
+        with serapi_instance.PooledSerapiContext(coqargs, includes,
+                                                 args.prelude) as worker_coq:
+            worker_coq.debug = args.debug
+            return linearize_remaining(worker_coq, run_skeleton(skeleton, worker_coq))
+    num_workers = min(args.linearize_workers, len(proofs))
+    linearized_proofs : Dict[int, List[str]] = {}
+    with ThreadPool(max(num_workers, 1)) as pool:
+        for results in pool.map(work, range(num_workers)):
+            linearized_proofs.update(results)
+
+    result : List[str] = []
+    proof_idx = 0
+    for step in skeleton:
+        if isinstance(step, SkeletonProof):
+            result.extend(linearized_proofs[proof_idx])
+            proof_idx += 1
+        else:
+            result.append(step)
+    return result
 
 def split_to_next_matching(openpat : str, closepat : str, target : str) \
     -> Tuple[str, str]:
@@ -362,6 +502,159 @@ def linearize_proof(coq : serapi_instance.SerapiInstance,
                 yield indentation + "{"
     pass
 
+# Tactics that can work on goals other than the first, or bring back
+# shelved goals, so running them without braces could give different
+# goals than linearize_proof would see.
+multi_goal_tactic_pattern = re.compile(
+    r"\b(e(apply|exists|constructor|split|left|right|rewrite|destruct|induction|"
+    r"case|elim|inversion|pose|set|assert|transitivity)|refine|instantiate|"
+    r"shelve|unshelve|Unshelve|give_up|cycle|swap|revgoals|Focus|Unfocus|"
+    r"Grab|Existential|Undo|Restart|Abort)\b")
+
+# Split the comments off the front of a command, the way
+# linearize_proof does.
+def split_leading_comments(command : str) -> Tuple[str, str]:
+    comment_before_command = ""
+    command_proper = command
+    while "(*" in command_proper:
+        next_comment, command_proper = \
+            split_to_next_matching("\(\*", "\*\)", command_proper)
+        command_proper = command_proper[1:]
+        comment_before_command += next_comment
+    return comment_before_command, command_proper
+
+# Whether linearize_proof would run every command of a proof as it is,
+# and only add braces: there are no semicolons, branches, goal
+# selectors, bullets or braces, and no commands it would treat
+# specially.
+def already_linear(command_batch : List[str]) -> bool:
+    for command in command_batch:
+        _, command_proper = split_leading_comments(command)
+        if any(special in command for special in [";", "||", "&&", "<..>"]) or \
+           re.match(r"\s*[*+-]+\s*|\s*[{}]\s*", command) or \
+           re.match(r"\s*[*+\-{}(]", command_proper) or \
+           re.match(r"[^(]*:", command_proper) or \
+           multi_goal_tactic_pattern.search(serapi_instance.kill_comments(command)):
+            return False
+    return True
+
+# Tactics that always leave exactly the one goal they're run on
+single_goal_tactic_pattern = re.compile(
+    r"(Proof|intros?|simpl|unfold|fold|red|hnf|cbn|cbv|compute|subst|clear|"
+    r"revert|generalize|rename|pattern|change|set|remember|pose)\b")
+
+# The goals after each command, when they can be worked out without
+# running anything. That's when the proof starts with one goal, every
+# command but the last one keeps it, and the proof ends in Qed, so the
+# last one must solve it.
+def predict_linear_goals(command_batch : List[str], initial_goals : int) \
+    -> Optional[List[int]]:
+    if initial_goals != 1 or len(command_batch) < 2 or \
+       serapi_instance.kill_comments(command_batch[-1]).strip() != "Qed.":
+        return None
+    commands = [serapi_instance.kill_comments(command).strip()
+                for command in command_batch[:-1]]
+    if any(not single_goal_tactic_pattern.match(command)
+           for command in commands[:-1]) or \
+           re.match(r"Proof\b", commands[-1]) or \
+           any("Transparent" in command or serapi_instance.ending_proof(command)
+               for command in commands):
+        return None
+    return [1] * (len(commands) - 1) + [0]
+
+# linearize_proof, for proofs that already_linear says only need
+# braces. Since the commands don't change, the braces only depend on
+# how many goals are left after each one. So the commands are run
+# without braces, and the braces worked out from the goal counts.
+# When the goal counts can be predicted, nothing is run but an
+# "Admitted." to close the proof. If the goal counts don't add up,
+# the proof is linearized the normal way.
+def linearize_linear_proof(coq : serapi_instance.SerapiInstance,
+                           theorem_name : str,
+                           command_batch : List[str],
+                           debug : bool = False,
+                           skip_nochange_tac : bool = False) -> Iterable[str]:
+    initial_goals = coq.count_fg_goals()
+    predicted_goals = predict_linear_goals(command_batch, initial_goals)
+    if predicted_goals is not None:
+        predictions = iter(predicted_goals)
+        def run_command(command : str) -> int:
+            return next(predictions)
+        def run_ending(command : str) -> None:
+            coq.run_stmt("Admitted.")
+    else:
+        def run_command(command : str) -> int:
+            coq.run_stmt(command)
+            return coq.count_fg_goals()
+        def run_ending(command : str) -> None:
+            coq.run_stmt(command)
+    saved_state = coq.save_state()
+    try:
+        return list(braces_from_goal_counts(command_batch[:], initial_goals,
+                                            run_command, run_ending, debug))
+    except LinearizerCouldNotLinearize:
+        eprint(f"Couldn't linearize {theorem_name} without braces, "
+               "linearizing it normally", guard=debug)
+        coq.restore_state(saved_state)
+        return list(linearize_proof(coq, theorem_name, command_batch,
+                                    debug, skip_nochange_tac))
+
+# The commands and braces linearize_proof would give for an
+# already_linear proof. run_command runs a command without braces and
+# gives the number of goals after it.
+def braces_from_goal_counts(command_batch : List[str], initial_goals : int,
+                            run_command : Callable[[str], int],
+                            run_ending : Callable[[str], None],
+                            debug : bool) -> Iterable[str]:
+    # The goals left at each level of braces, besides the one in them
+    sibling_goals_stack : List[int] = []
+    focused_goals = initial_goals
+    total_goals = initial_goals
+    while command_batch:
+        while focused_goals == 0:
+            indentation = "  " * (len(sibling_goals_stack))
+            if len(sibling_goals_stack) == 0:
+                if total_goals != 0:
+                    raise LinearizerCouldNotLinearize()
+                while command_batch:
+                    command = command_batch.pop(0)
+                    if "Transparent" in command or \
+                       serapi_instance.ending_proof(command):
+                        run_ending(command)
+                        yield command
+                return
+            yield indentation + "}"
+            focused_goals = sibling_goals_stack[-1]
+            if focused_goals > 0:
+                yield indentation + "{"
+                sibling_goals_stack[-1] = focused_goals - 1
+                focused_goals = 1
+            else:
+                sibling_goals_stack.pop()
+        command = command_batch.pop(0)
+        assert serapi_instance.isValidCommand(command), \
+            f"command is \"{command}\", command_batch is {command_batch}"
+        comment_before_command, command = split_leading_comments(command)
+        if comment_before_command:
+            yield comment_before_command
+        if debug:
+            eprint(f"Linearizing command \"{command}\"")
+        try:
+            new_total_goals = run_command(command)
+        except StopIteration:
+            raise LinearizerCouldNotLinearize()
+        focused_goals += new_total_goals - total_goals
+        total_goals = new_total_goals
+        if focused_goals < 0:
+            raise LinearizerCouldNotLinearize()
+        indentation = "  " * (len(sibling_goals_stack) + 1) \
+            if command.strip() != "Proof." else ""
+        yield indentation + command.strip()
+        if focused_goals > 1:
+            sibling_goals_stack.append(focused_goals - 1)
+            focused_goals = 1
+            yield indentation + "{"
+
 def handle_with(command_batch : Iterable[str],
                 with_tactic : str) -> Iterable[str]:
     if not with_tactic:
@@ -484,7 +777,7 @@ def generate_lifted(commands : List[str], coq : serapi_instance.SerapiInstance,
     for command in commands:
         if serapi_instance.possibly_starting_proof(command):
             coq.run_stmt(command)
-            if coq.proof_context:
+            if coq.in_proof:
                 lemma_stack.append([])
             coq.cancel_last()
         if len(lemma_stack) > 0 and not lifted_vernac(command):
@@ -503,7 +796,8 @@ def preprocess_file_commands(args : argparse.Namespace, file_idx : int,
                              filename : str, relative_filename : str,
                              skip_nochange_tac : bool) -> List[str]:
     try:
-        with serapi_instance.SerapiContext(coqargs, includes, args.prelude) as coq:
+        with serapi_instance.PooledSerapiContext(coqargs, includes,
+                                                 args.prelude) as coq:
             coq.debug = args.debug
             with tqdm(file=sys.stdout,
                       disable=not args.progress,
@@ -512,13 +806,20 @@ def preprocess_file_commands(args : argparse.Namespace, file_idx : int,
                       total=len(commands),
                       dynamic_ncols=True,
                       bar_format=mybarfmt) as pbar:
-                result = list(
-                    postlinear_desugar_tacs(
-                        linearize_commands(
-                            args, file_idx,
-                            generate_lifted(commands, coq, pbar),
-                            coq, filename, relative_filename,
-                        skip_nochange_tac)))
+                if args.linearize_workers > 1:
+                    linearized = linearize_commands_parallel(
+                        args, file_idx,
+                        generate_lifted(commands, coq, pbar),
+                        coq, coqargs, includes,
+                        filename, relative_filename,
+                        skip_nochange_tac)
+                else:
+                    linearized = linearize_commands(
+                        args, file_idx,
+                        generate_lifted(commands, coq, pbar),
+                        coq, filename, relative_filename,
+                        skip_nochange_tac)
+                result = list(postlinear_desugar_tacs(linearized))
         return result
     except (CoqExn, BadResponse, AckError, CompletedError):
         eprint("In file {}".format(filename))
@@ -539,7 +840,8 @@ def get_linearized(args : argparse.Namespace, coqargs : List[str], includes : st
             original_commands,
             coqargs, includes,
             local_filename, filename, False)
-        serapi_instance.save_lin(fresh_commands, local_filename)
+        serapi_instance.save_lin(fresh_commands, local_filename,
+                                 open_lin_cache(args))
         return fresh_commands
     else:
         return loaded_commands
@@ -556,6 +858,16 @@ def main():
                         dest='skip_nochange_tac')
     parser.add_argument("--progress",
                         action='store_const', const=True, default=False)
+    parser.add_argument("--linearize-workers", dest="linearize_workers",
+                        default=0, type=int,
+                        help="Linearize the proofs of each file with this many "
+                        "coq instances at once")
+    parser.add_argument("--lin-cache", dest="lin_cache", default=None,
+                        help="a directory of linearized files to share between "
+                        "checkouts")
+    parser.add_argument("--lin-cache-size", dest="lin_cache_size", type=int, default=1024,
+                        help="the most space the linearized file cache can use, "
+                        "in megabytes")
     parser.add_argument('filenames', nargs="+", help="proof file name (*.v)")
     arg_values = parser.parse_args()
 
@@ -574,7 +886,8 @@ def main():
                                                   original_commands,
                                                   coqargs, includes,
                                                   local_filename, filename, False)
-        serapi_instance.save_lin(fresh_commands, local_filename)
+        serapi_instance.save_lin(fresh_commands, local_filename,
+                                 open_lin_cache(arg_values))
 
 if __name__ == "__main__":
     main()
@@ -203,13 +203,17 @@ class DecoderGRU(nn.Module):
         return self.softmax(input), hidden[0]
 
 import sys
-from sklearn import svm
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    # Importing sklearn is slow, so it's only imported once an SVM is
+    # made.
+    from sklearn import svm
 
 svm_kernels = [
     "rbf",
     "linear",
 ]
-class SVMClassifierModel(StraightlineClassifierModel[svm.SVC]):
+class SVMClassifierModel(StraightlineClassifierModel['svm.SVC']):
     @staticmethod
     def add_args_to_parser(parser : argparse.ArgumentParser,
                            default_values : Dict[str, Any] = {}) \
@@ -220,11 +224,12 @@ class SVMClassifierModel(StraightlineClassifierModel[svm.SVC]):
                             default=svm_kernels[0])
     def __init__(self, args : argparse.Namespace,
                  input_vocab_size : int, output_vocab_size : int) -> None:
+        from sklearn import svm
         self._model = svm.SVC(gamma=args.gamma, kernel=args.kernel,
                               probability=args.probability,
                               verbose=args.verbose)
     def checkpoints(self, inputs : List[List[float]], outputs : List[int]) \
-        -> Iterable[svm.SVC]:
+        -> Iterable['svm.SVC']:
         curtime = time.time()
         print("Training SVM...", end="")
         sys.stdout.flush()
@@ -235,7 +240,7 @@ class SVMClassifierModel(StraightlineClassifierModel[svm.SVC]):
         yield self._model
     def predict(self, inputs : List[List[float]]) -> List[List[float]]:
         return self._model.predict_log_proba(inputs)
-    def setState(self, state : svm.SVC) -> None:
+    def setState(self, state : 'svm.SVC') -> None:
         self._model = state
 
 import threading
@@ -180,6 +180,9 @@ class FeaturesPolyArgModel(nn.Module):
         self.hyp_model = maybe_cuda(hyp_model)
 
 from difflib import SequenceMatcher
+# The most contexts to run through the model at once
+inference_batch_size = 256
+
 class FeaturesPolyargPredictor(
         TrainablePredictor[FeaturesPolyArgDataset,
                            Tuple[Tokenizer, Embedding,
@@ -199,106 +202,130 @@ class FeaturesPolyargPredictor(
         self._embedding : Optional[Embedding] = None
         self._model : Optional[FeaturesPolyArgModel] = None
     def predictKTactics(self, context : TacticContext, k : int) -> List[Prediction]:
+        return self.predictKTactics_batch([context], k)[0]
+    # Runs the stem classifier and the goal and hypothesis argument
+    # models on many contexts at once. Contexts are grouped by how many
+    # hypotheses they have, to keep the padding down.
+    def predictKTactics_batch(self, contexts : List[TacticContext], k : int) \
+        -> List[List[Prediction]]:
+        results : List[Optional[List[Prediction]]] = [None] * len(contexts)
+        order = sorted(range(len(contexts)),
+                       key=lambda idx: len(contexts[idx].hypotheses))
+        for chunk_idxs in chunks(order, inference_batch_size):
+            chunk_predictions = self.predictKTacticsChunk(
+                [contexts[idx] for idx in chunk_idxs], k)
+            for idx, predictions in zip(chunk_idxs, chunk_predictions):
+                results[idx] = predictions
+        return cast(List[List[Prediction]], results)
+    # The hypotheses of each context are padded out to the most any of
+    # them has, and the padding is masked out before the softmax, so
+    # each context gets the same predictions it would get on its own.
+    def predictKTacticsChunk(self, contexts : List[TacticContext], k : int) \
+        -> List[List[Prediction]]:
         assert self._tokenizer
         assert self._embedding
         assert self.training_args
         assert self._model
         beam_width=min(self.training_args.max_beam_width, k ** 2)
-        num_hyps = len(context.hypotheses)
+        batch_size = len(contexts)
+        max_length = self.training_args.max_length
+        max_hyps = max([len(context.hypotheses) for context in contexts])
 
         num_stem_poss = self._embedding.num_tokens()
         stem_width = min(beam_width, num_stem_poss)
 
         with self._lock:
 
-            word_features, vec_features = self.encodeFeatureVecs([context])
+            word_features, vec_features = self.encodeFeatureVecs(contexts)
             stem_distribution = self._model.stem_classifier(word_features, vec_features)
             stem_certainties, stem_idxs = stem_distribution.topk(stem_width)
 
-            goals_batch = LongTensor([self.encodeStrTerm(context.goal)])
+            goals_batch = LongTensor([self.encodeStrTerm(context.goal)
+                                      for context in contexts])
             goal_arg_values = self._model.goal_args_model(
-                stem_idxs.view(1 * stem_width),
-                goals_batch.view(1, 1, self.training_args.max_length)\
+                stem_idxs.view(batch_size * stem_width),
+                goals_batch.view(batch_size, 1, max_length)\
                 .expand(-1, stem_width, -1).contiguous()\
-                .view(1 * stem_width,
-                      self.training_args.max_length))\
-                      .view(1, stem_width, self.training_args.max_length + 1)
-            goal_symbols = tokenizer.get_symbols(context.goal)
-            for i in range(len(goal_symbols) + 1, goal_arg_values.size()[2]):
-                goal_arg_values[:, :, i] = -float("Inf")
-            assert goal_arg_values.size() == torch.Size([1, stem_width,
-                                                         self.training_args.max_length + 1]),\
+                .view(batch_size * stem_width, max_length))\
+                .view(batch_size, stem_width, max_length + 1)
+            for context_idx, context in enumerate(contexts):
+                num_goal_symbols = len(tokenizer.get_symbols(context.goal))
+                goal_arg_values[context_idx, :, num_goal_symbols + 1:] = -float("Inf")
+            assert goal_arg_values.size() == torch.Size([batch_size, stem_width,
+                                                         max_length + 1]),\
                 "goal_arg_values.size(): {}; stem_width: {}".format(goal_arg_values.size(),
                                                                     stem_width)
 
-            num_probs = 1 + len(context.hypotheses) + self.training_args.max_length
-            if len(context.hypotheses) > 0:
+            num_probs = 1 + max_hyps + max_length
+            if max_hyps > 0:
                 encoded_goals = self._model.goal_encoder(goals_batch)\
-                                           .view(1, 1, self.training_args.hidden_size)
+                                           .view(batch_size, self.training_args.hidden_size)
 
                 hyps_batch = LongTensor([[self.encodeStrTerm(hyp)
-                                          for hyp in context.hypotheses]])
-                assert hyps_batch.size() == torch.Size([1, num_hyps,
-                                                        self.training_args.max_length])
-                hyps_batch_expanded = hyps_batch.expand(stem_width, -1, -1)\
-                                                .contiguous()\
-                                                .view(stem_width * num_hyps,
-                                                      self.training_args.max_length)
-
-                hypfeatures_batch = self.encodeHypsFeatureVecs(context.goal,
-                                                               context.hypotheses)
-                assert hypfeatures_batch.size() == torch.Size([num_hyps, 2])
-                hypfeatures_batch_expanded = hypfeatures_batch.view(1, num_hyps, 2)\
-                                                             .expand(stem_width, -1, 2)\
-                                                             .contiguous()\
-                                                             .view(stem_width * num_hyps, 2)
+                                          for hyp in context.hypotheses] +
+                                         [[0] * max_length] *
+                                         (max_hyps - len(context.hypotheses))
+                                         for context in contexts])
+                assert hyps_batch.size() == torch.Size([batch_size, max_hyps,
+                                                        max_length])
+                hypfeatures_batch = torch.zeros(batch_size, max_hyps, 2)
+                for context_idx, context in enumerate(contexts):
+                    if len(context.hypotheses) > 0:
+                        hypfeatures_batch[context_idx, :len(context.hypotheses)] = \
+                            self.encodeHypsFeatureVecs(context.goal,
+                                                       context.hypotheses)
                 hyp_arg_values = self.runHypModel(stem_idxs,
                                                   encoded_goals, hyps_batch,
                                                   hypfeatures_batch)
                 assert hyp_arg_values.size() == \
-                    torch.Size([1, stem_width, len(context.hypotheses)])
+                    torch.Size([batch_size, stem_width, max_hyps])
+                for context_idx, context in enumerate(contexts):
+                    hyp_arg_values[context_idx, :, len(context.hypotheses):] = \
+                        -float("Inf")
                 total_values = torch.cat((goal_arg_values, hyp_arg_values), dim=2)
             else:
                 total_values = goal_arg_values
             all_prob_batches = self._softmax((total_values +
-                                              stem_certainties.view(1, stem_width, 1)
+                                              stem_certainties.view(batch_size,
+                                                                    stem_width, 1)
                                               .expand(-1, -1, num_probs))
                                              .contiguous()
-                                             .view(1, stem_width * num_probs))\
-                                   .view(stem_width * num_probs)
+                                             .view(batch_size, stem_width * num_probs))
 
-            final_probs, final_idxs = all_prob_batches.topk(beam_width)
-            assert not torch.isnan(final_probs).any()
-            assert final_probs.size() == torch.Size([beam_width])
-            row_length = self.training_args.max_length + len(context.hypotheses) + 1
-            stem_keys = final_idxs / row_length
-            assert stem_keys.size() == torch.Size([beam_width])
-            assert stem_idxs.size() == torch.Size([1, stem_width]), stem_idxs.size()
-            prediction_stem_idxs = stem_idxs.view(stem_width).index_select(0, stem_keys)
-            assert prediction_stem_idxs.size() == torch.Size([beam_width]), \
-                prediction_stem_idxs.size()
-            arg_idxs = final_idxs % row_length
-            assert arg_idxs.size() == torch.Size([beam_width])
-            return [Prediction(self.decodePrediction(context.goal,
-                                                     context.hypotheses,
-                                                     stem_idx.item(),
-                                                     arg_idx.item()),
-                               math.exp(prob))
-                    for stem_idx, arg_idx, prob in
-                    islice(zip(prediction_stem_idxs, arg_idxs, final_probs), k)]
+            assert not torch.isnan(all_prob_batches).any()
+            all_probs = all_prob_batches.view(batch_size, stem_width, num_probs)
+            results : List[List[Prediction]] = []
+            for context, context_stem_idxs, context_probs in \
+                zip(contexts, stem_idxs, all_probs):
+                # Only pick from this context's own args, leaving out the
+                # hypotheses it was padded with, so that it gets the same
+                # k predictions it would on its own.
+                row_length = 1 + max_length + len(context.hypotheses)
+                final_probs, final_idxs = context_probs[:, :row_length]\
+                    .contiguous().view(stem_width * row_length).topk(beam_width)
+                prediction_stem_idxs = context_stem_idxs.index_select(
+                    0, final_idxs // row_length)
+                arg_idxs = final_idxs % row_length
+                results.append([Prediction(self.decodePrediction(context.goal,
+                                                                 context.hypotheses,
+                                                                 stem_idx.item(),
+                                                                 arg_idx.item()),
+                                           math.exp(prob))
+                                for stem_idx, arg_idx, prob in
+                                islice(zip(prediction_stem_idxs, arg_idxs,
+                                           final_probs), k)])
+            return results
     def predictKTacticsWithLoss(self, in_data : TacticContext, k : int, correct : str) -> \
         Tuple[List[Prediction], float]:
         return self.predictKTactics(in_data, k), 0
+    # The word and vector features only look at the last tactic
+    def prevTacticsUsed(self) -> Optional[int]:
+        return 1
     def predictKTacticsWithLoss_batch(self,
                                       in_datas : List[TacticContext],
                                       k : int, corrects : List[str]) -> \
                                       Tuple[List[List[Prediction]], float]:
-        subresults = [self.predictKTacticsWithLoss(in_data, k, correct)
-                      for in_data, correct in
-                      zip(in_datas, corrects)]
-        loss = sum([subresult[1] for subresult in subresults])
-        predictions = [subresult[0] for subresult in subresults]
-        return predictions, loss
+        return self.predictKTactics_batch(in_datas, k), 0
 
     def predictTactic(self, context : TacticContext) -> Prediction:
         assert self.training_args
@@ -363,10 +390,9 @@ class FeaturesPolyargPredictor(
         assert self._model
         assert self.training_args
         batch_size = encoded_goals.size()[0]
-        assert batch_size == 1
         num_hyps = hyps_batch.size()[1]
         beam_width = stem_idxs.size()[1]
-        features_size = hypfeatures_batch.size()[1]
+        features_size = hypfeatures_batch.size()[-1]
         hyp_arg_values = \
             self._model.hyp_model(stem_idxs.view(batch_size, beam_width, 1)
                                   .expand(-1, -1, num_hyps).contiguous()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3.7
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+import threading
+from collections import OrderedDict
+
+from typing import Any, List, Tuple, Optional, Hashable, Dict
+
+from models.tactic_predictor import TacticPredictor, Prediction, TacticContext
+
+# Wraps any predictor with a least-recently-used cache of its
+# predictions, for when the same contexts come up over and over (like
+# when search backtracks). The key only includes as many previous
+# tactics as the wrapped predictor says it looks at.
+class MemoizingPredictor(TacticPredictor):
+    def __init__(self, predictor : TacticPredictor, max_size : int) -> None:
+        self.predictor = predictor
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.__cache : 'OrderedDict[Hashable, Tuple[List[Prediction], float]]' = \
+            OrderedDict()
+        self.__lock = threading.Lock()
+
+    # Anything else the callers use on the predictor (like its
+    # training args or tokenizer) comes from the wrapped one. Copying
+    # and unpickling look things up before predictor is set, and need
+    # an AttributeError then.
+    def __getattr__(self, name : str) -> Any:
+        return getattr(object.__getattribute__(self, "predictor"), name)
+
+    # The lock can't be pickled, so pickles leave out the cache too,
+    # and start over with an empty one.
+    def __getstate__(self) -> Dict[str, Any]:
+        state = dict(self.__dict__)
+        del state["_MemoizingPredictor__cache"]
+        del state["_MemoizingPredictor__lock"]
+        return state
+    def __setstate__(self, state : Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self.__cache = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def getOptions(self) -> List[Tuple[str, str]]:
+        return self.predictor.getOptions()
+
+    def predictKTactics(self, in_data : TacticContext, k : int) \
+        -> List[Prediction]:
+        key = self.__key(in_data, k, None)
+        cached = self.__lookup(key)
+        if cached:
+            return list(cached[0])
+        predictions = self.predictor.predictKTactics(in_data, k)
+        self.__store(key, (predictions, 0.))
+        return list(predictions)
+
+    def predictKTacticsWithLoss(self, in_data : TacticContext, k : int, correct : str) -> \
+        Tuple[List[Prediction], float]:
+        key = self.__key(in_data, k, correct)
+        cached = self.__lookup(key)
+        if cached:
+            return list(cached[0]), cached[1]
+        predictions, loss = self.predictor.predictKTacticsWithLoss(in_data, k, correct)
+        self.__store(key, (predictions, loss))
+        return list(predictions), loss
+
+    # Only the contexts that miss go to the wrapped predictor, in one
+    # batch. Since it only gives a loss for the whole batch, that's
+    # split evenly between them when they're cached.
+    def predictKTacticsWithLoss_batch(self,
+                                      in_data : List[TacticContext],
+                                      k : int, correct : List[str]) -> \
+                                      Tuple[List[List[Prediction]], float]:
+        keys = [self.__key(context, k, c) for context, c in zip(in_data, correct)]
+        results : List[Optional[Tuple[List[Prediction], float]]] = \
+            [self.__lookup(key) for key in keys]
+        missing_idxs = [idx for idx, result in enumerate(results) if result is None]
+        if missing_idxs:
+            predictions, loss = self.predictor.predictKTacticsWithLoss_batch(
+                [in_data[idx] for idx in missing_idxs], k,
+                [correct[idx] for idx in missing_idxs])
+            item_loss = loss / len(missing_idxs)
+            for idx, item_predictions in zip(missing_idxs, predictions):
+                results[idx] = (item_predictions, item_loss)
+                self.__store(keys[idx], (item_predictions, item_loss))
+        return ([list(result[0]) for result in results if result],
+                sum([result[1] for result in results if result]))
+
+    def hitRate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.
+
+    def statsString(self) -> str:
+        return (f"Prediction cache: {self.hits} hits, {self.misses} misses "
+                f"({self.hitRate():.2%} hit rate)")
+
+    def __key(self, context : TacticContext, k : int,
+              correct : Optional[str]) -> Hashable:
+        num_prev_tactics = self.predictor.prevTacticsUsed()
+        prev_tactics : Hashable
+        if num_prev_tactics is None:
+            prev_tactics = tuple(context.prev_tactics)
+        else:
+            # Predictors often check whether there's a previous tactic
+            # at all, so keep track of whether the suffix is everything
+            prev_tactics = (tuple(context.prev_tactics[-num_prev_tactics:]
+                                  if num_prev_tactics > 0 else []),
+                            min(len(context.prev_tactics), num_prev_tactics + 1))
+        return (prev_tactics, tuple(context.hypotheses), context.goal, k, correct)
+
+    def __lookup(self, key : Hashable) -> Optional[Tuple[List[Prediction], float]]:
+        with self.__lock:
+            result = self.__cache.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.__cache.move_to_end(key)
+            return result
+
+    def __store(self, key : Hashable, result : Tuple[List[Prediction], float]) -> None:
+        with self.__lock:
+            self.__cache[key] = result
+            self.__cache.move_to_end(key)
+            while len(self.__cache) > self.max_size:
+                self.__cache.popitem(last=False)
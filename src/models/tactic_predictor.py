@@ -40,6 +40,12 @@ class TacticPredictor(metaclass=ABCMeta):
                                       k : int, correct : List[str]) -> \
                                       Tuple[List[List[Prediction]], float]: pass
 
+    # How many of the most recent previous tactics predictions depend
+    # on, or None if they could depend on all of them. Caches of
+    # predictions use this to key on as little as they can.
+    def prevTacticsUsed(self) -> Optional[int]:
+        return None
+
 from data import Dataset, RawDataset, ScrapedTactic, get_text_data, TokenizedDataset, \
     DatasetMetadata, stemmify_data, tactic_substitutions
 from typing import TypeVar, Generic, Sized
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3.7
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# A cache of what happened when search ran a tactic in a proof state,
+# kept in an sqlite database next to the .lin file of each source
+# file, so that it carries over between search runs.
+
+import hashlib
+import json
+import sqlite3
+import threading
+from typing import Optional, NamedTuple, List
+
+from serapi_instance import FullContext, Subgoal
+
+class TacticOutcome(NamedTuple):
+    # The name of the exception the tactic raised, or None if it ran
+    error : Optional[str]
+    context_after : Optional[FullContext]
+
+def outcome_cache_path(filename : str) -> str:
+    return filename + ".outcomes"
+
+class OutcomeCache:
+    def __init__(self, db_path : str) -> None:
+        # Search workers look things up from their own threads
+        self.__conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.__lock = threading.Lock()
+        with self.__lock:
+            self.__conn.execute("CREATE TABLE IF NOT EXISTS outcomes "
+                                "(file_hash TEXT, lemma TEXT, "
+                                "context_hash TEXT, tactic TEXT, "
+                                "error TEXT, context_after TEXT, "
+                                "PRIMARY KEY (file_hash, lemma, "
+                                "context_hash, tactic))")
+            self.__conn.commit()
+
+    def lookup(self, file_hash : str, lemma : str, context_hash : str,
+               tactic : str) -> Optional[TacticOutcome]:
+        with self.__lock:
+            row = self.__conn.execute(
+                "SELECT error, context_after FROM outcomes "
+                "WHERE file_hash = ? AND lemma = ? AND "
+                "context_hash = ? AND tactic = ?",
+                (file_hash, lemma, context_hash, tactic)).fetchone()
+        if row is None:
+            return None
+        error, context_after = row
+        return TacticOutcome(error, decode_context(context_after)
+                             if context_after else None)
+
+    def record(self, file_hash : str, lemma : str, context_hash : str,
+               tactic : str, outcome : TacticOutcome) -> None:
+        with self.__lock:
+            self.__conn.execute(
+                "INSERT OR REPLACE INTO outcomes VALUES (?, ?, ?, ?, ?, ?)",
+                (file_hash, lemma, context_hash, tactic, outcome.error,
+                 encode_context(outcome.context_after)
+                 if outcome.context_after else None))
+
+    def flush(self) -> None:
+        with self.__lock:
+            self.__conn.commit()
+
+    def close(self) -> None:
+        self.flush()
+        self.__conn.close()
+
+    def forLemma(self, file_hash : str, lemma : str) -> 'LemmaOutcomes':
+        return LemmaOutcomes(self, file_hash, lemma)
+
+# The outcome cache, narrowed to the lemma being searched
+class LemmaOutcomes(NamedTuple):
+    cache : OutcomeCache
+    file_hash : str
+    lemma : str
+
+    def lookup(self, context_hash : str, tactic : str) -> Optional[TacticOutcome]:
+        return self.cache.lookup(self.file_hash, self.lemma, context_hash, tactic)
+    def record(self, context_hash : str, tactic : str,
+               outcome : TacticOutcome) -> None:
+        self.cache.record(self.file_hash, self.lemma, context_hash, tactic, outcome)
+
+def encode_context(context : FullContext) -> str:
+    return json.dumps([[subgoal.hypotheses, subgoal.goal]
+                       for subgoal in context.subgoals])
+
+# Outcomes are keyed on the exact proof state, with the names and order
+# of the hypotheses, since tactics refer to hypotheses by name.
+def context_key(context : FullContext) -> str:
+    return hashlib.sha1(encode_context(context).encode('utf-8')).hexdigest()
+
+def decode_context(encoded : str) -> FullContext:
+    return FullContext([Subgoal(hypotheses, goal)
+                        for hypotheses, goal in json.loads(encoded)])
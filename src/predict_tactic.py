@@ -20,86 +20,73 @@
 #
 ##########################################################################
 
+import os
+import threading
 import torch
-from typing import Dict, List, Union, Callable
-import functools
+from typing import Dict, Tuple
 from models.tactic_predictor import TacticPredictor, TrainablePredictor
-from models.components import DNNClassifierModel
+from util import LazyRegistry
+from weights_file import is_weights_file, load_weights
 
-from models import encdecrnn_predictor
-from models import try_common_predictor
-from models import wordbagclass_predictor
-from models import ngramclass_predictor
-from models import encclass_predictor
-from models import dnnclass_predictor
-from models import k_nearest_predictor
-from models import autoclass_predictor
-from models import wordbagsvm_classifier
-from models import ngramsvm_classifier
-from models import hyparg_predictor
-from models import pec_predictor
-from models import features_predictor
-from models import encfeatures_predictor
-from models import featuressvm_predictor
-from models import apply_predictor
-from models import apply_baselines
-from models import hypstem_predictor
-from models import hypfeatures_predictor
-from models import copyarg_predictor
-from models import numeric_induction
-from models import features_polyarg_predictor
+# The predictors are only imported when they're picked, so that using
+# one model doesn't mean importing all the others (and sklearn).
 
-loadable_predictors = {
-    'encdec' : encdecrnn_predictor.EncDecRNNPredictor,
-    'encclass' : encclass_predictor.EncClassPredictor,
-    'dnnclass' : dnnclass_predictor.DNNClassPredictor,
-    'trycommon' : try_common_predictor.TryCommonPredictor,
-    'wordbagclass' : wordbagclass_predictor.WordBagClassifyPredictor,
-    'ngramclass' : ngramclass_predictor.NGramClassifyPredictor,
-    'k-nearest' : k_nearest_predictor.KNNPredictor,
-    'autoclass' : autoclass_predictor.AutoClassPredictor,
-    'wordbagsvm' : wordbagsvm_classifier.WordBagSVMClassifier,
-    'ngramsvm' : ngramsvm_classifier.NGramSVMClassifier,
-    'pec' : pec_predictor.PECPredictor,
-    'features' : features_predictor.FeaturesPredictor,
-    'featuressvm' : featuressvm_predictor.FeaturesSVMPredictor,
-    'encfeatures' : encfeatures_predictor.EncFeaturesPredictor,
-    'apply' : apply_predictor.ApplyPredictor,
-    "hypstem" : functools.partial(hypstem_predictor.HypStemPredictor, DNNClassifierModel),
-    "hypfeatures" : hypfeatures_predictor.HypFeaturesPredictor,
-    "copyarg" : copyarg_predictor.CopyArgPredictor,
-    "polyarg" : features_polyarg_predictor.FeaturesPolyargPredictor,
-}
+def hypstem_predictor() -> TrainablePredictor:
+    from models.hypstem_predictor import HypStemPredictor
+    from models.components import DNNClassifierModel
+    return HypStemPredictor(DNNClassifierModel)
 
-static_predictors = {
-    'apply_longest' : apply_baselines.ApplyLongestPredictor,
-    'apply_similar' : apply_baselines.ApplyStringSimilarPredictor,
-    'apply_similar2' : apply_baselines.ApplyNormalizedSimilarPredictor,
-    'apply_wordsim' : apply_baselines.ApplyWordSimlarPredictor,
-    'numeric_induction' : numeric_induction.NumericInductionPredictor,
-}
+loadable_predictors = LazyRegistry({
+    'encdec' : "models.encdecrnn_predictor:EncDecRNNPredictor",
+    'encclass' : "models.encclass_predictor:EncClassPredictor",
+    'dnnclass' : "models.dnnclass_predictor:DNNClassPredictor",
+    'trycommon' : "models.try_common_predictor:TryCommonPredictor",
+    'wordbagclass' : "models.wordbagclass_predictor:WordBagClassifyPredictor",
+    'ngramclass' : "models.ngramclass_predictor:NGramClassifyPredictor",
+    'k-nearest' : "models.k_nearest_predictor:KNNPredictor",
+    'autoclass' : "models.autoclass_predictor:AutoClassPredictor",
+    'wordbagsvm' : "models.wordbagsvm_classifier:WordBagSVMClassifier",
+    'ngramsvm' : "models.ngramsvm_classifier:NGramSVMClassifier",
+    'pec' : "models.pec_predictor:PECPredictor",
+    'features' : "models.features_predictor:FeaturesPredictor",
+    'featuressvm' : "models.featuressvm_predictor:FeaturesSVMPredictor",
+    'encfeatures' : "models.encfeatures_predictor:EncFeaturesPredictor",
+    'apply' : "models.apply_predictor:ApplyPredictor",
+    "hypstem" : hypstem_predictor,
+    "hypfeatures" : "models.hypfeatures_predictor:HypFeaturesPredictor",
+    "copyarg" : "models.copyarg_predictor:CopyArgPredictor",
+    "polyarg" : "models.features_polyarg_predictor:FeaturesPolyargPredictor",
+})
 
-trainable_modules : Dict[str, Callable[[List[str]], None]] = {
-    "encdec" : encdecrnn_predictor.main,
-    "encclass" : encclass_predictor.main,
-    "dnnclass" : dnnclass_predictor.main,
-    "trycommon" : try_common_predictor.train,
-    "wordbagclass" : wordbagclass_predictor.main,
-    "ngramclass" : ngramclass_predictor.main,
-    "k-nearest" : k_nearest_predictor.main,
-    "autoclass" : autoclass_predictor.main,
-    "wordbagsvm" : wordbagsvm_classifier.main,
-    "ngramsvm" : ngramsvm_classifier.main,
-    "pec" : pec_predictor.main,
-    "features" : features_predictor.main,
-    "featuressvm" : featuressvm_predictor.main,
-    "encfeatures" : encfeatures_predictor.main,
-    "relevance" : apply_predictor.train_relevance,
-    "hypstem" : hypstem_predictor.main,
-    "hypfeatures" : hypfeatures_predictor.main,
-    "copyarg" : copyarg_predictor.main,
-    "polyarg" : features_polyarg_predictor.main,
-}
+static_predictors = LazyRegistry({
+    'apply_longest' : "models.apply_baselines:ApplyLongestPredictor",
+    'apply_similar' : "models.apply_baselines:ApplyStringSimilarPredictor",
+    'apply_similar2' : "models.apply_baselines:ApplyNormalizedSimilarPredictor",
+    'apply_wordsim' : "models.apply_baselines:ApplyWordSimlarPredictor",
+    'numeric_induction' : "models.numeric_induction:NumericInductionPredictor",
+})
+
+trainable_modules = LazyRegistry({
+    "encdec" : "models.encdecrnn_predictor:main",
+    "encclass" : "models.encclass_predictor:main",
+    "dnnclass" : "models.dnnclass_predictor:main",
+    "trycommon" : "models.try_common_predictor:train",
+    "wordbagclass" : "models.wordbagclass_predictor:main",
+    "ngramclass" : "models.ngramclass_predictor:main",
+    "k-nearest" : "models.k_nearest_predictor:main",
+    "autoclass" : "models.autoclass_predictor:main",
+    "wordbagsvm" : "models.wordbagsvm_classifier:main",
+    "ngramsvm" : "models.ngramsvm_classifier:main",
+    "pec" : "models.pec_predictor:main",
+    "features" : "models.features_predictor:main",
+    "featuressvm" : "models.featuressvm_predictor:main",
+    "encfeatures" : "models.encfeatures_predictor:main",
+    "relevance" : "models.apply_predictor:train_relevance",
+    "hypstem" : "models.hypstem_predictor:main",
+    "hypfeatures" : "models.hypfeatures_predictor:main",
+    "copyarg" : "models.copyarg_predictor:main",
+    "polyarg" : "models.features_polyarg_predictor:main",
+})
 
 def loadPredictorByName(predictor_type : str) -> TacticPredictor:
     # Silencing the type checker on this line because the "real" type
@@ -109,7 +96,10 @@ def loadPredictorByName(predictor_type : str) -> TacticPredictor:
     return static_predictors[predictor_type]() # type: ignore
 
 def loadPredictorByFile(filename : str) -> TrainablePredictor:
-    predictor_type, saved_state = torch.load(filename, map_location='cpu')
+    if is_weights_file(filename):
+        predictor_type, saved_state = load_weights(filename)
+    else:
+        predictor_type, saved_state = torch.load(filename, map_location='cpu')
     # Silencing the type checker on this line because the "real" type
     # of the predictors dictionary is "string to classes constructors
     # that derive from TacticPredictor, but are not tactic
@@ -117,3 +107,21 @@ def loadPredictorByFile(filename : str) -> TrainablePredictor:
     predictor = loadable_predictors[predictor_type]() # type: ignore
     predictor.load_saved_state(*saved_state)
     return predictor
+
+# Predictors loaded by loadSharedPredictorByFile, by the path, time
+# modified and size of their weights file. Predicting doesn't change a
+# predictor, so all the threads of a process (like the per-file searches
+# of search_report) can use the same one, instead of each loading the
+# weights again.
+shared_predictors : Dict[Tuple[str, int, int], TrainablePredictor] = {}
+shared_predictors_lock = threading.Lock()
+
+def loadSharedPredictorByFile(filename : str) -> TrainablePredictor:
+    stat = os.stat(filename)
+    key = (os.path.realpath(filename), stat.st_mtime_ns, stat.st_size)
+    # Loading with the lock held means that threads which ask for the
+    # same predictor at once wait for one load, instead of all loading it.
+    with shared_predictors_lock:
+        if key not in shared_predictors:
+            shared_predictors[key] = loadPredictorByFile(filename)
+        return shared_predictors[key]
@@ -24,9 +24,6 @@ import pdb
 import signal
 import sys
 from tokenizer import tokenizers
-import search_report
-import dynamic_report
-import static_report
 import argparse
 import data
 import itertools
@@ -34,7 +31,6 @@ import serapi_instance
 import features
 from util import *
 from models.tactic_predictor import strip_scraped_output
-from models.components import SimpleEmbedding
 from predict_tactic import trainable_modules
 from pathlib_revised import Path2
 
@@ -115,6 +111,7 @@ def get_data(args : List[str]) -> None:
             print("====> {}".format(tactic))
         pass
     elif arg_values.format == "tacvector":
+        from models.components import SimpleEmbedding
         dataset = data.get_text_data(arg_values)
         embedding = SimpleEmbedding()
         eprint("Encoding tactics...", guard=arg_values.verbose)
@@ -138,13 +135,16 @@ def get_data(args : List[str]) -> None:
             print(",".join(list(map(str, word_feat)) + list(map(str, vec_feat))
                            + [str(tactic)]))
 
-modules = {
+# The report modules are only imported when they're run
+modules = LazyRegistry({
     "train" : train,
-    "search-report":search_report.main,
-    "dynamic-report":dynamic_report.main,
-    "static-report":static_report.main,
+    "search-report": "search_report:main",
+    "dynamic-report": "dynamic_report:main",
+    "static-report": "static_report:main",
     "data": get_data,
-}
+    "convert-scrape": "binary_scrape:main",
+    "convert-weights": "weights_file:main",
+})
 
 if __name__ == "__main__":
     main()
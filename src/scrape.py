@@ -27,17 +27,25 @@ import tempfile
 import functools
 import sys
 import contextlib
+import hashlib
+import io
 import os
+import queue
+import time
 
 import linearize_semicolons
 import serapi_instance
+from lin_cache import open_lin_cache
 
 from sexpdata import *
 from traceback import *
 from util import *
 from format import format_context, format_tactic
+from binary_scrape import BinaryScrapeWriter, read_text_scrape
+from scrape_cache import (ScrapeCache, DependencyGraph, scrape_cache_path,
+                          proof_key, closing_proof, proof_body_opaque)
 
-from typing import Dict, Any, TextIO, List
+from typing import Dict, Any, TextIO, List, Optional, Iterator, NamedTuple
 
 def main():
     # Parse the command line arguments.
@@ -53,8 +61,28 @@ def main():
                         action='store_const', const=True, default=False)
     parser.add_argument('--skip-nochange-tac', default=False, const=True, action='store_const',
                     dest='skip_nochange_tac')
+    parser.add_argument('--linearize-workers', dest='linearize_workers', default=0, type=int,
+                        help="linearize the proofs of each file with this many "
+                        "coq instances at once")
+    parser.add_argument('--lin-cache', dest='lin_cache', default=None,
+                        help="a directory of linearized files to share between "
+                        "checkouts")
+    parser.add_argument('--lin-cache-size', dest='lin_cache_size', type=int, default=1024,
+                        help="the most space the linearized file cache can use, "
+                        "in megabytes")
+    parser.add_argument('--binary', action='store_true',
+                        help="write the output in the indexed binary scrape format")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only rescrape the proofs that changed since the last "
+                        "scrape, and files whose dependencies changed")
+    parser.add_argument('--stream', action='store_true',
+                        help="send scraped records to the output as they're "
+                        "scraped, instead of once each file finishes")
     parser.add_argument('inputs', nargs="+", help="proof file name(s) (*.v)")
     args = parser.parse_args()
+    if args.binary and not args.output:
+        eprint("Binary scrapes need an output file (-o)")
+        sys.exit(1)
 
 
     includes=subprocess.Popen(['make', '-C', args.prelude, 'print-includes'],
@@ -64,10 +92,35 @@ def main():
     thispath = os.path.dirname(os.path.abspath(__file__))
     # Set up the command which runs sertop.
     coqargs = ["sertop"]
-    with multiprocessing.Pool(args.threads) as pool:
+    if args.incremental:
+        dependency_graph = DependencyGraph(args.prelude)
+        deps_hashes = {filename : dependency_graph.deps_hash(filename)
+                       for filename in args.inputs}
+    else:
+        deps_hashes = {}
+    scrape_queue = multiprocessing.Queue() if args.stream else None
+    with multiprocessing.Pool(args.threads, initializer=set_scrape_queue,
+                              initargs=(scrape_queue,)) as pool:
         scrape_result_files = pool.imap_unordered(
-            functools.partial(scrape_file, coqargs, args, includes),
+            functools.partial(scrape_file, coqargs, args, includes, deps_hashes),
             enumerate(args.inputs))
+        if scrape_queue:
+            merge_streamed_scrapes(args, scrape_queue)
+            return
+        if args.binary:
+            with open(args.output, 'wb') as binary_out:
+                writer = BinaryScrapeWriter(binary_out)
+                for idx, scrape_result_file in enumerate(scrape_result_files, start=1):
+                    if scrape_result_file is None:
+                        eprint("Failed file {} of {}".format(idx, len(args.inputs)))
+                    else:
+                        if args.verbose:
+                            eprint("Finished file {} of {}".format(idx, len(args.inputs)))
+                        filename = os.path.relpath(scrape_result_file[:-len(".scrape")],
+                                                   args.prelude)
+                        writer.write_file(filename, read_text_scrape(scrape_result_file))
+                writer.close()
+            return
         with (open(args.output, 'w') if args.output
               else contextlib.nullcontext(sys.stdout)) as out:
             for idx, scrape_result_file in enumerate(scrape_result_files, start=1):
@@ -80,9 +133,180 @@ def main():
                         for line in f:
                             out.write(line)
 
-from tqdm import tqdm
+# When streaming, workers send these to the main process: some scraped
+# text from a file, or that a file is done (with the path of its
+# .scrape, or None if it failed).
+class ScrapedChunk(NamedTuple):
+    file_idx : int
+    text : str
+class ScrapeFinished(NamedTuple):
+    file_idx : int
+    result_file : Optional[str]
+
+scrape_queue : Optional[multiprocessing.Queue] = None
+def set_scrape_queue(queue : Optional[multiprocessing.Queue]) -> None:
+    global scrape_queue
+    scrape_queue = queue
+
+stream_chunk_size = 1 << 16
+
+# Writes to a file's .scrape, and sends the same text to the main
+# process, a chunk at a time.
+class StreamingScrapeFile:
+    def __init__(self, f : TextIO, file_idx : int,
+                 queue : multiprocessing.Queue) -> None:
+        self.f = f
+        self.file_idx = file_idx
+        self.queue = queue
+        self.pending : List[str] = []
+        self.pending_size = 0
+    def write(self, text : str) -> None:
+        self.f.write(text)
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.pending_size >= stream_chunk_size:
+            self.flush()
+    def flush(self) -> None:
+        if self.pending:
+            self.queue.put(ScrapedChunk(self.file_idx, "".join(self.pending)))
+            self.pending = []
+            self.pending_size = 0
+
+@contextlib.contextmanager
+def open_scrape_output(result_file : str, file_idx : int) -> Iterator[Any]:
+    with open(result_file, 'w') as f:
+        if scrape_queue is None:
+            yield f
+            return
+        stream = StreamingScrapeFile(f, file_idx, scrape_queue)
+        try:
+            yield stream
+        finally:
+            stream.flush()
+
+def count_records(text : str) -> int:
+    return text.count("\n-----\n")
+
+# Writes the records from the workers to the output as they come in,
+# a file at a time, reporting progress as they do.
+def merge_streamed_scrapes(args : argparse.Namespace,
+                           scrape_queue : multiprocessing.Queue) -> None:
+    num_records = 0
+    num_finished = 0
+    start_time = time.time()
+    last_report = start_time
+    def report(final : bool = False) -> None:
+        elapsed = time.time() - start_time
+        eprint(f"\r{num_records} records, "
+               f"{num_records / elapsed if elapsed > 0 else 0:.1f} records/sec, "
+               f"{num_finished} of {len(args.inputs)} files finished",
+               end="\n" if final else "")
+    if args.binary:
+        with open(args.output, 'wb') as binary_out:
+            writer = BinaryScrapeWriter(binary_out)
+            while num_finished < len(args.inputs):
+                try:
+                    message = scrape_queue.get(timeout=1)
+                except queue.Empty:
+                    message = None
+                if isinstance(message, ScrapedChunk):
+                    num_records += count_records(message.text)
+                elif isinstance(message, ScrapeFinished):
+                    num_finished += 1
+                    if message.result_file is None:
+                        eprint(f"\nFailed file {args.inputs[message.file_idx]}")
+                    else:
+                        writer.write_file(
+                            os.path.relpath(message.result_file[:-len(".scrape")],
+                                            args.prelude),
+                            read_text_scrape(message.result_file))
+                if time.time() - last_report >= 1:
+                    report()
+                    last_report = time.time()
+            writer.close()
+        report(final=True)
+        return
+    with (open(args.output, 'w') if args.output
+          else contextlib.nullcontext(sys.stdout)) as out:
+        # One file at a time goes straight to the output as its chunks
+        # come in, and the others are held until it finishes, so that
+        # each file's records stay together. If that file fails part
+        # way through, the output is truncated back to where its
+        # records started, so failed files are left out as in the
+        # binary output. Stdout can't be truncated, so there every
+        # file is held until it finishes.
+        seekable = out.seekable()
+        current : Optional[int] = None
+        current_start = 0
+        held : Dict[int, List[str]] = {}
+        finished : Dict[int, Optional[str]] = {}
+        def write_finished(file_idx : int) -> None:
+            result_file = finished.pop(file_idx)
+            chunks = held.pop(file_idx, None)
+            if result_file is None:
+                eprint(f"\nFailed file {args.inputs[file_idx]}")
+            elif chunks is None:
+                # Nothing was streamed, because the existing scrape
+                # was reused
+                with open(result_file, 'r') as f:
+                    for line in f:
+                        out.write(line)
+            else:
+                out.write("".join(chunks))
+        def start_file(file_idx : int) -> None:
+            nonlocal current, current_start
+            current = file_idx
+            current_start = out.tell()
+            out.write("".join(held.pop(file_idx, [])))
+            out.flush()
+        while num_finished < len(args.inputs):
+            try:
+                message = scrape_queue.get(timeout=1)
+            except queue.Empty:
+                message = None
+            if isinstance(message, ScrapedChunk):
+                num_records += count_records(message.text)
+                held.setdefault(message.file_idx, []).append(message.text)
+                if seekable and current is None:
+                    start_file(message.file_idx)
+                elif message.file_idx == current:
+                    out.write("".join(held.pop(message.file_idx)))
+                    out.flush()
+            elif isinstance(message, ScrapeFinished):
+                num_finished += 1
+                if message.file_idx == current:
+                    current = None
+                    if message.result_file is None:
+                        eprint(f"\nFailed file {args.inputs[message.file_idx]}")
+                        out.seek(current_start)
+                        out.truncate()
+                else:
+                    finished[message.file_idx] = message.result_file
+                if current is None:
+                    for file_idx in list(finished):
+                        write_finished(file_idx)
+                    if seekable and held:
+                        start_file(next(iter(held)))
+            if time.time() - last_report >= 1:
+                report()
+                last_report = time.time()
+        report(final=True)
+
 def scrape_file(coqargs : List[str], args : argparse.Namespace, includes : str,
-                file_tuple : Tuple[int, str]) -> str:
+                deps_hashes : Dict[str, str],
+                file_tuple : Tuple[int, str]) -> Optional[str]:
+    result_file : Optional[str] = None
+    try:
+        result_file = run_scrape_file(coqargs, args, includes, deps_hashes, file_tuple)
+        return result_file
+    finally:
+        if scrape_queue:
+            scrape_queue.put(ScrapeFinished(file_tuple[0], result_file))
+
+from tqdm import tqdm
+def run_scrape_file(coqargs : List[str], args : argparse.Namespace, includes : str,
+                    deps_hashes : Dict[str, str],
+                    file_tuple : Tuple[int, str]) -> Optional[str]:
     file_idx, filename = file_tuple
     full_filename = args.prelude + "/" + filename
     result_file = full_filename + ".scrape"
@@ -92,6 +316,14 @@ def scrape_file(coqargs : List[str], args : argparse.Namespace, includes : str,
                 if args.verbose:
                     eprint(f"Found existing scrape at {result_file}! Using it")
                 return result_file
+    cache : Optional[ScrapeCache] = None
+    if args.incremental:
+        cache = ScrapeCache(scrape_cache_path(full_filename),
+                            hash_file(full_filename), deps_hashes[filename])
+        if cache.complete and os.path.exists(result_file):
+            eprint(f"{filename} and its dependencies haven't changed, "
+                   "using existing scrape", guard=args.verbose)
+            return result_file
     try:
         commands = serapi_instance.try_load_lin(args, file_idx, full_filename)
         if not commands:
@@ -99,18 +331,25 @@ def scrape_file(coqargs : List[str], args : argparse.Namespace, includes : str,
                 args, file_idx,
                 serapi_instance.load_commands(full_filename),
                 coqargs, includes, full_filename, filename, args.skip_nochange_tac)
-            serapi_instance.save_lin(commands, full_filename)
+            serapi_instance.save_lin(commands, full_filename, open_lin_cache(args))
 
-        with serapi_instance.SerapiContext(coqargs, includes, args.prelude) as coq:
+        with serapi_instance.PooledSerapiContext(coqargs, includes,
+                                                 args.prelude) as coq:
             coq.debug = args.debug
             try:
-                with open(result_file, 'w') as f:
-                    for command in tqdm(commands, file=sys.stdout,
-                                        disable=(not args.progress),
-                                        position=file_idx * 2,
-                                        desc="Scraping file", leave=False,
-                                        dynamic_ncols=True, bar_format=mybarfmt):
-                        process_statement(coq, command, f)
+                with open_scrape_output(result_file, file_idx) as f, \
+                     tqdm(total=len(commands), file=sys.stdout,
+                          disable=(not args.progress),
+                          position=file_idx * 2,
+                          desc="Scraping file", leave=False,
+                          dynamic_ncols=True, bar_format=mybarfmt) as pbar:
+                    if cache:
+                        scrape_incrementally(coq, commands, f, cache, pbar)
+                        cache.save()
+                    else:
+                        for command in commands:
+                            process_statement(coq, command, f)
+                            pbar.update(1)
             except serapi_instance.TimeoutError:
                 eprint("Command in {} timed out.".format(filename))
             return result_file
@@ -127,12 +366,56 @@ def process_statement(coq : serapi_instance.SerapiInstance, command : str,
             prev_tactics = coq.prev_tactics
             prev_hyps = coq.hypotheses
             prev_goal = coq.goals
-            result_file.write(format_context(prev_tactics, prev_hyps, prev_goal, ""))
-            result_file.write(format_tactic(command))
+            result_file.write(format_context(prev_tactics, prev_hyps, prev_goal, "") +
+                              format_tactic(command))
         else:
             subbed_command = re.sub(r"\n", r"\\n", command)
             result_file.write(subbed_command+"\n-----\n")
     coq.run_stmt(command)
 
+# Scrapes commands like process_statement, but proofs that are in the
+# cache are closed with "Admitted." instead of being run, and their
+# scraped tactics come from the cache.
+def scrape_incrementally(coq : serapi_instance.SerapiInstance, commands : List[str],
+                         result_file : TextIO, cache : ScrapeCache, pbar : tqdm) -> None:
+    vernacs_hash = hashlib.sha1()
+    idx = 0
+    while idx < len(commands):
+        command = commands[idx]
+        process_statement(coq, command, result_file)
+        idx += 1
+        vernacs_hash.update(command.encode('utf-8'))
+        # proof_context is empty once the goals are solved, before the
+        # proof is closed, so it can't tell us whether we're in one.
+        if not coq.in_proof:
+            pbar.update(1)
+            continue
+        proof_start = idx
+        proof_end = idx
+        while proof_end < len(commands) and not closing_proof(commands[proof_end]):
+            proof_end += 1
+        proof_commands = commands[proof_start:proof_end + 1]
+        key = proof_key(vernacs_hash.hexdigest(), command, proof_commands)
+        cached = cache.lookup(key)
+        if cached is not None:
+            result_file.write(cached)
+            coq.run_stmt("Admitted.")
+            idx = proof_end + 1
+        else:
+            proof_output = io.StringIO()
+            # This runs the command that closes the proof too
+            while coq.in_proof and idx < len(commands):
+                process_statement(coq, commands[idx], proof_output)
+                idx += 1
+            result_file.write(proof_output.getvalue())
+            if proof_commands and commands[proof_start:idx] == proof_commands and \
+               proof_body_opaque(proof_commands[-1]):
+                cache.record(key, proof_output.getvalue())
+            else:
+                # Later commands might be able to see this proof
+                for proof_command in commands[proof_start:idx]:
+                    vernacs_hash.update(proof_command.encode('utf-8'))
+        pbar.update(idx - proof_start + 1)
+
 if __name__ == "__main__":
     main()
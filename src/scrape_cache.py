@@ -0,0 +1,168 @@
+#!/usr/bin/env python3.7
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# The bookkeeping for incremental scraping. Every scraped file gets a
+# cache of the scrape output of each of its proofs, keyed by the lemma
+# statement, the proof body, and a hash of every vernac that ran
+# before the lemma. Proofs whose key hasn't changed don't have to be
+# run again. The whole cache is thrown out when any file the scraped
+# file Requires (directly or not) has changed.
+
+import contextlib
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+from typing import Dict, List, Optional, Set
+
+from serapi_instance import kill_comments
+from util import hash_file
+
+def scrape_cache_path(filename : str) -> str:
+    return filename + ".scrape.cache"
+
+def proof_key(vernacs_hash : str, lemma_statement : str,
+              proof_commands : List[str]) -> str:
+    hasher = hashlib.sha1()
+    hasher.update(vernacs_hash.encode('utf-8'))
+    hasher.update(b"\0")
+    hasher.update(lemma_statement.strip().encode('utf-8'))
+    for command in proof_commands:
+        hasher.update(b"\0")
+        hasher.update(command.strip().encode('utf-8'))
+    return hasher.hexdigest()
+
+# Proof ends that can be found without running anything. Other ways of
+# ending a proof (like "Proof term.") still work, but those proofs
+# aren't cached.
+def closing_proof(command : str) -> bool:
+    stripped_command = kill_comments(command).strip()
+    return re.fullmatch(r"(Qed|Defined|Admitted|Abort|Save\s+\S+)\s*\.",
+                        stripped_command) is not None
+
+# Only proofs whose bodies later commands can't see get skipped; for
+# those, closing the proof with "Admitted." leaves the same state
+# behind.
+def proof_body_opaque(ending_command : str) -> bool:
+    stripped_command = kill_comments(ending_command).strip()
+    return stripped_command in ["Qed.", "Admitted."]
+
+class ScrapeCache:
+    def __init__(self, path : str, file_hash : str, deps_hash : str) -> None:
+        self.path = path
+        self.file_hash = file_hash
+        self.deps_hash = deps_hash
+        self.old_proofs : Dict[str, str] = {}
+        self.new_proofs : Dict[str, str] = {}
+        self.complete = False
+        try:
+            with open(path, 'r') as f:
+                contents = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        if contents["deps_hash"] != deps_hash:
+            return
+        self.old_proofs = contents["proofs"]
+        self.complete = contents["file_hash"] == file_hash
+
+    def lookup(self, key : str) -> Optional[str]:
+        result = self.old_proofs.get(key)
+        if result is not None:
+            self.new_proofs[key] = result
+        return result
+    def record(self, key : str, scraped : str) -> None:
+        self.new_proofs[key] = scraped
+
+    # Only proofs that are still in the file are kept
+    def save(self) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                        suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({"file_hash" : self.file_hash,
+                           "deps_hash" : self.deps_hash,
+                           "proofs" : self.new_proofs}, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
+
+def required_modules(filename : str) -> List[str]:
+    with open(filename, 'r') as f:
+        contents = kill_comments(f.read())
+    modules : List[str] = []
+    for match in re.finditer(r"(?:From\s+(\S+)\s+)?Require\s+(?:Import\s+|Export\s+)?"
+                             r"(.*?)\.(?:\s|$)", contents, re.DOTALL):
+        prefix = match.group(1)
+        for module in match.group(2).split():
+            modules.append(f"{prefix}.{module}" if prefix else module)
+    return modules
+
+# Finds the source files under the prelude that Require statements
+# could refer to, by matching module paths against the ends of the
+# files' paths.
+class DependencyGraph:
+    def __init__(self, prelude : str) -> None:
+        self.prelude = prelude
+        self.__files_by_module : Dict[str, List[str]] = {}
+        for dirpath, dirnames, filenames in os.walk(prelude):
+            for filename in filenames:
+                if not filename.endswith(".v"):
+                    continue
+                relpath = os.path.relpath(os.path.join(dirpath, filename), prelude)
+                module_parts = relpath[:-len(".v")].split(os.sep)
+                for i in range(len(module_parts)):
+                    self.__files_by_module.setdefault(
+                        ".".join(module_parts[i:]), []).append(relpath)
+        self.__deps_hashes : Dict[str, str] = {}
+
+    def dependencies(self, filename : str) -> List[str]:
+        deps : Set[str] = set()
+        for module in required_modules(os.path.join(self.prelude, filename)):
+            # Logical paths can start with a prefix that isn't a
+            # directory (like -R . compcert), so use the longest
+            # suffix that names some file.
+            parts = module.split(".")
+            for i in range(len(parts)):
+                matches = self.__files_by_module.get(".".join(parts[i:]))
+                if matches:
+                    deps.update(dep for dep in matches if dep != filename)
+                    break
+        return sorted(deps)
+
+    # A hash of every file that filename depends on, transitively
+    def deps_hash(self, filename : str) -> str:
+        filename = os.path.normpath(filename)
+        if filename in self.__deps_hashes:
+            return self.__deps_hashes[filename]
+        # Guards against cycles, which Coq wouldn't allow anyway
+        self.__deps_hashes[filename] = ""
+        hasher = hashlib.sha1()
+        for dep in self.dependencies(filename):
+            hasher.update(dep.encode('utf-8'))
+            hasher.update(hash_file(os.path.join(self.prelude, dep)).encode('utf-8'))
+            hasher.update(self.deps_hash(dep).encode('utf-8'))
+        self.__deps_hashes[filename] = hasher.hexdigest()
+        return self.__deps_hashes[filename]
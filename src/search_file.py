@@ -30,13 +30,22 @@ import time
 import functools
 import shutil
 import csv
+import hashlib
+import math
+import heapq
+import contextlib
+import threading
+from multiprocessing.pool import ThreadPool
 from typing import List, Tuple, NamedTuple, Optional, Sequence, Dict, Union, Iterator
 
-from models.tactic_predictor import TacticPredictor, TacticContext
-from predict_tactic import (static_predictors, loadPredictorByFile,
+from models.tactic_predictor import TacticPredictor, TacticContext, Prediction
+from models.memoizing_predictor import MemoizingPredictor
+from predict_tactic import (static_predictors, loadSharedPredictorByFile,
                             loadPredictorByName)
 import serapi_instance
 from serapi_instance import FullContext, Subgoal
+from outcome_cache import (OutcomeCache, LemmaOutcomes, TacticOutcome,
+                           outcome_cache_path, context_key)
 
 import linearize_semicolons
 import syntax
@@ -78,6 +87,8 @@ class ProofBlock(NamedTuple):
     status : SearchStatus
     predicted_tactics : List[TacticInteraction]
     original_tactics : List[TacticInteraction]
+    transposition_hits : int = 0
+    transposition_misses : int = 0
 
 class ArgsMismatchException(Exception):
     pass
@@ -134,6 +145,16 @@ def parse_arguments(args_list : List[str]) -> Tuple[argparse.Namespace,
                         action='store_true')
     parser.add_argument("--hardfail", "-f", help="fail when hitting a coq anomaly",
                         action='store_true')
+    parser.add_argument("--linearize-workers", dest="linearize_workers", type=int,
+                        default=0,
+                        help="linearize the proofs of each file with this many "
+                        "coq instances at once")
+    parser.add_argument("--lin-cache", dest="lin_cache", default=None,
+                        help="a directory of linearized files to share between "
+                        "checkouts")
+    parser.add_argument("--lin-cache-size", dest="lin_cache_size", type=int, default=1024,
+                        help="the most space the linearized file cache can use, "
+                        "in megabytes")
     parser.add_argument('--context-filter', dest="context_filter", type=str,
                         default=None)
     parser.add_argument('--weightsfile', default=None)
@@ -150,6 +171,37 @@ def parse_arguments(args_list : List[str]) -> Tuple[argparse.Namespace,
     parser.add_argument('filename', help="proof file name (*.v)", type=Path2)
     parser.add_argument("--use-hammer", help="Use Hammer tactic after every predicted tactic",
                         action='store_const', const=True, default=False)
+    parser.add_argument("--backtrack", choices=["state", "cancel"], default="state",
+                        help="How to undo tactics during search: jump straight "
+                        "back to the saved coq state, or cancel them one by one")
+    parser.add_argument("--prediction-cache-size", dest="prediction_cache_size",
+                        type=int, default=0,
+                        help="Remember this many of the most recent predictions, "
+                        "to skip running the model on repeated contexts")
+    parser.add_argument("--search-type", dest="search_type", default="dfs",
+                        choices=list(search_engines.keys()))
+    parser.add_argument("--beam-width", dest="beam_width", type=int, default=None,
+                        help="Nodes kept at each depth of a beam search "
+                        "(defaults to the search width)")
+    parser.add_argument("--max-search-nodes", dest="max_search_nodes", type=int,
+                        default=None,
+                        help="Most predictions to try per lemma in best-first "
+                        "and beam search")
+    parser.add_argument("--max-search-time", dest="max_search_time", type=float,
+                        default=None,
+                        help="Most seconds to spend per lemma in best-first "
+                        "and beam search")
+    parser.add_argument("--no-transposition-table", dest="transposition_table",
+                        action='store_false',
+                        help="Don't skip proof states that were already "
+                        "searched through a different order of tactics")
+    parser.add_argument("--outcome-cache", dest="outcome_cache", action='store_true',
+                        help="Remember what each tactic did in each proof state "
+                        "in a database next to the source file, and reuse it "
+                        "on later runs")
+    parser.add_argument("--search-workers", dest="search_workers", type=int, default=0,
+                        help="Number of extra coq instances to try sibling "
+                        "predictions on in parallel (0 searches on the main instance)")
     known_args, unknown_args = parser.parse_known_args(args_list)
     return known_args, parser
 
@@ -157,13 +209,15 @@ def get_predictor(parser : argparse.ArgumentParser,
                   args : argparse.Namespace) -> TacticPredictor:
     predictor : TacticPredictor
     if args.weightsfile:
-        predictor = loadPredictorByFile(args.weightsfile)
+        predictor = loadSharedPredictorByFile(args.weightsfile)
     elif args.predictor:
         predictor = loadPredictorByName(args.predictor)
     else:
         print("You must specify either --weightsfile or --predictor!")
         parser.print_help()
         sys.exit(1)
+    if args.prediction_cache_size > 0:
+        predictor = MemoizingPredictor(predictor, args.prediction_cache_size)
     return predictor
 
 def search_file(args : argparse.Namespace, coqargs : List[str],
@@ -202,6 +256,12 @@ def search_file(args : argparse.Namespace, coqargs : List[str],
 
     commands_in = linearize_semicolons.get_linearized(args, coqargs, includes,
                                                       bar_idx, str(args.filename))
+    if args.outcome_cache:
+        outcome_cache : Optional[OutcomeCache] = \
+            OutcomeCache(outcome_cache_path(str(args.filename)))
+        file_hash = hash_file(str(args.filename))
+    else:
+        outcome_cache = None
     num_commands_total = len(commands_in)
     lemma_statement = ""
     module_stack : List[str] = []
@@ -213,12 +273,12 @@ def search_file(args : argparse.Namespace, coqargs : List[str],
         nonlocal blocks_out
         nonlocal module_stack
         vernacs : List[str] = []
-        assert not coq.full_context
-        while not coq.full_context and len(commands_in) > 0:
+        assert not coq.in_proof
+        while not coq.in_proof and len(commands_in) > 0:
             next_in_command = commands_in.pop(0)
             # Longer timeout for vernac stuff (especially requires)
             coq.run_stmt(next_in_command, timeout=60)
-            if not coq.full_context:
+            if not coq.in_proof:
                 vernacs.append(next_in_command)
             update_module_stack(next_in_command, module_stack)
             pbar.update(1)
@@ -238,7 +298,7 @@ def search_file(args : argparse.Namespace, coqargs : List[str],
         original_tactics : List[TacticInteraction] = []
         lemma_name = serapi_instance.lemma_name_from_statement(lemma_statement)
         try:
-            while coq.full_context != None:
+            while coq.in_proof:
                 next_in_command = commands_in.pop(0)
                 context_before = coq.fullContext
                 original_tactics.append(TacticInteraction(next_in_command, context_before))
@@ -259,7 +319,9 @@ def search_file(args : argparse.Namespace, coqargs : List[str],
     def add_proof_block(status : SearchStatus,
                         solution : Optional[List[TacticInteraction]],
                         initial_full_context : FullContext,
-                        original_tactics : List[TacticInteraction]) -> None:
+                        original_tactics : List[TacticInteraction],
+                        transposition_hits : int,
+                        transposition_misses : int) -> None:
         nonlocal num_proofs_failed
         nonlocal num_proofs_completed
         nonlocal blocks_out
@@ -273,7 +335,8 @@ def search_file(args : argparse.Namespace, coqargs : List[str],
                                    initial_full_context)] +
                 solution +
                 [TacticInteraction("Qed.", empty_context)],
-                original_tactics))
+                original_tactics,
+                transposition_hits, transposition_misses))
         else:
             blocks_out.append(ProofBlock(
                 lemma_statement, ".".join(module_stack), status,
@@ -281,7 +344,8 @@ def search_file(args : argparse.Namespace, coqargs : List[str],
                                    initial_full_context),
                  TacticInteraction("Admitted.",
                                    initial_full_context)],
-                original_tactics))
+                original_tactics,
+                transposition_hits, transposition_misses))
 
     if not args.progress:
         print("Loaded {} commands for file {}".format(len(commands_in), args.filename))
@@ -294,7 +358,8 @@ def search_file(args : argparse.Namespace, coqargs : List[str],
         while len(commands_in) > 0:
             try:
                 # print("Starting a coq instance...")
-                with serapi_instance.SerapiContext(coqargs, includes, args.prelude, use_hammer=args.use_hammer) as coq:
+                with serapi_instance.PooledSerapiContext(coqargs, includes, args.prelude, use_hammer=args.use_hammer) as coq, \
+                     SearchWorkerContext(args, coqargs, includes) as pool:
                     if args.progress:
                         pbar.reset()
                     for command in commands_run:
@@ -338,17 +403,21 @@ def search_file(args : argparse.Namespace, coqargs : List[str],
                         initial_context = coq.fullContext
                         # Try to search
                         if lemma_statement in lemmas_to_skip:
-                            search_status = SearchStatus.FAILURE
-                            tactic_solution : Optional[List[TacticInteraction]] = []
+                            search_result = SearchResult(SearchStatus.FAILURE, [])
                         else:
-                            search_status, tactic_solution = \
+                            search_result = \
                                 attempt_search(args, lemma_statement,
                                                ".".join(module_stack),
-                                               coq, bar_idx)
+                                               coq, bar_idx, pool, commands_run,
+                                               outcome_cache.forLemma(file_hash,
+                                                                      lemma_statement)
+                                               if outcome_cache else None)
+                        search_status = search_result.status
+                        tactic_solution = search_result.commands
                         # assert False
                         # Cancel until before the proof
                         try:
-                            while coq.full_context != None:
+                            while coq.in_proof:
                                 coq.cancel_last()
                         except serapi_instance.CoqExn as e:
                             raise serapi_instance.CoqAnomaly(f"While cancelling: {e}")
@@ -369,7 +438,9 @@ def search_file(args : argparse.Namespace, coqargs : List[str],
                         original_tactics = run_to_next_vernac(coq, pbar, initial_context,
                                                               lemma_statement)
                         add_proof_block(search_status, tactic_solution,
-                                        initial_context, original_tactics)
+                                        initial_context, original_tactics,
+                                        search_result.transposition_hits,
+                                        search_result.transposition_misses)
             except serapi_instance.CoqAnomaly as e:
                 if lemma_statement:
                     commands_in.insert(0, lemma_statement)
@@ -387,8 +458,12 @@ def search_file(args : argparse.Namespace, coqargs : List[str],
             except Exception as e:
                 eprint(f"FAILED: in file {args.filename}, {repr(e)}")
                 raise
+    if outcome_cache:
+        outcome_cache.close()
     write_html(args, args.output_dir, args.filename, blocks_out)
     write_csv(args, args.filename, blocks_out)
+    if isinstance(predictor, MemoizingPredictor):
+        eprint(predictor.statsString(), guard=args.verbose)
 
 def html_header(tag : Tag, doc : Doc, text : Text, css : List[str],
                 javascript : List[str], title : str) -> None:
@@ -413,7 +488,9 @@ def write_csv(args : argparse.Namespace, filename : str, doc_blocks : List[Docum
             if isinstance(block, ProofBlock):
                 rowwriter.writerow([block.lemma_statement.strip(),
                                     block.status,
-                                    len(block.original_tactics)])
+                                    len(block.original_tactics),
+                                    block.transposition_hits,
+                                    block.transposition_misses])
 
 def read_csv_options(f : Iterable[str]) -> Tuple[argparse.Namespace, Iterable[str]]:
     params : Dict[str, str] = {}
@@ -433,7 +510,9 @@ def read_csv_options(f : Iterable[str]) -> Tuple[argparse.Namespace, Iterable[st
         rest_iter = itertools.chain([final_line], f_iter)
     return argparse.Namespace(**params), rest_iter
 
-important_args = ["prelude", "context_filter", "weightsfile", "predictor", "search_width", "search_depth"]
+important_args = ["prelude", "context_filter", "weightsfile", "predictor", "search_width", "search_depth", "search_type"]
+# CSVs written before an arg existed ran with what is now its default
+important_arg_defaults = {"search_type": "dfs"}
 
 def check_csv_args(args : argparse.Namespace, vfilename : Path2) -> None:
     num_proofs = 0
@@ -444,7 +523,10 @@ def check_csv_args(args : argparse.Namespace, vfilename : Path2) -> None:
         saved_args, rest_iter = read_csv_options(csvfile)
         for arg in important_args:
             try:
-                oldval = str(vars(saved_args)[arg])
+                if arg in vars(saved_args):
+                    oldval = str(vars(saved_args)[arg])
+                else:
+                    oldval = important_arg_defaults[arg]
                 newval = str(vars(args)[arg])
                 if oldval != newval:
                     raise ArgsMismatchException(f"Old value of {arg} is {oldval}, "
@@ -599,11 +681,11 @@ def replay_solution_vfile(args : argparse.Namespace, coq : serapi_instance.Serap
                                   desc="Replaying", disable=(not args.progress),
                                   leave=False,position=(bar_idx*2),
                                   dynamic_ncols=True, bar_format=mybarfmt):
-            context_before = coq.fullContext if coq.full_context else FullContext([])
-            if not(coq.full_context != None and len(coq.fullContext.subgoals) == 0 and
+            context_before = coq.fullContext if coq.in_proof else FullContext([])
+            if not(coq.in_proof and len(coq.fullContext.subgoals) == 0 and
                    not serapi_instance.ending_proof(saved_command)):
                 coq.run_stmt(saved_command)
-            if coq.full_context == None:
+            if not coq.in_proof:
                 if in_proof:
                     in_proof = False
                     num_proofs += 1
@@ -617,7 +699,7 @@ def replay_solution_vfile(args : argparse.Namespace, coq : serapi_instance.Serap
                         search_status = SearchStatus.INCOMPLETE
                     coq.cancel_last()
                     try:
-                        while coq.full_context != None:
+                        while coq.in_proof:
                             coq.cancel_last()
                     except serapi_instance.CoqExn as e:
                         raise serapi_instance.CoqAnomaly(f"While cancelling: {e}")
@@ -675,15 +757,34 @@ def replay_solution_vfile(args : argparse.Namespace, coq : serapi_instance.Serap
 class SearchResult(NamedTuple):
     status : SearchStatus
     commands : Optional[List[TacticInteraction]]
+    transposition_hits : int = 0
+    transposition_misses : int = 0
 
 # This method attempts to complete proofs using search.
 def attempt_search(args : argparse.Namespace,
                    lemma_statement : str,
                    module_name : Optional[str],
                    coq : serapi_instance.SerapiInstance,
-                   bar_idx : int) \
+                   bar_idx : int,
+                   pool : Optional['SearchWorkerPool'] = None,
+                   commands_run : Sequence[str] = (),
+                   tactic_outcomes : Optional[LemmaOutcomes] = None) \
     -> SearchResult:
-    result = dfs_proof_search_with_graph(lemma_statement, module_name, coq, args, bar_idx)
+    search_engine = search_engines[args.search_type]
+    try:
+        if pool:
+            pool.startLemma(list(commands_run), lemma_statement, tactic_outcomes)
+            try:
+                result = search_engine(lemma_statement, module_name, coq,
+                                       args, bar_idx, pool, tactic_outcomes)
+            finally:
+                pool.finishLemma()
+        else:
+            result = search_engine(lemma_statement, module_name, coq, args, bar_idx,
+                                   tactic_outcomes=tactic_outcomes)
+    finally:
+        if tactic_outcomes:
+            tactic_outcomes.cache.flush()
     return result
 
 # This implementation is here for reference/documentation
@@ -789,16 +890,49 @@ def numNodesInTree(branching_factor : int, depth : int):
 def tryPrediction(args : argparse.Namespace,
                   coq : serapi_instance.SerapiInstance,
                   g : SearchGraph,
-                  predictionNode : LabeledNode) -> Tuple[FullContext, int, int, int]:
+                  predictionNode : LabeledNode,
+                  tactic_outcomes : Optional[LemmaOutcomes] = None) \
+                  -> Tuple[FullContext, int, int, int]:
+    context_after, num_stmts, subgoals_closed, subgoals_opened = \
+        runPrediction(args, coq, predictionNode.prediction, tactic_outcomes)
+    if subgoals_closed > 0:
+        g.setNodeColor(predictionNode, "blue")
+    return context_after, num_stmts, subgoals_closed, subgoals_opened
+
+# Runs a predicted tactic, and then closes or opens braces for any
+# subgoals it finished or created. Doesn't touch the search graph, so
+# it's safe to call from the search worker threads.
+#
+# With an outcome cache, a tactic that failed in the same state on an
+# earlier run fails again here without going to coq. Tactics that
+# worked still have to run, to get coq into the resulting state, but
+# the goals after them don't need to be printed again.
+def runPrediction(args : argparse.Namespace,
+                  coq : serapi_instance.SerapiInstance,
+                  prediction : str,
+                  tactic_outcomes : Optional[LemmaOutcomes] = None) \
+                  -> Tuple[FullContext, int, int, int]:
     coq.quiet = True
-    if coq.use_hammer:
-        coq.run_stmt(predictionNode.prediction, timeout=30)
-    else:
-        coq.run_stmt(predictionNode.prediction, timeout=5)
+    cached_outcome : Optional[TacticOutcome] = None
+    if tactic_outcomes:
+        context_hash = context_key(coq.fullContext)
+        cached_outcome = tactic_outcomes.lookup(context_hash, prediction)
+        if cached_outcome and cached_outcome.error:
+            raise cacheable_errors[cached_outcome.error](
+                f"{cached_outcome.error} (cached from an earlier run)")
+    try:
+        if coq.use_hammer:
+            coq.run_stmt(prediction, timeout=30)
+        else:
+            coq.run_stmt(prediction, timeout=5)
+    except tuple(cacheable_errors.values()) as e:
+        if tactic_outcomes:
+            tactic_outcomes.record(context_hash, prediction,
+                                   TacticOutcome(type(e).__name__, None))
+        raise
     num_stmts = 1
     subgoals_closed = 0
     while coq.count_fg_goals() == 0 and not completed_proof(coq):
-        g.setNodeColor(predictionNode, "blue")
         coq.run_stmt("}")
         subgoals_closed += 1
         num_stmts += 1
@@ -809,74 +943,347 @@ def tryPrediction(args : argparse.Namespace,
         num_stmts += 1
     else:
         subgoals_opened = 0
+    if tactic_outcomes and coq.in_proof:
+        if cached_outcome and cached_outcome.context_after:
+            coq.assume_full_context(cached_outcome.context_after)
+        elif not cached_outcome:
+            tactic_outcomes.record(context_hash, prediction,
+                                   TacticOutcome(None, coq.full_context))
     context_after = coq.fullContext
     return context_after, num_stmts, subgoals_closed, subgoals_opened
 
+# The errors from running a tactic that are worth remembering between
+# runs, by the names they're stored under.
+cacheable_errors = {
+    "CoqExn": serapi_instance.CoqExn,
+    "TimeoutError": serapi_instance.TimeoutError,
+    "ParseError": serapi_instance.ParseError,
+}
+
 def makePredictions(g : SearchGraph, coq : serapi_instance.SerapiInstance,
                     curNode : LabeledNode, k : int) -> List[LabeledNode]:
-    return g.addPredictions(curNode, coq.fullContext,
-                            [pred.prediction for pred in
-                             predictor.predictKTactics(
-                                 TacticContext(coq.prev_tactics, coq.hypotheses,
-                                               coq.goals),
-                                 k)])
+    return makeContextPredictions(g, curNode, coq.fullContext,
+                                  TacticContext(coq.prev_tactics, coq.hypotheses,
+                                                coq.goals),
+                                  k, use_hammer=False)
 
 def makeHammerPredictions(g : SearchGraph, coq : serapi_instance.SerapiInstance,
                     curNode : LabeledNode, k : int) -> List[LabeledNode]:
-    return g.addPredictions(curNode, coq.fullContext,
-                            [pred.prediction[:-1] + ";try hammer." for pred in
-                            # ["try hammer;" + pred.prediction for pred in
-                             predictor.predictKTactics(
-                                 TacticContext(coq.prev_tactics, coq.hypotheses,
-                                               coq.goals),
-                                 k)])
+    return makeContextPredictions(g, curNode, coq.fullContext,
+                                  TacticContext(coq.prev_tactics, coq.hypotheses,
+                                                coq.goals),
+                                  k, use_hammer=True)
+
+def makeContextPredictions(g : SearchGraph, curNode : LabeledNode,
+                           full_context : FullContext,
+                           tactic_context : TacticContext,
+                           k : int, use_hammer : bool) -> List[LabeledNode]:
+    return [node for node, certainty in
+            makeScoredPredictions(g, curNode, full_context, tactic_context,
+                                  k, use_hammer)]
+
+# Like makeContextPredictions, but keeps the certainty the predictor
+# gave each prediction, for the search engines that order by it.
+def makeScoredPredictions(g : SearchGraph, curNode : LabeledNode,
+                          full_context : FullContext,
+                          tactic_context : TacticContext,
+                          k : int, use_hammer : bool) \
+                          -> List[Tuple[LabeledNode, float]]:
+    predictions = predictor.predictKTactics(tactic_context, k)
+    if use_hammer:
+        predictions = [Prediction(pred.prediction[:-1] + ";try hammer.",
+                                  # "try hammer;" + pred.prediction
+                                  pred.certainty)
+                       for pred in predictions]
+    nodes = g.addPredictions(curNode, full_context,
+                             [pred.prediction for pred in predictions])
+    return [(node, pred.certainty) for node, pred in zip(nodes, predictions)]
+
+search_errors = (serapi_instance.CoqExn, serapi_instance.TimeoutError,
+                 serapi_instance.OverflowError, serapi_instance.ParseError,
+                 serapi_instance.UnrecognizedError)
+
+# What happened when a search worker ran a prediction. The tactic
+# context is what the predictor needs to extend the search from the
+# resulting state, and is None when the prediction finished the proof.
+class PredictionOutcome(NamedTuple):
+    context_after : FullContext
+    num_stmts : int
+    subgoals_closed : int
+    subgoals_opened : int
+    completed : bool
+    tactic_context : Optional[TacticContext]
+
+# A coq instance positioned inside the current lemma. It remembers
+# the path of predictions it's currently at, along with a saved state
+# after each one, so moving to a sibling or child path only reruns the
+# part of the path that differs. The worker pool keeps these caught up
+# with the file being searched; the search engines that jump around
+# the tree also use one over the main instance.
+class SearchWorker:
+    def __init__(self, args : argparse.Namespace,
+                 coq : serapi_instance.SerapiInstance) -> None:
+        self.args = args
+        self.coq = coq
+        self.coq.quiet = True
+        self.num_commands_run = 0
+        self.path : List[str] = []
+        self.saved_states : List[serapi_instance.SavedState] = []
+        self.tactic_outcomes : Optional[LemmaOutcomes] = None
+
+    def startLemma(self, commands_run : List[str], lemma_statement : str,
+                   tactic_outcomes : Optional[LemmaOutcomes] = None) -> None:
+        for command in commands_run[self.num_commands_run:]:
+            self.coq.run_stmt(command, timeout=60)
+        self.num_commands_run = len(commands_run)
+        self.coq.run_stmt(lemma_statement)
+        self.setRoot(tactic_outcomes)
+
+    # Make the current state the start of the search
+    def setRoot(self, tactic_outcomes : Optional[LemmaOutcomes] = None) -> None:
+        self.path = []
+        self.saved_states = [self.coq.save_state()]
+        self.tactic_outcomes = tactic_outcomes
+
+    def finishLemma(self) -> None:
+        self.coq.restore_state(self.saved_states[0])
+        while self.coq.in_proof:
+            self.coq.cancel_last()
+        self.path = []
+        self.saved_states = []
+
+    def sharedPrefix(self, path : List[str]) -> int:
+        length = 0
+        while length < len(path) and length < len(self.path) and \
+              path[length] == self.path[length]:
+            length += 1
+        return length
+
+    def gotoPath(self, path : List[str]) -> None:
+        common = self.sharedPrefix(path)
+        self.coq.restore_state(self.saved_states[common])
+        del self.path[common:]
+        del self.saved_states[common+1:]
+        for prediction in path[common:]:
+            runPrediction(self.args, self.coq, prediction, self.tactic_outcomes)
+            self.path.append(prediction)
+            self.saved_states.append(self.coq.save_state())
+
+    def tryPrediction(self, path : List[str], prediction : str) \
+        -> Union[PredictionOutcome, Exception]:
+        try:
+            self.gotoPath(path)
+        except search_errors as e:
+            # Rerunning the path can time out where it didn't before,
+            # so start over from the lemma statement next time.
+            self.coq.restore_state(self.saved_states[0])
+            self.path = []
+            del self.saved_states[1:]
+            return e
+        try:
+            context_after, num_stmts, subgoals_closed, subgoals_opened = \
+                runPrediction(self.args, self.coq, prediction, self.tactic_outcomes)
+        except search_errors as e:
+            self.coq.restore_state(self.saved_states[-1])
+            return e
+        completed = completed_proof(self.coq)
+        if completed:
+            tactic_context = None
+        else:
+            tactic_context = TacticContext(self.coq.prev_tactics,
+                                           self.coq.hypotheses,
+                                           self.coq.goals)
+        self.path.append(prediction)
+        self.saved_states.append(self.coq.save_state())
+        return PredictionOutcome(context_after, num_stmts,
+                                 subgoals_closed, subgoals_opened,
+                                 completed, tactic_context)
+
+    def kill(self) -> None:
+        self.coq.kill()
+
+# A pool of search workers, which runs sibling predictions
+# concurrently. Each prediction goes to the idle worker whose current
+# path shares the most with the path it extends.
+class SearchWorkerPool:
+    def __init__(self, args : argparse.Namespace, coqargs : List[str],
+                 includes : str, num_workers : int) -> None:
+        self.__threads = ThreadPool(num_workers)
+        self.workers = self.__threads.map(
+            lambda _: SearchWorker(args, serapi_instance.SerapiInstance(
+                coqargs, includes, args.prelude, use_hammer=args.use_hammer)),
+            range(num_workers))
+        self.__idle = list(self.workers)
+        self.__idle_cond = threading.Condition()
+
+    def startLemma(self, commands_run : List[str], lemma_statement : str,
+                   tactic_outcomes : Optional[LemmaOutcomes] = None) -> None:
+        self.__threads.map(lambda worker: worker.startLemma(commands_run,
+                                                            lemma_statement,
+                                                            tactic_outcomes),
+                           self.workers)
+
+    def finishLemma(self) -> None:
+        self.__threads.map(lambda worker: worker.finishLemma(), self.workers)
+
+    def tryPredictions(self, path : List[str], predictions : List[str]) \
+        -> List[Union[PredictionOutcome, Exception]]:
+        def run(prediction : str) -> Union[PredictionOutcome, Exception]:
+            worker = self.__acquire(path)
+            try:
+                return worker.tryPrediction(path, prediction)
+            finally:
+                self.__release(worker)
+        return self.__threads.map(run, predictions)
+
+    def __acquire(self, path : List[str]) -> SearchWorker:
+        with self.__idle_cond:
+            while not self.__idle:
+                self.__idle_cond.wait()
+            worker = max(self.__idle, key=lambda w: w.sharedPrefix(path))
+            self.__idle.remove(worker)
+            return worker
+
+    def __release(self, worker : SearchWorker) -> None:
+        with self.__idle_cond:
+            self.__idle.append(worker)
+            self.__idle_cond.notify()
+
+    def kill(self) -> None:
+        for worker in self.workers:
+            worker.kill()
+        self.__threads.terminate()
+
+@contextlib.contextmanager
+def SearchWorkerContext(args : argparse.Namespace, coqargs : List[str],
+                        includes : str) -> Iterator[Optional[SearchWorkerPool]]:
+    if args.search_workers > 0:
+        pool = SearchWorkerPool(args, coqargs, includes, args.search_workers)
+        try:
+            yield pool
+        finally:
+            pool.kill()
+    else:
+        yield None
+
+# A canonical hash of a proof state, which doesn't depend on the names
+# of hypotheses or the order they're in. This is right for spotting
+# the same state reached twice, but not for anything keyed on tactic
+# text, which names hypotheses; the outcome cache uses
+# outcome_cache.context_key for that.
+def contextHash(full_context : FullContext) -> str:
+    h = hashlib.sha1()
+    for subgoal in full_context.subgoals:
+        for hyp_type in sorted(serapi_instance.get_hyp_type(hyp)
+                               for hyp in subgoal.hypotheses):
+            h.update(hyp_type.encode())
+            h.update(b"\0")
+        h.update(b"\1")
+        h.update(subgoal.goal.encode())
+        h.update(b"\2")
+    return h.hexdigest()
+
+# The proof states already expanded in the search of a lemma, and how
+# much depth was left when they were. Reaching one of them again, by a
+# different order of tactics, with no more depth left than last time,
+# can't find anything new.
+class TranspositionTable:
+    def __init__(self, enabled : bool) -> None:
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.__remaining_depths : Dict[str, int] = {}
+
+    # Returns whether the state has been searched at least this deep
+    # before, and otherwise records that it's being searched now.
+    def checkAndAdd(self, full_context : FullContext,
+                    remaining_depth : int) -> bool:
+        if not self.enabled:
+            return False
+        key = contextHash(full_context)
+        searched_depth = self.__remaining_depths.get(key)
+        if searched_depth is not None and searched_depth >= remaining_depth:
+            self.hits += 1
+            return True
+        self.misses += 1
+        self.__remaining_depths[key] = remaining_depth
+        return False
 
 def dfs_proof_search_with_graph(lemma_statement : str,
                                 module_name : Optional[str],
                                 coq : serapi_instance.SerapiInstance,
                                 args : argparse.Namespace,
-                                bar_idx : int) \
+                                bar_idx : int,
+                                pool : Optional[SearchWorkerPool] = None,
+                                tactic_outcomes : Optional[LemmaOutcomes] = None) \
                                 -> SearchResult:
-    global obligation_number
     lemma_name = serapi_instance.lemma_name_from_statement(lemma_statement)
     g = SearchGraph(lemma_name)
-    def cleanupSearch(num_stmts : int, msg : Optional[str] = None):
+    transpositions = TranspositionTable(args.transposition_table)
+    def cleanupSearch(num_stmts : int,
+                      saved_state : Optional[serapi_instance.SavedState],
+                      msg : Optional[str] = None):
         if msg:
             eprint(f"Cancelling {num_stmts} statements "
                    f"because {msg}.", guard=args.debug)
-        for _ in range(num_stmts):
-            coq.cancel_last()
+        if pool:
+            # The workers ran it, so there's nothing to undo here.
+            pass
+        elif saved_state:
+            coq.restore_state(saved_state)
+        else:
+            for _ in range(num_stmts):
+                coq.cancel_last()
     hasUnexploredNode = False
     def search(pbar : tqdm, current_path : List[LabeledNode],
                subgoal_distance_stack : List[int],
-               extra_depth : int) -> SubSearchResult:
+               extra_depth : int,
+               node_context : Optional[Tuple[FullContext, TacticContext]] = None) \
+               -> SubSearchResult:
         nonlocal hasUnexploredNode
         # print(coq.use_hammer)
-        if coq.use_hammer:
+        if node_context:
+            # Searching with workers, the main instance stays at the
+            # start of the proof, so the context comes from the worker
+            # that ran the last prediction.
+            full_context, tactic_context = node_context
+            predictionNodes = makeContextPredictions(g, current_path[-1],
+                                                     full_context, tactic_context,
+                                                     args.search_width,
+                                                     coq.use_hammer)
+        elif coq.use_hammer:
             predictionNodes = makeHammerPredictions(g, coq, current_path[-1], args.search_width)
         else:
             predictionNodes = makePredictions(g, coq, current_path[-1], args.search_width)
-        for predictionNode in predictionNodes:
+        if pool:
+            outcomes = pool.tryPredictions([n.prediction for n in current_path[1:]],
+                                           [n.prediction for n in predictionNodes])
+            saved_state = None
+        else:
+            # The state of the last node in the path, which each
+            # prediction starts from. Saved after making predictions, so
+            # that it has the goals cached.
+            saved_state = coq.save_state() if args.backtrack == "state" else None
+        for idx, predictionNode in enumerate(predictionNodes):
             try:
-                context_after, num_stmts, subgoals_closed, subgoals_opened = \
-                    tryPrediction(args, coq, g, predictionNode)
-                pbar.update(1)
-
-                #### 1.
-                if subgoal_distance_stack:
-                    new_distance_stack = (subgoal_distance_stack[:-1] +
-                                          [subgoal_distance_stack[-1]+1])
+                if pool:
+                    outcome = outcomes[idx]
+                    if isinstance(outcome, Exception):
+                        raise outcome
+                    context_after, num_stmts, subgoals_closed, subgoals_opened, \
+                        completed, next_tactic_context = outcome
+                    if subgoals_closed > 0:
+                        g.setNodeColor(predictionNode, "blue")
                 else:
-                    new_distance_stack = []
-
-                #### 2.
-                new_extra_depth = extra_depth
-                for _ in range(subgoals_closed):
-                    closed_goal_distance = new_distance_stack.pop()
-                    new_extra_depth += closed_goal_distance
+                    context_after, num_stmts, subgoals_closed, subgoals_opened = \
+                        tryPrediction(args, coq, g, predictionNode, tactic_outcomes)
+                    completed = completed_proof(coq)
+                pbar.update(1)
 
-                #### 3.
-                new_distance_stack += [0] * subgoals_opened
+                #### 1., 2., 3.
+                new_distance_stack, new_extra_depth = \
+                    updateSubgoalDistances(subgoal_distance_stack, extra_depth,
+                                           subgoals_closed, subgoals_opened)
                 # if subgoals_opened > 0:
                 #     eprint(f"Opened {subgoals_opened} subgoals with "
                 #            f"{predictionNode.prediction}")
@@ -884,7 +1291,7 @@ def dfs_proof_search_with_graph(lemma_statement : str,
                 #### 4.
 
                 #############
-                if completed_proof(coq):
+                if completed:
                     solution = g.mkQED(predictionNode)
                     return SubSearchResult(solution, subgoals_closed)
                 elif contextInPath(context_after, current_path[1:] + [predictionNode]):
@@ -893,11 +1300,29 @@ def dfs_proof_search_with_graph(lemma_statement : str,
                                                    (args.search_depth + 1) -
                                                    len(current_path)) - 1
                     pbar.update(nodes_skipped)
-                    cleanupSearch(num_stmts, "resulting context is in current path")
+                    cleanupSearch(num_stmts, saved_state,
+                                  "resulting context is in current path")
+                elif len(current_path) < args.search_depth + new_extra_depth and \
+                     transpositions.checkAndAdd(context_after,
+                                                args.search_depth + new_extra_depth -
+                                                len(current_path)):
+                    g.setNodeColor(predictionNode, "purple")
+                    nodes_skipped = numNodesInTree(args.search_width,
+                                                   (args.search_depth + 1) -
+                                                   len(current_path)) - 1
+                    pbar.update(nodes_skipped)
+                    cleanupSearch(num_stmts, saved_state,
+                                  "resulting context was already searched")
                 elif len(current_path) < args.search_depth + new_extra_depth:
-                    sub_search_result = search(pbar, current_path + [predictionNode],
-                                               new_distance_stack, new_extra_depth)
-                    cleanupSearch(num_stmts, "we finished subsearch")
+                    if pool:
+                        assert next_tactic_context
+                        sub_search_result = search(pbar, current_path + [predictionNode],
+                                                   new_distance_stack, new_extra_depth,
+                                                   (context_after, next_tactic_context))
+                    else:
+                        sub_search_result = search(pbar, current_path + [predictionNode],
+                                                   new_distance_stack, new_extra_depth)
+                    cleanupSearch(num_stmts, saved_state, "we finished subsearch")
                     if sub_search_result.solution or \
                        sub_search_result.solved_subgoals > subgoals_opened:
                         new_subgoals_closed = \
@@ -910,16 +1335,18 @@ def dfs_proof_search_with_graph(lemma_statement : str,
                         return SubSearchResult(None, subgoals_closed)
                 else:
                     hasUnexploredNode = True
-                    cleanupSearch(num_stmts, "we hit the depth limit")
+                    cleanupSearch(num_stmts, saved_state, "we hit the depth limit")
                     if subgoals_closed > 0:
                         return SubSearchResult(None, subgoals_closed)
-            except (serapi_instance.CoqExn, serapi_instance.TimeoutError,
-                    serapi_instance.OverflowError, serapi_instance.ParseError,
-                    serapi_instance.UnrecognizedError):
+            except search_errors:
                 g.setNodeColor(predictionNode, "red")
                 nodes_skipped = numNodesInTree(args.search_width,
                                                (args.search_depth + 1)- len(current_path)) - 1
                 pbar.update(nodes_skipped)
+                # The failing statement was already cancelled, but
+                # any braces tryPrediction ran before it weren't.
+                if saved_state:
+                    coq.restore_state(saved_state)
                 continue
             except serapi_instance.NoSuchGoalError:
                 raise
@@ -933,22 +1360,240 @@ def dfs_proof_search_with_graph(lemma_statement : str,
               dynamic_ncols=True, bar_format=mybarfmt) as pbar:
         command_list, _ = search(pbar, [g.start_node], [], 0)
         pbar.clear()
+    drawSearchGraph(args, g, module_name, lemma_name)
+    if command_list:
+        status = SearchStatus.SUCCESS
+    elif hasUnexploredNode:
+        status = SearchStatus.INCOMPLETE
+    else:
+        status = SearchStatus.FAILURE
+    return SearchResult(status, command_list,
+                        transpositions.hits, transpositions.misses)
+
+def drawSearchGraph(args : argparse.Namespace, g : SearchGraph,
+                    module_name : Optional[str], lemma_name : str) -> None:
+    global obligation_number
     module_prefix = f"{module_name}Zd" if module_name else ""
     if lemma_name == "Obligation":
         obligation_number += 1
         g.draw(f"{args.output_dir}/{module_prefix}{lemma_name}{obligation_number}.svg")
     else:
         g.draw(f"{args.output_dir}/{module_prefix}{lemma_name}.svg")
-    if command_list:
-        return SearchResult(SearchStatus.SUCCESS, command_list)
+
+# A node on the frontier of the best-first and beam searches. The path
+# doesn't include the start node, and the score is the sum of the log
+# certainties of the predictions along it.
+class ScoredNode(NamedTuple):
+    node : LabeledNode
+    path : List[LabeledNode]
+    score : float
+    full_context : FullContext
+    tactic_context : TacticContext
+    subgoal_distance_stack : List[int]
+    extra_depth : int
+
+def best_first_proof_search_with_graph(lemma_statement : str,
+                                       module_name : Optional[str],
+                                       coq : serapi_instance.SerapiInstance,
+                                       args : argparse.Namespace,
+                                       bar_idx : int,
+                                       pool : Optional[SearchWorkerPool] = None,
+                                       tactic_outcomes : Optional[LemmaOutcomes] = None) \
+                                       -> SearchResult:
+    return scored_proof_search_with_graph(lemma_statement, module_name, coq,
+                                          args, bar_idx, pool, tactic_outcomes,
+                                          beam_width=None)
+
+def beam_proof_search_with_graph(lemma_statement : str,
+                                 module_name : Optional[str],
+                                 coq : serapi_instance.SerapiInstance,
+                                 args : argparse.Namespace,
+                                 bar_idx : int,
+                                 pool : Optional[SearchWorkerPool] = None,
+                                 tactic_outcomes : Optional[LemmaOutcomes] = None) \
+                                 -> SearchResult:
+    return scored_proof_search_with_graph(lemma_statement, module_name, coq,
+                                          args, bar_idx, pool, tactic_outcomes,
+                                          beam_width=(args.beam_width or
+                                                      args.search_width))
+
+# Searches the tree in order of cumulative log certainty, stopping
+# when it runs out of nodes or time. Without a beam width, this always
+# expands the best node seen so far; with one, it goes level by level,
+# keeping only the best beam_width nodes at each depth.
+#
+# Unlike the DFS, this jumps between branches, so it always goes
+# through saved states instead of cancelling.
+def scored_proof_search_with_graph(lemma_statement : str,
+                                   module_name : Optional[str],
+                                   coq : serapi_instance.SerapiInstance,
+                                   args : argparse.Namespace,
+                                   bar_idx : int,
+                                   pool : Optional[SearchWorkerPool],
+                                   tactic_outcomes : Optional[LemmaOutcomes],
+                                   beam_width : Optional[int]) -> SearchResult:
+    lemma_name = serapi_instance.lemma_name_from_statement(lemma_statement)
+    g = SearchGraph(lemma_name)
+    transpositions = TranspositionTable(args.transposition_table)
+    if pool:
+        cursor = None
+    else:
+        cursor = SearchWorker(args, coq)
+        cursor.setRoot(tactic_outcomes)
+    start_time = time.time()
+    nodes_run = 0
+    hasUnexploredNode = False
+    def outOfBudget() -> bool:
+        return bool((args.max_search_nodes and
+                     nodes_run >= args.max_search_nodes) or
+                    (args.max_search_time and
+                     time.time() - start_time > args.max_search_time))
+    def runPredictions(path : List[LabeledNode], nodes : List[LabeledNode]) \
+        -> List[Union[PredictionOutcome, Exception]]:
+        path_predictions = [n.prediction for n in path]
+        if pool:
+            return pool.tryPredictions(path_predictions,
+                                       [n.prediction for n in nodes])
+        else:
+            assert cursor
+            return [cursor.tryPrediction(path_predictions, n.prediction)
+                    for n in nodes]
+    # Predict and run the children of a node. Returns a solution if one
+    # of them finishes the proof, and otherwise the children that are
+    # worth expanding.
+    def expand(pbar : tqdm, parent : ScoredNode) \
+        -> Tuple[Optional[List[TacticInteraction]], List[ScoredNode]]:
+        nonlocal nodes_run
+        nonlocal hasUnexploredNode
+        scored_predictions = makeScoredPredictions(g, parent.node,
+                                                   parent.full_context,
+                                                   parent.tactic_context,
+                                                   args.search_width,
+                                                   coq.use_hammer)
+        outcomes = runPredictions(parent.path,
+                                  [node for node, _ in scored_predictions])
+        children : List[ScoredNode] = []
+        for (predictionNode, certainty), outcome in zip(scored_predictions, outcomes):
+            nodes_run += 1
+            pbar.update(1)
+            if isinstance(outcome, Exception):
+                g.setNodeColor(predictionNode, "red")
+                continue
+            if outcome.subgoals_closed > 0:
+                g.setNodeColor(predictionNode, "blue")
+            if outcome.completed:
+                return g.mkQED(predictionNode), []
+            path = parent.path + [predictionNode]
+            distance_stack, extra_depth = \
+                updateSubgoalDistances(parent.subgoal_distance_stack,
+                                       parent.extra_depth,
+                                       outcome.subgoals_closed,
+                                       outcome.subgoals_opened)
+            if contextInPath(outcome.context_after, path):
+                g.setNodeColor(predictionNode, "orange")
+            elif len(path) >= args.search_depth + extra_depth:
+                hasUnexploredNode = True
+            elif transpositions.checkAndAdd(outcome.context_after,
+                                            args.search_depth + extra_depth -
+                                            len(path)):
+                g.setNodeColor(predictionNode, "purple")
+            else:
+                assert outcome.tactic_context
+                children.append(ScoredNode(predictionNode, path,
+                                           parent.score +
+                                           math.log(max(certainty, 1e-20)),
+                                           outcome.context_after,
+                                           outcome.tactic_context,
+                                           distance_stack, extra_depth))
+        return None, children
+
+    root = ScoredNode(g.start_node, [], 0., coq.fullContext,
+                      TacticContext(coq.prev_tactics, coq.hypotheses, coq.goals),
+                      [], 0)
+    solution : Optional[List[TacticInteraction]] = None
+    total_nodes = args.max_search_nodes or \
+        numNodesInTree(args.search_width, args.search_depth + 2) - 1
+    with tqdm(total=total_nodes, unit="pred", file=sys.stdout,
+              desc="Proof", disable=(not args.progress),
+              leave=False,
+              position=((bar_idx*2)+1),
+              dynamic_ncols=True, bar_format=mybarfmt) as pbar:
+        if beam_width:
+            beam = [root]
+            out_of_budget = False
+            while beam and not solution and not out_of_budget:
+                candidates : List[ScoredNode] = []
+                # The budget is checked before every expansion, like in
+                # best-first search, so one wide level can't run over it.
+                for node in beam:
+                    if outOfBudget():
+                        hasUnexploredNode = True
+                        out_of_budget = True
+                        break
+                    solution, children = expand(pbar, node)
+                    if solution:
+                        break
+                    candidates += children
+                if len(candidates) > beam_width:
+                    hasUnexploredNode = True
+                beam = sorted(candidates, key=lambda node: -node.score)[:beam_width]
+        else:
+            # Ties go to the node found first
+            frontier = [(-root.score, 0, root)]
+            nodes_pushed = 1
+            while frontier:
+                if outOfBudget():
+                    hasUnexploredNode = True
+                    break
+                _, _, node = heapq.heappop(frontier)
+                solution, children = expand(pbar, node)
+                if solution:
+                    break
+                for child in children:
+                    heapq.heappush(frontier, (-child.score, nodes_pushed, child))
+                    nodes_pushed += 1
+        pbar.clear()
+    if cursor:
+        cursor.gotoPath([])
+    drawSearchGraph(args, g, module_name, lemma_name)
+    if solution:
+        status = SearchStatus.SUCCESS
     elif hasUnexploredNode:
-        return SearchResult(SearchStatus.INCOMPLETE, None)
+        status = SearchStatus.INCOMPLETE
     else:
-        return SearchResult(SearchStatus.FAILURE, None)
+        status = SearchStatus.FAILURE
+    return SearchResult(status, solution,
+                        transpositions.hits, transpositions.misses)
+
+# The subgoal depth bookkeeping for the searches: each tactic moves us one further from the subgoals we're in, closing a subgoal
+# gives back the depth spent on it, and opening subgoals starts new
+# distances.
+def updateSubgoalDistances(subgoal_distance_stack : List[int],
+                           extra_depth : int,
+                           subgoals_closed : int,
+                           subgoals_opened : int) -> Tuple[List[int], int]:
+    if subgoal_distance_stack:
+        new_distance_stack = (subgoal_distance_stack[:-1] +
+                              [subgoal_distance_stack[-1]+1])
+    else:
+        new_distance_stack = []
+    new_extra_depth = extra_depth
+    for _ in range(subgoals_closed):
+        closed_goal_distance = new_distance_stack.pop()
+        new_extra_depth += closed_goal_distance
+    new_distance_stack += [0] * subgoals_opened
+    return new_distance_stack, new_extra_depth
+
+search_engines = {
+    "dfs": dfs_proof_search_with_graph,
+    "best-first": best_first_proof_search_with_graph,
+    "beam": beam_proof_search_with_graph,
+}
 
 
 def completed_proof(coq : serapi_instance.SerapiInstance) -> bool:
-    completed = len(coq.fullContext.subgoals) == 0
+    completed = coq.count_fg_goals() == 0 and \
+        len(coq.tactic_history.getAllBackgroundSubgoals()) == 0
     return completed
 
 def update_module_stack(cmd : str, module_stack : List[str]) -> None:
@@ -33,7 +33,7 @@ import shutil
 from pathlib_revised import Path2
 
 from models.tactic_predictor import TacticPredictor, TacticContext
-from predict_tactic import (static_predictors, loadPredictorByFile,
+from predict_tactic import (static_predictors, loadSharedPredictorByFile,
                             loadPredictorByName)
 import serapi_instance
 from serapi_instance import FullContext, Subgoal
@@ -251,7 +251,7 @@ def write_summary(args : argparse.Namespace, options : Sequence[Tuple[str, str]]
         (base / filename).copyfile(args.output / filename)
 def write_proof_summary_csv(output_dir : str, filenames : List[str]):
     with open('{}/proofs.csv'.format(output_dir), 'w') as fout:
-        fout.write("lemma,status,prooflength\n")
+        fout.write("lemma,status,prooflength,tablehits,tablemisses\n")
         for filename in filenames:
             with open("{}/{}.csv".format(output_dir, escape_filename(filename)), 'r') \
                  as fin:
@@ -304,7 +304,7 @@ def get_predictor(parser : argparse.ArgumentParser,
                   args : argparse.Namespace) -> TacticPredictor:
     predictor : TacticPredictor
     if args.weightsfile:
-        predictor = loadPredictorByFile(args.weightsfile)
+        predictor = loadSharedPredictorByFile(args.weightsfile)
         if args.predictor:
             eprint("Ignoring --predictor because --weightsfile takes precedence")
     elif args.predictor:
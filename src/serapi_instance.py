@@ -20,6 +20,7 @@
 #
 ##########################################################################
 
+import atexit
 import subprocess
 import threading
 import re
@@ -29,9 +30,10 @@ from pathlib_revised import Path2
 import argparse
 import sys
 import signal
+import copy
 from dataclasses import dataclass
 
-from typing import List, Any, Optional, cast, Tuple, Union
+from typing import List, Any, Optional, cast, Tuple, Union, Dict, Pattern
 # These dependencies is in pip, the python package manager
 from pampy import match, _, TAIL
 
@@ -40,6 +42,8 @@ from traceback import *
 from util import *
 from format import ScrapedTactic
 import tokenizer
+import sexp_reader
+from lin_cache import LinCache, open_lin_cache
 
 # Some Exceptions to throw when various responses come back from coq
 @dataclass
@@ -93,6 +97,13 @@ class Subgoal(NamedTuple):
 class FullContext(NamedTuple):
     subgoals : List[Subgoal]
 
+class SavedState(NamedTuple):
+    state_id : int
+    tactic_history : 'TacticHistory'
+    in_proof : bool
+    goals_str : Optional[str]
+    full_context : Optional[FullContext]
+
 @dataclass
 class TacticTree:
     children : List[Union['TacticTree', str]]
@@ -219,7 +230,8 @@ class SerapiInstance(threading.Thread):
     # ".debug" field after you've created it to get more verbose
     # logging.
     def __init__(self, coq_command : List[str], includes : str, prelude : str,
-                 timeout : int = 30, use_hammer : bool = False) -> None:
+                 timeout : int = 30, use_hammer : bool = False,
+                 pipelined : bool = True) -> None:
         # Set up some threading stuff. I'm not totally sure what
         # daemon=True does, but I think I wanted it at one time or
         # other.
@@ -239,11 +251,37 @@ class SerapiInstance(threading.Thread):
         # coq state. This way we don't have to do expensive queries to
         # the other process to answer simple questions.
         self._current_fg_goal_count = None # type: Optional[int]
-        self.proof_context = None # type: Optional[str]
-        self.full_context = None # type: Optional[FullContext]
+        # The proof context is fetched lazily: after each command we
+        # only find out whether we're in a proof, and the goals are
+        # queried the first time someone asks for them in that
+        # state. _goals_str is the pretty-printed goals, and
+        # _full_context the goals with their hypotheses printed
+        # term-by-term.
+        self._in_proof = False
+        self._goals_str = None # type: Optional[str]
+        self._full_context = None # type: Optional[FullContext]
+        # Printed terms, keyed by their sexps. Hypotheses usually
+        # survive many tactics unchanged, so this saves printing them
+        # again in each state. Cleared whenever we leave a proof.
+        self._term_str_cache = {} # type: Dict[str, str]
         self.cur_state = 0
         self.tactic_history = TacticHistory()
 
+        # When pipelined is set, we send commands that depend on each
+        # other in a single write, guessing the state id that the
+        # first one will produce, instead of waiting for each
+        # answer before sending the next command. Pipelined commands
+        # are tagged with negative numbers so they never collide with
+        # the tags sertop picks for untagged commands.
+        self.pipelined = pipelined
+        self._next_tag = -1
+        self._pending_tags = [] # type: List[int]
+        self._max_state_seen = 0
+        # The states added to the document so far, in order, minus the
+        # ones that were cancelled. Used to jump back to an earlier
+        # state with a single Cancel.
+        self._doc_states = [] # type: List[int]
+
         # Set up the message queue, which we'll populate with the
         # messages from serapi.
         self.message_queue = queue.Queue() # type: queue.Queue[Sexp]
@@ -266,6 +304,11 @@ class SerapiInstance(threading.Thread):
         if self.use_hammer:
             self.init_hammer()
 
+        # Where reset goes back to
+        self._init_state = self.save_state()
+        self._init_doc_states = list(self._doc_states)
+        self._init_timeout = timeout
+
     # Hammer prints a lot of stuff when it gets imported. Discard all of it.
     def init_hammer(self):
         self.hammer_timeout = 100
@@ -297,7 +340,45 @@ class SerapiInstance(threading.Thread):
         self.send_flush(cmd)
         self.get_ack()
 
+    # Send several commands to serapi in a single write, tagging each
+    # one so that we can tell which answers belong to which
+    # command. Sertop runs commands in the order it reads them, so the
+    # answers come back in the same order we would get by sending them
+    # one at a time, and the usual get_* methods can read them off in
+    # sequence. Returns the tags, in order.
+    def send_tagged(self, cmds : List[str]) -> List[int]:
+        tags = []
+        payload = ""
+        for cmd in cmds:
+            tag = self._next_tag
+            self._next_tag -= 1
+            tags.append(tag)
+            payload += "({} {})\n".format(tag, cmd.strip())
+        self._pending_tags += tags
+        self.send_flush(payload)
+        return tags
+
+    # Throw away every message belonging to the given tagged commands,
+    # up to and including their Completed answers.
+    def discard_tagged(self, tags : List[int]) -> None:
+        while any(tag in self._pending_tags for tag in tags):
+            self.get_message()
+
+    # Throw away the answers to any tagged commands we haven't read
+    # yet. This happens when a pipelined command fails, and the
+    # commands we sent after it are now meaningless.
+    def flush_pending(self) -> None:
+        while self._pending_tags:
+            self.get_message()
+
+    def _note_answer(self, msg : 'Sexp') -> None:
+        if self._pending_tags and isinstance(msg, list) and len(msg) == 3 and \
+           msg[0] == Symbol("Answer") and msg[2] == Symbol("Completed") and \
+           msg[1] in self._pending_tags:
+            self._pending_tags.remove(msg[1])
+
     def ask(self, cmd : str):
+        self.flush_pending()
         assert self.message_queue.empty(), self.messages
         self.send_acked(cmd)
         msg = self.get_message(complete=True)
@@ -315,6 +396,7 @@ class SerapiInstance(threading.Thread):
         if timeout:
             old_timeout = self.timeout
             self.timeout = timeout
+        self.flush_pending()
         assert self.message_queue.empty(), self.messages
         if re.match(r"\s*[{]\s*", stmt):
             self.run_stmt("Unshelve.")
@@ -331,37 +413,22 @@ class SerapiInstance(threading.Thread):
             # Preprocess_command sometimes turns one command into two,
             # to get around some limitations of the serapi interface.
             for stm in preprocess_command(kill_comments(stmt)):
-                # Get initial context
-                context_before = self.full_context
-                # Send the command
-                assert self.message_queue.empty()
-                self.send_acked("(Add () \"{}\")\n".format(stm))
-                # Get the response, which indicates what state we put
-                # serapi in.
-                self.update_state()
-                self.get_completed()
+                # Opening a subgoal puts the other goals in the
+                # background, so get them before we lose them.
+                if re.match(r"\s*[{]\s*", stm):
+                    context_before = self.full_context
+                else:
+                    context_before = None
+                # Send the command, execute it, and get the new proof
+                # context.
                 assert self.message_queue.empty()
+                if self.pipelined:
+                    self.add_and_exec_pipelined(stm)
+                else:
+                    self.add_and_exec(stm)
 
-                # Execute the statement.
-                self.send_acked("(Exec {})\n".format(self.cur_state))
-                # Finally, get the result of the command
-                feedbacks = self.get_feedbacks()
-                # Get a new proof context, if it exists
-                self.get_proof_context()
-
-                if possibly_starting_proof(stm) and self.full_context:
-                    self.tactic_history = TacticHistory()
-                    self.tactic_history.addTactic(stm)
-                elif re.match(r"\s*[{]\s*", stm):
-                    assert context_before
-                    self.tactic_history.openSubgoal(context_before.subgoals[1:])
-                elif re.match(r"\s*[}]\s*", stm):
-                    self.tactic_history.closeSubgoal()
-                elif self.full_context:
-                    # If we saw a new proof context, we're still in a
-                    # proof so append the command to our prev_tactics
-                    # list.
-                    self.tactic_history.addTactic(stm)
+                self.tactic_history = record_tactic(self.tactic_history, stm,
+                                                    self._in_proof, context_before)
 
         # If we hit a problem let the user know what file it was in,
         # and then throw it again for other handlers. NOTE: We may
@@ -373,6 +440,93 @@ class SerapiInstance(threading.Thread):
             if timeout:
                 self.timeout=old_timeout
 
+    def add_and_exec(self, stm : str) -> None:
+        self.send_acked("(Add () \"{}\")\n".format(stm))
+        # Get the response, which indicates what state we put
+        # serapi in.
+        self.update_state()
+        self.get_completed()
+        assert self.message_queue.empty()
+
+        # Execute the statement.
+        self.send_acked("(Exec {})\n".format(self.cur_state))
+        # Finally, get the result of the command
+        feedbacks = self.get_feedbacks()
+        # Get a new proof context, if it exists
+        self.get_proof_context()
+
+    # Does the same thing as add_and_exec, but sends the Add, Exec,
+    # and first Goals query in one write. If the state id we guessed
+    # turns out to be wrong, throws away the answers to the Exec and
+    # the query and falls back to running them in lock-step.
+    def add_and_exec_pipelined(self, stm : str) -> None:
+        predicted_state = self._max_state_seen + 1
+        tags = self.send_tagged(
+            ["(Add () \"{}\")".format(stm),
+             "(Exec {})".format(predicted_state),
+             "(Query ((sid {}) (pp ((pp_format PpStr)))) Goals)"
+             .format(predicted_state)])
+        self.get_ack()
+        self.update_state()
+        self.get_completed()
+        if self.cur_state != predicted_state:
+            eprint(f"Predicted state {predicted_state}, but got state "
+                   f"{self.cur_state}. Falling back to lock-step.",
+                   guard=self.debug)
+            self.discard_tagged(tags[1:])
+            self.send_acked("(Exec {})\n".format(self.cur_state))
+            self.get_feedbacks()
+            self.get_proof_context()
+            return
+        self.get_ack()
+        feedbacks = self.get_feedbacks()
+        self.get_ack()
+        self.read_proof_context()
+
+    # Remember the current state, so that we can come back to it later
+    # with restore_state.
+    def save_state(self) -> 'SavedState':
+        return SavedState(self.cur_state, copy.deepcopy(self.tactic_history),
+                          self._in_proof, self._goals_str, self._full_context)
+
+    # Go back to a state saved with save_state, by cancelling
+    # everything added after it in one go. The saved state has to still
+    # be in the document, so you can only go backwards. Since we know
+    # what the goals were there, this doesn't query them again.
+    def restore_state(self, saved : 'SavedState') -> None:
+        self.flush_pending()
+        assert self.message_queue.empty(), self.messages
+        later_states = [state for state in self._doc_states
+                        if state > saved.state_id]
+        if later_states:
+            eprint(f"Restoring state {saved.state_id} "
+                   f"from state {self.cur_state}",
+                   guard=self.debug)
+            self.send_acked("(Cancel ({}))".format(min(later_states)))
+            self.get_cancelled()
+        self.cur_state = saved.state_id
+        self.tactic_history = copy.deepcopy(saved.tactic_history)
+        self._in_proof = saved.in_proof
+        self._goals_str = saved.goals_str
+        self._full_context = saved.full_context
+        assert self.message_queue.empty(), self.messages
+
+    # Go back to the state right after startup, cancelling everything
+    # that was run since (including the Requires of whatever file it was
+    # running), so the same sertop can be used for another file.
+    def reset(self) -> None:
+        self.flush_pending()
+        self.flush_queue()
+        self.restore_state(self._init_state)
+        # If anything from startup got cancelled, like Unset Printing
+        # Notations, this isn't the instance a new one would be.
+        assert self._doc_states == self._init_doc_states, \
+            (self._doc_states, self._init_doc_states)
+        self._term_str_cache = {}
+        self.timeout = self._init_timeout
+        self.debug = False
+        self.quiet = False
+
     @property
     def prev_tactics(self):
         return self.tactic_history.getCurrentHistory()
@@ -380,57 +534,14 @@ class SerapiInstance(threading.Thread):
     def handle_exception(self, e : Exception, stmt : str):
         eprint("Problem running statement: {}\n{}".format(stmt, e),
                guard=(not self.quiet or self.debug))
-        match(e,
-              TimeoutError, lambda *args: progn(self.tactic_history.addTactic(stmt), # type: ignore
-                                                self.cancel_last(), # type: ignore
-                                                raise_(TimeoutError("Statment \"{}\" timed out."
-                                                                    .format(stmt)))),
-              _, lambda e:
-              match(normalizeMessage(e.msg),
-                    ['Stream\.Error', str],
-                    lambda *args: progn(self.get_completed(),
-                                        raise_(ParseError("Couldn't parse command {}"
-                                                          .format(stmt)))),
-
-                    ['CLexer.Error.E(3)'],
-                    lambda *args: progn(self.get_completed(),
-                                        raise_(ParseError("Couldn't parse command {}"
-                                                          .format(stmt)))),
-                    'Not_found',
-                    lambda *args: progn(self.tactic_history.addTactic(stmt), # type: ignore
-                                        self.cancel_last(), raise_(e)), # type: ignore
-                    ['CErrors\.UserError', _],
-                    lambda inner: progn(self.tactic_history.addTactic(stmt), # type: ignore
-                                        self.get_completed(),
-                                        self.cancel_last(), raise_(e)), # type: ignore
-                    ['ExplainErr\.EvaluatedError', TAIL],
-                    lambda inner: progn(self.tactic_history.addTactic(stmt), # type: ignore
-                                        self.get_completed(),
-                                        self.cancel_last(), raise_(e)), # type: ignore
-                    ['Proofview.NoSuchGoals(1)'],
-                    lambda inner: progn(self.tactic_history.addTactic(stmt), # type: ignore
-                                        self.get_completed(),
-                                        self.cancel_last(), raise_(NoSuchGoalError())), # type: ignore
-
-                    ['Answer', int, ['CoqExn', _, _, _, 'Stream\\.Error']],
-                    lambda *args: raise_(ParseError("Couldn't parse command {}".format(stmt))),
-
-                    ['Answer', int, ['CoqExn', _, _, _, 'Invalid_argument']],
-                    lambda *args: raise_(ParseError("Invalid argument{}".format(stmt))),
-                    ['Answer', int, ['CoqExn', _, _, ["Backtrace", []], [str]]],
-                    lambda sentence, loc1, loc2, inner:
-                    progn(self.get_completed(), raise_(CoqAnomaly("Overflowed")))
-                    if re.search("Stack overflow", inner) else
-                    progn(self.get_completed(), raise_(UnrecognizedError(inner))),
-                    ['Answer', int, ['CoqExn', _, _, ["Backtrace", []], [str, str]]],
-                    lambda sentence, loc1, loc2, inner1, inner2:
-                    progn(self.get_completed(), raise_(CoqExn(inner1 + inner2))),
-                    [str],
-                    lambda contents:
-                    progn(self.get_completed(), raise_(CoqExn(contents)))
-                    if re.search("Anomaly", contents) else
-                    raise_(UnrecognizedError(contents)),
-                    _, lambda *args: progn(raise_(UnrecognizedError(args)))))
+        handling = exception_handling(e, stmt)
+        if handling.cancel:
+            self.tactic_history.addTactic(stmt)
+        if handling.get_completed:
+            self.get_completed()
+        if handling.cancel:
+            self.cancel_last()
+        raise handling.error
 
     # Flush all messages in the message queue
     def flush_queue(self) -> None:
@@ -438,29 +549,60 @@ class SerapiInstance(threading.Thread):
             self.get_message()
     def sexpToTermStr(self, sexp) -> str:
         answer = self.ask(f"(Print ((pp_format PpStr)) (CoqConstr {dumps(sexp)}))")
-        return match(normalizeMessage(answer),
-                     ["Answer", int, ["ObjList", [["CoqString", _]]]],
-                     lambda statenum, s: str(s),
-                     ["Answer", int, ["CoqExn", list, list, list, _]],
-                     lambda statenum, a, b, c, msg:
-                     raise_(CoqExn(msg)))
+        return parse_print_answer(answer)
+
+    # Print a batch of terms. Terms we've already printed in this proof
+    # come out of the cache, and the rest are sent in a single write
+    # when we're pipelining. Terms with evars aren't cached, since how
+    # they print depends on the state.
+    def sexpsToTermStrs(self, sexps : List['Sexp']) -> List[str]:
+        keys = [dumps(sexp) for sexp in sexps]
+        sexps_by_key = dict(zip(keys, sexps))
+        missing = [key for key in sexps_by_key if key not in self._term_str_cache]
+        if not self.pipelined:
+            printed = [self.sexpToTermStr(sexps_by_key[key]) for key in missing]
+        elif not missing:
+            printed = []
+        else:
+            self.flush_pending()
+            assert self.message_queue.empty(), self.messages
+            self.send_tagged([f"(Print ((pp_format PpStr)) (CoqConstr {key}))"
+                              for key in missing])
+            answers = []
+            for key in missing:
+                self.get_ack()
+                answers.append(self.get_message())
+                self.get_completed()
+            printed = [parse_print_answer(answer) for answer in answers]
+        new_strs = dict(zip(missing, printed))
+        for key, term_str in new_strs.items():
+            if "Evar" not in key:
+                self._term_str_cache[key] = term_str
+        return [self._term_str_cache[key] if key in self._term_str_cache
+                else new_strs[key]
+                for key in keys]
 
     # Cancel the last command which was sucessfully parsed by
     # serapi. Even if the command failed after parsing, this will
     # still cancel it. You need to call this after a command that
     # fails after parsing, but not if it fails before.
     def cancel_last(self) -> None:
+        self.flush_pending()
         assert self.message_queue.empty(), self.messages
-        context_before = self.full_context
-        if context_before:
+        in_proof_before = self._in_proof
+        old_subgoals = [] # type: List[Subgoal]
+        if in_proof_before:
             cancelled = self.tactic_history.getNextCancelled()
-            old_subgoals = context_before.subgoals
+            # Cancelling a closing brace puts us back in the subgoal,
+            # and the tactic history needs the goals to restore it.
+            if cancelled == "}":
+                assert self.full_context
+                old_subgoals = self.full_context.subgoals
             eprint(f"Cancelling {cancelled} "
                    f"from state {self.cur_state}",
                    guard=self.debug)
         else:
             cancelled = ""
-            old_subgoals = []
             eprint(f"Cancelling vernac "
                    f"from state {self.cur_state}",
                    guard=self.debug)
@@ -472,9 +614,9 @@ class SerapiInstance(threading.Thread):
         self.get_proof_context()
 
         # Fix up the previous tactics
-        if context_before:
+        if in_proof_before:
             self.tactic_history.removeLast(old_subgoals)
-        if not self.full_context:
+        if not self._in_proof:
             self.tactic_history = TacticHistory()
         assert self.message_queue.empty(), self.messages
         if re.match(r"\s*[{]\s*", cancelled):
@@ -483,18 +625,12 @@ class SerapiInstance(threading.Thread):
     # Get the next message from the message queue, and make sure it's
     # an Ack
     def get_ack(self) -> None:
-        ack = self.get_message()
-        match(normalizeMessage(ack),
-              ["Answer", _, "Ack"], lambda state: None,
-              _, lambda msg: raise_(AckError(dumps(ack))))
+        check_ack(self.get_message())
 
     # Get the next message from the message queue, and make sure it's
     # a Completed.
     def get_completed(self) -> Any:
-        completed = self.get_message()
-        match(normalizeMessage(completed),
-              ["Answer", int, "Completed"], lambda state: None,
-              _, lambda msg: raise_(CompletedError(completed)))
+        check_completed(self.get_message())
 
     def add_lib(self, origpath : str, logicalpath : str) -> None:
         addStm = ("(Add () \"Add Rec LoadPath \\\"{}\\\" as {}.\")\n"
@@ -553,29 +689,24 @@ class SerapiInstance(threading.Thread):
 
     def unset_printing_notations(self) -> None:
         self.send_acked("(Add () \"Unset Printing Notations.\")\n")
-        self.get_next_state()
+        self.update_state()
         self.get_completed()
 
     def get_next_state(self) -> int:
-        msg = self.get_message()
-        while match(normalizeMessage(msg),
-                    ["Feedback", TAIL], lambda tail: True,
-                    _, lambda x: False):
-            msg = self.get_message()
-
-        return match(normalizeMessage(msg),
-                     ["Answer", int, list],
-                     lambda state_num, contents:
-                     match(contents,
-                           ["CoqExn", _, _, _, list],
-                           lambda loc1, loc2, loc3, inner:
-                           raise_(CoqExn(inner)),
-                           ["Added", int, TAIL],
-                           lambda state_num, tail: state_num),
-                     _, lambda x: raise_(BadResponse(msg)))
+        state_num = parse_added_state(self.get_message())
+        while state_num is None:
+            state_num = parse_added_state(self.get_message())
+        self._see_state(state_num)
+        return state_num
+    def _see_state(self, state_num : int) -> None:
+        self._max_state_seen = max(self._max_state_seen, state_num)
+        self._doc_states.append(state_num)
+    def _forget_states(self, state_nums : List[int]) -> None:
+        self._doc_states = [state for state in self._doc_states
+                            if state not in state_nums]
     def discard_feedback(self) -> None:
         feedback_message = self.get_message()
-        while feedback_message[1][3][1] != Symbol("Processed"):
+        while not is_processed_feedback(feedback_message):
             feedback_message = self.get_message()
 
     def discard_initial_feedback(self) -> None:
@@ -592,6 +723,7 @@ class SerapiInstance(threading.Thread):
     def get_message(self, complete=False) -> Any:
         try:
             msg = self.message_queue.get(timeout=self.timeout)
+            self._note_answer(msg)
             if complete:
                 self.get_completed()
             return msg
@@ -611,13 +743,8 @@ class SerapiInstance(threading.Thread):
                 except:
                     raise CoqAnomaly("Timing Out")
 
-            got_answer_after_interrupt = match(normalizeMessage(interrupt_response),
-                                               ["Answer", int, ["CoqExn", TAIL]],
-                                               lambda *args: False,
-                                               ["Answer", TAIL],
-                                               lambda *args: True,
-                                               _, lambda *args: False)
-            if got_answer_after_interrupt:
+            response_kind = classify_interrupt_response(interrupt_response)
+            if response_kind == "answer":
                 self.get_completed()
                 for i in range(num_breaks):
                     try:
@@ -625,20 +752,14 @@ class SerapiInstance(threading.Thread):
                     except:
                         raise CoqAnomaly("Timing out")
                     assert isBreakMessage(msg), msg
-                assert self.message_queue.empty()
+                assert self.message_queue.empty() or self._pending_tags
                 return interrupt_response
-            elif isBreakMessage(interrupt_response):
+            elif response_kind == "break":
                 raise TimeoutError("")
-            elif isBreakAnswer(interrupt_response):
+            elif response_kind == "break_answer":
                 self.get_completed()
                 raise TimeoutError("")
-            elif match(normalizeMessage(interrupt_response, depth=10),
-                       ["Feedback", [["doc_id", int], ["span_id", int], ["route", int],
-                                     ["contents", ["Message", "Error", [],
-                                                   ["Pp_box", ["Pp_hovbox", int],
-                                                    ["Pp_glue", ["Pp_force_newline", ["Pp_string", "User interrupt."]]]]]]]],
-                       lambda *args: True,
-                       _, lambda *args: False):
+            elif response_kind == "user_interrupt":
                 for i in range(num_breaks):
                     try:
                         msg = self.message_queue.get(timeout=self.timeout)
@@ -646,14 +767,14 @@ class SerapiInstance(threading.Thread):
                         raise CoqAnomaly("Timing out")
                     assert isBreakAnswer(msg), msg
                 self.get_completed()
-                assert self.message_queue.empty(), self.messages
+                assert self.message_queue.empty() or self._pending_tags, \
+                    self.messages
                 raise TimeoutError("")
-            elif interrupt_response[0] == Symbol("Feedback"):
+            else:
                 eprint(interrupt_response)
                 self.get_completed()
-                assert self.message_queue.empty()
+                assert self.message_queue.empty() or self._pending_tags
                 return interrupt_response
-            assert False, (interrupt_response, self.messages)
 
     def get_feedbacks(self) -> List['Sexp']:
         feedbacks = [] #type: List[Sexp]
@@ -662,48 +783,61 @@ class SerapiInstance(threading.Thread):
               next_message[0] == Symbol("Feedback")):
             feedbacks.append(next_message)
             next_message = self.get_message()
-        fin = next_message
-        match(normalizeMessage(fin),
-              ["Answer", _, "Completed", TAIL], lambda *args: None,
-              ['Answer', _, ["CoqExn", _, _, _, _]],
-              lambda statenum, loc1, loc2, loc3, inner: raise_(CoqExn(inner)),
-              _, lambda *args: progn(eprint(f"message is \"{repr(fin)}\""), raise_(UnrecognizedError(fin)))
-        )
-
+        check_feedbacks_end(next_message)
         return feedbacks
 
+    # Counting goals only needs the pretty-printed goals, so this
+    # avoids printing each hypothesis when the full context hasn't
+    # been fetched yet.
     def count_fg_goals(self) -> int:
-        if not self.full_context:
+        if not self._in_proof:
             return 0
-        return len(self.full_context.subgoals)
+        if self._full_context:
+            return len(self._full_context.subgoals)
+        return count_pp_goals(self.get_goals_str())
 
     def get_cancelled(self) -> int:
         try:
-            feedback = self.get_message()
-
-            new_statenum = \
-                match(normalizeMessage(feedback),
-                      ["Answer", int, ["CoqExn", _, _, _, _]],
-                      lambda *args: raise_(CoqExn(feedback)),
-                      ["Feedback", [['doc_id', int], ['span_id', int], TAIL]],
-                      lambda docnum, statenum, *rest: statenum,
-                      _, lambda *args: raise_(BadResponse(feedback)))
-
-            cancelled_answer = self.get_message()
-            old_statenum = \
-                match(normalizeMessage(cancelled_answer),
-                      ["Answer", int, ["Canceled", list]],
-                      lambda _, statenums: min(statenums),
-                      ["Answer", int, ["CoqExn", _, _, _, _]],
-                      lambda *args: raise_(CoqExn(cancelled_answer)),
-                      _, lambda *args: raise_(BadResponse(cancelled_answer)))
+            new_statenum = parse_cancel_feedback(self.get_message())
+            self._forget_states(parse_cancelled(self.get_message()))
         finally:
             self.get_completed()
 
         return new_statenum
 
-    def extract_proof_context(self, raw_proof_context : 'Sexp') -> str:
-        return cast(List[List[str]], raw_proof_context)[0][1]
+    # Whether the current state is in a proof. Unlike checking
+    # full_context, this never needs to ask coq anything.
+    @property
+    def in_proof(self) -> bool:
+        return self._in_proof
+
+    @property
+    def proof_context(self) -> Optional[str]:
+        if not self._in_proof:
+            return None
+        return self.get_goals_str().split("\n\n")[0]
+
+    @property
+    def full_context(self) -> Optional[FullContext]:
+        if not self._in_proof:
+            return None
+        if self._full_context is None:
+            self.fetch_goals(structured=True)
+        return self._full_context
+
+    # Fill in the foreground goals of the current state from somewhere
+    # else, like the outcome cache of an earlier search, so that they
+    # don't have to be queried and printed again.
+    def assume_full_context(self, full_context : FullContext) -> None:
+        assert self._in_proof
+        if self._full_context is None:
+            self._full_context = full_context
+
+    def get_goals_str(self) -> str:
+        if self._goals_str is None:
+            self.fetch_goals(structured=False)
+        assert self._goals_str is not None
+        return self._goals_str
 
     @property
     def goals(self) -> str:
@@ -739,72 +873,107 @@ class SerapiInstance(threading.Thread):
 
     def get_proof_context(self) -> None:
         self.send_acked("(Query ((sid {}) (pp ((pp_format PpStr)))) Goals)".format(self.cur_state))
+        self.read_proof_context()
 
+    # Read the answer to a pretty-printed Goals query which has already
+    # been acked, and use it to find out whether we're in a proof. The
+    # goals themselves are only fetched once they're asked for.
+    def read_proof_context(self) -> None:
         proof_context_message = self.get_message()
         self.get_completed()
-        if (not isinstance(proof_context_message, list) or
-            proof_context_message[0] != Symbol("Answer")):
-            raise BadResponse(proof_context_message)
-        else:
-            ol_msg = proof_context_message[2]
-            if (ol_msg[0] != Symbol("ObjList")):
-                raise BadResponse(proof_context_message)
-            if len(ol_msg[1]) != 0:
-                # If we're in a proof, then let's run Unshelve to get
-                # the real goals. Note this would fail if we were not
-                # in a proof, so we have to check that first.
-                self.unshelve()
-
-                # Now actually get the goals
-                # Now actually get the real goals
-                self.send_acked("(Query ((sid {}) (pp ((pp_format PpStr)))) Goals)"
-                                .format(self.cur_state))
+        self._in_proof = goals_answer_in_proof(proof_context_message)
+        self._goals_str = None
+        self._full_context = None
+        if not self._in_proof:
+            self._term_str_cache = {}
+
+    # Get the goals in the current state. We have to run Unshelve to
+    # get the real goals, so only call this when we're in a proof. If
+    # structured is set, also prints each hypothesis and goal term
+    # separately to build the full context; otherwise, only gets the
+    # pretty-printed goals.
+    def fetch_goals(self, structured : bool) -> None:
+        assert self._in_proof
+        self.flush_pending()
+        assert self.message_queue.empty(), self.messages
+        newcontext, goals_message = self.get_unshelved_goals(structured)
+        assert self.message_queue.empty()
+        self._goals_str = newcontext
+        if structured:
+            if newcontext == "":
+                self._full_context = FullContext([])
+            else:
+                # Try to do this the right way, fall back to the
+                # wrong way if we run into this bug:
+                # https://github.com/ejgallego/coq-serapi/issues/150
+                try:
+                    # Print all the goal and hypothesis terms at once,
+                    # then put them back together.
+                    term_strs = self.sexpsToTermStrs(goal_term_sexps(goals_message))
+                    self._full_context = full_context_from_terms(goals_message,
+                                                                 term_strs)
+                except CoqExn:
+                    self._full_context = full_context_from_pp(newcontext)
+        # Cancel the Unshelve, to keep things clean.
+        self.send_acked("(Cancel ({}))".format(self.cur_state))
+        self.cur_state = self.get_cancelled()
+        assert self.message_queue.empty()
+
+    # Run Unshelve, and get the goals after it, pretty-printed and, if
+    # structured is set, as terms. Leaves the Unshelve in place, so the
+    # caller has to cancel it. The structured goals are only fetched
+    # when there are some.
+    def get_unshelved_goals(self, structured : bool = True) \
+        -> Tuple[str, Optional['Sexp']]:
+        if self.pipelined:
+            predicted_state = self._max_state_seen + 1
+            queries = ["(Query ((sid {}) (pp ((pp_format PpStr)))) Goals)"
+                       .format(predicted_state)]
+            if structured:
+                queries.append("(Query ((sid {})) Goals)".format(predicted_state))
+            tags = self.send_tagged(
+                ["(Add () \"Unshelve.\")",
+                 "(Exec {})".format(predicted_state)] + queries)
+            self.get_ack()
+            self.update_state()
+            self.get_completed()
+            if self.cur_state == predicted_state:
+                self.get_ack()
+                self.discard_feedback()
+                self.discard_feedback()
+                self.get_completed()
+                self.get_ack()
                 proof_context_message = self.get_message()
-                ol_msg = proof_context_message[2]
                 self.get_completed()
-                assert self.message_queue.empty()
-
-                # Do some basic parsing on the context
-                newcontext = self.extract_proof_context(ol_msg[1])
-                self.proof_context = newcontext.split("\n\n")[0]
-                if newcontext == "":
-                    self.full_context = FullContext([])
-                else:
-                    # Try to do this the right way, fall back to the
-                    # wrong way if we run into this bug:
-                    # https://github.com/ejgallego/coq-serapi/issues/150
-                    try:
-                        response = self.ask("(Query () Goals)")
-                        subgoal_sexps = response[2][1][0][1][0][1]
-                        subgoals = []
-                        for goal_sexp in subgoal_sexps:
-                            goal_term = self.sexpToTermStr(goal_sexp[1][1])
-
-                            hyps = []
-                            for hyp_sexp in goal_sexp[2][1]:
-                                ids_str = ",".join([dumps(var_sexp[1]) for var_sexp in hyp_sexp[0]])
-                                hyp_type = self.sexpToTermStr(hyp_sexp[2])
-
-                                hyps.append(f"{ids_str} : {hyp_type}")
-                            subgoals.append(Subgoal(hyps, goal_term))
-                        self.full_context = FullContext(subgoals)
-                    except CoqExn:
-                        if newcontext == "none":
-                            self.full_context =  FullContext([])
-                        else:
-                            self.full_context = \
-                                FullContext([parsePPSubgoal(substr) for substr
-                                             in re.split("\n\n|(?=\snone)", newcontext)
-                                             if substr.strip()])
-                        pass
-                # Cancel the Unshelve, to keep things clean.
-                self.send_acked("(Cancel ({}))".format(self.cur_state))
-                self.cur_state = self.get_cancelled()
-                assert self.message_queue.empty()
+                newcontext = extract_proof_context(proof_context_message[2][1])
+                if not structured:
+                    return newcontext, None
+                self.get_ack()
+                goals_message = self.get_message()
+                self.get_completed()
+                return newcontext, (goals_message if newcontext != "" else None)
+            eprint(f"Predicted state {predicted_state} for Unshelve, but got "
+                   f"state {self.cur_state}. Falling back to lock-step.",
+                   guard=self.debug)
+            self.discard_tagged(tags[1:])
+            self.send_acked("(Exec {})\n".format(self.cur_state))
+            self.discard_feedback()
+            self.discard_feedback()
+            self.get_completed()
+        else:
+            self.unshelve()
+        assert self.message_queue.empty()
 
-            else:
-                self.proof_context = None
-                self.full_context = None
+        # Now actually get the real goals
+        self.send_acked("(Query ((sid {}) (pp ((pp_format PpStr)))) Goals)"
+                        .format(self.cur_state))
+        proof_context_message = self.get_message()
+        self.get_completed()
+        assert self.message_queue.empty()
+        newcontext = extract_proof_context(proof_context_message[2][1])
+        if newcontext == "" or not structured:
+            return newcontext, None
+        return newcontext, self.ask("(Query () Goals)")
 
     def get_lemmas_about_head(self) -> str:
         goal_head = self.goals.split()[0]
@@ -815,15 +984,11 @@ class SerapiInstance(threading.Thread):
         except:
             return ""
 
+    # Nothing looks at most of what's in feedback messages, so they
+    # aren't read in full.
     def run(self) -> None:
-        while(True):
-            line = self._fout.readline().decode('utf-8')
-            if line == '': break
-            try:
-                response = loads(line)
-            except:
-                eprint("Couldn't parse Sexp:\n{}".format(line))
-                raise
+        for response in sexp_reader.read_messages(self._fout,
+                                                  skip_feedback_contents=True):
             # print("Got message {}".format(response))
             self.message_queue.put(response)
 
@@ -846,15 +1011,288 @@ def isBreakAnswer(msg : 'Sexp') -> bool:
                  lambda *args: True,
                  _, lambda *args: False)
 
+# The rest of the protocol handling doesn't do any I/O, so that
+# SerapiInstance and the asyncio client in async_serapi can share it,
+# and each only has to do its own reading and writing.
+
+# What to do about an error from running a statement. If cancel is
+# set, the statement goes in the tactic history and then gets
+# cancelled. If get_completed is set, the Completed that's still
+# coming has to be read first. Either way, error is raised at the end.
+class ExceptionHandling(NamedTuple):
+    cancel : bool
+    get_completed : bool
+    error : Exception
+
+def exception_handling(e : Exception, stmt : str) -> ExceptionHandling:
+    if isinstance(e, TimeoutError):
+        return ExceptionHandling(True, False,
+                                 TimeoutError("Statment \"{}\" timed out."
+                                              .format(stmt)))
+    return match(normalizeMessage(e.msg), # type: ignore
+                 ['Stream\.Error', str],
+                 lambda *args:
+                 ExceptionHandling(False, True,
+                                   ParseError("Couldn't parse command {}"
+                                              .format(stmt))),
+                 ['CLexer.Error.E(3)'],
+                 lambda *args:
+                 ExceptionHandling(False, True,
+                                   ParseError("Couldn't parse command {}"
+                                              .format(stmt))),
+                 'Not_found',
+                 lambda *args: ExceptionHandling(True, False, e),
+                 ['CErrors\.UserError', _],
+                 lambda inner: ExceptionHandling(True, True, e),
+                 ['ExplainErr\.EvaluatedError', TAIL],
+                 lambda inner: ExceptionHandling(True, True, e),
+                 ['Proofview.NoSuchGoals(1)'],
+                 lambda inner: ExceptionHandling(True, True, NoSuchGoalError()),
+
+                 ['Answer', int, ['CoqExn', _, _, _, 'Stream\\.Error']],
+                 lambda *args:
+                 ExceptionHandling(False, False,
+                                   ParseError("Couldn't parse command {}"
+                                              .format(stmt))),
+
+                 ['Answer', int, ['CoqExn', _, _, _, 'Invalid_argument']],
+                 lambda *args:
+                 ExceptionHandling(False, False,
+                                   ParseError("Invalid argument{}".format(stmt))),
+                 ['Answer', int, ['CoqExn', _, _, ["Backtrace", []], [str]]],
+                 lambda sentence, loc1, loc2, inner:
+                 ExceptionHandling(False, True, CoqAnomaly("Overflowed"))
+                 if re.search("Stack overflow", inner) else
+                 ExceptionHandling(False, True, UnrecognizedError(inner)),
+                 ['Answer', int, ['CoqExn', _, _, ["Backtrace", []], [str, str]]],
+                 lambda sentence, loc1, loc2, inner1, inner2:
+                 ExceptionHandling(False, True, CoqExn(inner1 + inner2)),
+                 [str],
+                 lambda contents:
+                 ExceptionHandling(False, True, CoqExn(contents))
+                 if re.search("Anomaly", contents) else
+                 ExceptionHandling(False, False, UnrecognizedError(contents)),
+                 _, lambda *args:
+                 ExceptionHandling(False, False, UnrecognizedError(args)))
+
+def check_ack(ack : 'Sexp') -> None:
+    match(normalizeMessage(ack),
+          ["Answer", _, "Ack"], lambda state: None,
+          _, lambda msg: raise_(AckError(dumps(ack))))
+
+def check_completed(completed : 'Sexp') -> None:
+    match(normalizeMessage(completed),
+          ["Answer", int, "Completed"], lambda state: None,
+          _, lambda msg: raise_(CompletedError(completed)))
+
+# The state number in the answer to an Add, or None if the message is
+# feedback that came before the answer.
+def parse_added_state(msg : 'Sexp') -> Optional[int]:
+    return match(normalizeMessage(msg),
+                 ["Feedback", TAIL], lambda tail: None,
+                 ["Answer", int, list],
+                 lambda state_num, contents:
+                 match(contents,
+                       ["CoqExn", _, _, _, list],
+                       lambda loc1, loc2, loc3, inner:
+                       raise_(CoqExn(inner)),
+                       ["Added", int, TAIL],
+                       lambda state_num, tail: state_num),
+                 _, lambda x: raise_(BadResponse(msg)))
+
+def is_processed_feedback(msg : 'Sexp') -> bool:
+    return msg[1][3][1] == Symbol("Processed")
+
+# Check the message that ends the feedback from an Exec.
+def check_feedbacks_end(fin : 'Sexp') -> None:
+    match(normalizeMessage(fin),
+          ["Answer", _, "Completed", TAIL], lambda *args: None,
+          ['Answer', _, ["CoqExn", _, _, _, _]],
+          lambda statenum, loc1, loc2, loc3, inner: raise_(CoqExn(inner)),
+          _, lambda *args: progn(eprint(f"message is \"{repr(fin)}\""),
+                                 raise_(UnrecognizedError(fin))))
+
+# Cancelling sends feedback with the state we end up in, and then an
+# answer with the states that were cancelled.
+def parse_cancel_feedback(feedback : 'Sexp') -> int:
+    return match(normalizeMessage(feedback),
+                 ["Answer", int, ["CoqExn", _, _, _, _]],
+                 lambda *args: raise_(CoqExn(feedback)),
+                 ["Feedback", [['doc_id', int], ['span_id', int], TAIL]],
+                 lambda docnum, statenum, *rest: statenum,
+                 _, lambda *args: raise_(BadResponse(feedback)))
+def parse_cancelled(cancelled_answer : 'Sexp') -> List[int]:
+    return match(normalizeMessage(cancelled_answer),
+                 ["Answer", int, ["Canceled", list]],
+                 lambda _, statenums: statenums,
+                 ["Answer", int, ["CoqExn", _, _, _, _]],
+                 lambda *args: raise_(CoqExn(cancelled_answer)),
+                 _, lambda *args: raise_(BadResponse(cancelled_answer)))
+
+# What sertop sent back after we interrupted it: "answer" if the
+# command finished anyway, "break" or "break_answer" if it was
+# interrupted, "user_interrupt" if the interrupt was reported as an
+# error message, and "feedback" for other feedback.
+def classify_interrupt_response(msg : 'Sexp') -> str:
+    got_answer_after_interrupt = match(normalizeMessage(msg),
+                                       ["Answer", int, ["CoqExn", TAIL]],
+                                       lambda *args: False,
+                                       ["Answer", TAIL],
+                                       lambda *args: True,
+                                       _, lambda *args: False)
+    if got_answer_after_interrupt:
+        return "answer"
+    elif isBreakMessage(msg):
+        return "break"
+    elif isBreakAnswer(msg):
+        return "break_answer"
+    elif match(normalizeMessage(msg, depth=10),
+               ["Feedback", [["doc_id", int], ["span_id", int], ["route", int],
+                             ["contents", ["Message", "Error", [],
+                                           ["Pp_box", ["Pp_hovbox", int],
+                                            ["Pp_glue", ["Pp_force_newline", ["Pp_string", "User interrupt."]]]]]]]],
+               lambda *args: True,
+               _, lambda *args: False):
+        return "user_interrupt"
+    elif msg[0] == Symbol("Feedback"):
+        return "feedback"
+    assert False, msg
+
+# Whether the answer to a pretty-printed Goals query has any goals,
+# which is how we tell if we're in a proof.
+def goals_answer_in_proof(proof_context_message : 'Sexp') -> bool:
+    if (not isinstance(proof_context_message, list) or
+        proof_context_message[0] != Symbol("Answer")):
+        raise BadResponse(proof_context_message)
+    ol_msg = proof_context_message[2]
+    if (ol_msg[0] != Symbol("ObjList")):
+        raise BadResponse(proof_context_message)
+    return len(ol_msg[1]) != 0
+
+def extract_proof_context(raw_proof_context : 'Sexp') -> str:
+    return cast(List[List[str]], raw_proof_context)[0][1]
+
+def parse_print_answer(answer : 'Sexp') -> str:
+    return match(normalizeMessage(answer),
+                 ["Answer", int, ["ObjList", [["CoqString", _]]]],
+                 lambda statenum, s: str(s),
+                 ["Answer", int, ["CoqExn", list, list, list, _]],
+                 lambda statenum, a, b, c, msg:
+                 raise_(CoqExn(msg)))
+
+# The goal and hypothesis terms in the answer to a structured Goals
+# query, in the order full_context_from_terms wants them printed.
+def goal_term_sexps(goals_message : 'Sexp') -> List['Sexp']:
+    term_sexps = []
+    for goal_sexp in goals_message[2][1][0][1][0][1]:
+        term_sexps.append(goal_sexp[1][1])
+        for hyp_sexp in goal_sexp[2][1]:
+            term_sexps.append(hyp_sexp[2])
+    return term_sexps
+
+def full_context_from_terms(goals_message : 'Sexp',
+                            term_strs : List[str]) -> FullContext:
+    term_strs_iter = iter(term_strs)
+    subgoals = []
+    for goal_sexp in goals_message[2][1][0][1][0][1]:
+        goal_term = next(term_strs_iter)
+
+        hyps = []
+        for hyp_sexp in goal_sexp[2][1]:
+            ids_str = ",".join([dumps(var_sexp[1]) for var_sexp in hyp_sexp[0]])
+            hyp_type = next(term_strs_iter)
+
+            hyps.append(f"{ids_str} : {hyp_type}")
+        subgoals.append(Subgoal(hyps, goal_term))
+    return FullContext(subgoals)
+
+# For when the terms can't be printed, because of this bug:
+# https://github.com/ejgallego/coq-serapi/issues/150
+def full_context_from_pp(goals_str : str) -> FullContext:
+    if goals_str == "none":
+        return FullContext([])
+    return FullContext([parsePPSubgoal(substr) for substr
+                        in re.split("\n\n|(?=\snone)", goals_str)
+                        if substr.strip()])
+
+def count_pp_goals(goals_str : str) -> int:
+    if goals_str == "" or goals_str == "none":
+        return 0
+    return len(re.findall("\n====+\n", goals_str))
+
+# Update the tactic history after running stm. context_before is the
+# context before an opening brace, whose background goals it saves.
+# Starting a proof starts a new history, so this returns the history
+# to use from now on.
+def record_tactic(tactic_history : TacticHistory, stm : str, in_proof : bool,
+                  context_before : Optional[FullContext]) -> TacticHistory:
+    if possibly_starting_proof(stm) and in_proof:
+        tactic_history = TacticHistory()
+        tactic_history.addTactic(stm)
+    elif re.match(r"\s*[{]\s*", stm):
+        assert context_before
+        tactic_history.openSubgoal(context_before.subgoals[1:])
+    elif re.match(r"\s*[}]\s*", stm):
+        tactic_history.closeSubgoal()
+    elif in_proof:
+        # If we saw a new proof context, we're still in a proof so
+        # append the command to our prev_tactics list.
+        tactic_history.addTactic(stm)
+    return tactic_history
+
 import contextlib
 from typing import Iterator
 
 @contextlib.contextmanager
-def SerapiContext(coq_commands : List[str], includes : str, prelude : str, use_hammer : bool = False) -> Iterator[Any]:
-    coq = SerapiInstance(coq_commands, includes, prelude, use_hammer=use_hammer)
+def SerapiContext(coq_commands : List[str], includes : str, prelude : str,
+                  use_hammer : bool = False, pipelined : bool = True) -> Iterator[Any]:
+    coq = SerapiInstance(coq_commands, includes, prelude, use_hammer=use_hammer,
+                         pipelined=pipelined)
     yield coq
     coq.kill()
 
+# Instances that finished a job cleanly, waiting to be reused by the
+# next job in this process that starts sertop the same way.
+idle_instances : Dict[Tuple[Any, ...], List[SerapiInstance]] = {}
+idle_instances_lock = threading.Lock()
+
+def kill_idle_instances() -> None:
+    with idle_instances_lock:
+        for instances in idle_instances.values():
+            for coq in instances:
+                coq.kill()
+        idle_instances.clear()
+atexit.register(kill_idle_instances)
+
+# Like SerapiContext, but instead of killing the instance at the end,
+# it's reset and kept for the next job. If the job raised, or the
+# reset fails, the instance is killed, since we don't know what state
+# it's in.
+@contextlib.contextmanager
+def PooledSerapiContext(coq_commands : List[str], includes : str, prelude : str,
+                        use_hammer : bool = False,
+                        pipelined : bool = True) -> Iterator[Any]:
+    key = (tuple(coq_commands), includes, prelude, use_hammer, pipelined)
+    with idle_instances_lock:
+        instances = idle_instances.get(key)
+        coq = instances.pop() if instances else None
+    if coq is None:
+        coq = SerapiInstance(coq_commands, includes, prelude, use_hammer=use_hammer,
+                             pipelined=pipelined)
+    try:
+        yield coq
+    except BaseException:
+        coq.kill()
+        raise
+    try:
+        coq.reset()
+    except Exception as e:
+        eprint(f"Couldn't reset coq instance, killing it: {e}", guard=coq.debug)
+        coq.kill()
+        return
+    with idle_instances_lock:
+        idle_instances.setdefault(key, []).append(coq)
+
 def possibly_starting_proof(command : str) -> bool:
     stripped_command = kill_comments(command).strip()
     return (re.match("Lemma\s", stripped_command) != None or
@@ -881,57 +1319,82 @@ def ending_proof(command : str) -> bool:
             (re.match("\s*Proof\s+\S+\s*", stripped_command) != None and
              re.match("\s*Proof\s+with", stripped_command) == None))
 
+# The lexers below only look at the characters that can change their
+# state, and copy everything in between with slices, instead of going
+# a character at a time. Where they look at the previous character,
+# they index the same way the character-at-a-time versions did (so at
+# the start of the string they look at its last character), to split
+# every file exactly the same way.
+
+split_commands_event_re = re.compile(r'["{}+\-*]|\.(?=\s|\Z)')
+nonspace_re = re.compile(r"\S")
+nonbullet_re = re.compile(r"[^+\-*]")
 def split_commands(string : str) -> List[str]:
     result = []
-    next_command = ""
+    # The command we're in is string[command_start:i]
+    command_start = 0
+    # The first non-whitespace character of the command, and the first
+    # character after that which isn't a bullet
+    first_nonspace = first_nonbullet = -1
     in_quote = False
-    for i in range(len(string)):
+    def find(pattern : Pattern, pos : int) -> int:
+        found = pattern.search(string, pos)
+        return found.start() if found else len(string)
+    for event in split_commands_event_re.finditer(string):
+        i = event.start()
+        c = string[i]
         if in_quote:
-            if string[i] == '"' and string[i-1] != '\\':
+            if c == '"' and string[i-1] != '\\':
                 in_quote = False
-        else:
-            if string[i] == '"' and string[i-1] != '\\':
+            continue
+        if c == '"':
+            if string[i-1] != '\\':
                 in_quote = True
-            if (re.match("[\{\}]", string[i]) and
-                re.fullmatch("\s*", next_command)):
-                result.append(string[i])
-                next_command = ""
-                continue
-            if (re.match("[\+\-\*]", string[i]) and
-                string[i] != string[i+1] and
-                re.fullmatch("\s*[\+\-\*]*", next_command)):
-                next_command += string[i]
-                result.append(next_command.strip())
-                next_command = ""
-                continue
-            if (re.match("\.($|\s)", string[i:i+2]) and
-                (not string[i-1] == "." or string[i-2] == ".")):
-                result.append(next_command.strip() + ".")
-                next_command = ""
-                continue
-        next_command += string[i]
+            continue
+        if first_nonspace < command_start:
+            first_nonspace = find(nonspace_re, command_start)
+            first_nonbullet = find(nonbullet_re, first_nonspace)
+        if c in "{}":
+            if first_nonspace >= i:
+                result.append(c)
+                command_start = i + 1
+        elif c in "+-*":
+            if string[i+1:i+2] != c and first_nonbullet >= i:
+                result.append(string[command_start:i+1].strip())
+                command_start = i + 1
+        elif string[i-1] != "." or string[i-2] == ".":
+            result.append(string[command_start:i].strip() + ".")
+            command_start = i + 1
     return result
 
+kill_comments_event_re = re.compile(r'"|\((?=\*)|(?<=\*)\)')
 def kill_comments(string: str) -> str:
-    result = ""
+    if "(*" not in string:
+        return string
+    pieces = []
+    # Where the text we're keeping starts, if we're not in a comment
+    keep_start = 0
     depth = 0
     in_quote = False
-    for i in range(len(string)):
-        if in_quote:
+    for event in kill_comments_event_re.finditer(string):
+        i = event.start()
+        c = string[i]
+        if c == '"':
+            if string[i-1] != '\\':
+                in_quote = not in_quote
+        elif in_quote:
+            continue
+        elif c == "(":
             if depth == 0:
-                result += string[i]
-            if string[i] == '"' and string[i-1] != '\\':
-                in_quote = False
-        else:
-            if string[i:i+2] == '(*':
-                depth += 1
+                pieces.append(string[keep_start:i])
+            depth += 1
+        elif depth > 0:
+            depth -= 1
             if depth == 0:
-                result += string[i]
-            if string[i-1:i+1] == '*)' and depth > 0:
-                depth -= 1
-            if string[i] == '"' and string[i-1] != '\\':
-               in_quote = True
-    return result
+                keep_start = i + 1
+    if depth == 0:
+        pieces.append(string[keep_start:])
+    return "".join(pieces)
 
 def next_proof(cmds : Iterator[str]) -> Iterable[str]:
     next_cmd = next(cmds)
@@ -1232,35 +1695,61 @@ def load_commands_preserve(args : argparse.Namespace, file_idx : int,
 
 from tqdm import tqdm
 from typing import Pattern, Match
+command_quote_re = re.compile(r"(?<!\\)\"")
+command_open_comment_re = re.compile(r"\(\*")
+command_close_comment_re = re.compile(r"\*\)")
+command_bracket_re = re.compile(r"[\{\}]")
+command_bullet_re = re.compile(r"[\+\-\*]+(?![\)\+\-\*])")
+command_period_re = re.compile(r"(?<!\.)\.($|\s)|\.\.\.($|\s)")
 def read_commands_preserve(args : argparse.Namespace, file_idx : int,
                            contents : str) -> List[str]:
     result = []
-    cur_command = ""
+    # The command we're in is contents[command_start:curPos]
+    command_start = 0
     comment_depth = 0
     in_quote = False
     curPos = 0
+    # The next match of each pattern. A match that starts at or after
+    # curPos is still the next one, so each pattern only gets searched
+    # again once we've passed its match, and the file is only scanned
+    # once.
+    next_matches : Dict[Pattern, Optional[Match]] = {}
     def search_pat(pat : Pattern) -> Tuple[Optional[Match], int]:
-        match = pat.search(contents, curPos)
+        if pat not in next_matches or \
+           (next_matches[pat] is not None and next_matches[pat].start() < curPos):
+            next_matches[pat] = pat.search(contents, curPos)
+        match = next_matches[pat]
         return match, match.end() if match else len(contents) + 1
+    # Once a command has something besides whitespace and comments in
+    # it, so does everything longer (unless it ended in a "(", which
+    # could be starting a comment), so that's only checked until then.
+    command_has_code = False
+    def only_comments_until(end : int) -> bool:
+        nonlocal command_has_code
+        if command_has_code:
+            return False
+        text = kill_comments(contents[command_start:end])
+        if not re.match("\s*$", text):
+            command_has_code = not contents.startswith("(", end - 1)
+            return False
+        return True
     with tqdm(total=len(contents)+1, file=sys.stdout,
               disable=(not args.progress),
               position = (file_idx * 2),
               desc="Reading file", leave=False,
               dynamic_ncols=True, bar_format=mybarfmt) as pbar:
       while curPos < len(contents):
-          _, next_quote = search_pat(re.compile(r"(?<!\\)\""))
-          _, next_open_comment = search_pat(re.compile(r"\(\*"))
-          _, next_close_comment = search_pat(re.compile(r"\*\)"))
-          _, next_bracket = search_pat(re.compile(r"[\{\}]"))
-          next_bullet_match, next_bullet = search_pat(re.compile(r"[\+\-\*]+(?![\)\+\-\*])"))
-          _, next_period = search_pat(re.compile(r"(?<!\.)\.($|\s)|\.\.\.($|\s)"))
+          _, next_quote = search_pat(command_quote_re)
+          _, next_open_comment = search_pat(command_open_comment_re)
+          _, next_close_comment = search_pat(command_close_comment_re)
+          _, next_bracket = search_pat(command_bracket_re)
+          next_bullet_match, next_bullet = search_pat(command_bullet_re)
+          _, next_period = search_pat(command_period_re)
           nextPos = min(next_quote,
                         next_open_comment, next_close_comment,
                         next_bracket,
                         next_bullet, next_period)
           assert curPos < nextPos
-          next_chunk = contents[curPos:nextPos]
-          cur_command += next_chunk
           pbar.update(nextPos - curPos)
           if nextPos == next_quote:
               if comment_depth == 0:
@@ -1273,21 +1762,24 @@ def read_commands_preserve(args : argparse.Namespace, file_idx : int,
                   comment_depth -= 1
           elif nextPos == next_bracket:
               if not in_quote and comment_depth == 0 and \
-                 re.match("\s*$", kill_comments(cur_command[:-1])):
-                  result.append(cur_command)
-                  cur_command = ""
+                 only_comments_until(nextPos - 1):
+                  result.append(contents[command_start:nextPos])
+                  command_start = nextPos
+                  command_has_code = False
           elif nextPos == next_bullet:
               assert next_bullet_match
               match_length = next_bullet_match.end() - next_bullet_match.start()
               if not in_quote and comment_depth == 0 and \
-                 re.match("\s*$", kill_comments(cur_command[:-match_length])):
-                  result.append(cur_command)
-                  cur_command = ""
+                 only_comments_until(nextPos - match_length):
+                  result.append(contents[command_start:nextPos])
+                  command_start = nextPos
+                  command_has_code = False
               assert next_bullet_match.end() >= nextPos
           elif nextPos == next_period:
               if not in_quote and comment_depth == 0:
-                  result.append(cur_command)
-                  cur_command = ""
+                  result.append(contents[command_start:nextPos])
+                  command_start = nextPos
+                  command_has_code = False
           curPos = nextPos
       return result
 
@@ -1297,21 +1789,35 @@ def try_load_lin(args : argparse.Namespace, file_idx : int, filename : str) \
     if args.verbose:
         eprint("Attempting to load cached linearized version from {}"
                .format(lin_path))
-    if not lin_path.exists():
+    lin_cache = open_lin_cache(args)
+    if not lin_path.exists() and not lin_cache:
         return None
     file_hash = hash_file(filename)
-    with lin_path.open(mode='r') as f:
-        if file_hash == f.readline().strip():
-            return read_commands_preserve(args, file_idx, f.read())
-        else:
-            return None
+    if lin_path.exists():
+        with lin_path.open(mode='r') as f:
+            if file_hash == f.readline().strip():
+                return read_commands_preserve(args, file_idx, f.read())
+    if lin_cache:
+        contents = lin_cache.lookup(lin_cache.key(file_hash, filename))
+        if contents is not None:
+            eprint(f"Found linearized version of {filename} in {lin_cache.path}",
+                   guard=args.verbose)
+            with open(filename + ".lin", 'w') as f:
+                print(file_hash, file=f)
+                f.write(contents)
+            return read_commands_preserve(args, file_idx, contents)
+    return None
 
-def save_lin(commands : List[str], filename : str) -> None:
+def save_lin(commands : List[str], filename : str,
+             lin_cache : Optional[LinCache] = None) -> None:
     output_file = filename + '.lin'
+    file_hash = hash_file(filename)
+    contents = "".join(command + "\n" for command in commands)
     with open(output_file, 'w') as f:
-        print(hash_file(filename), file=f)
-        for command in commands:
-            print(command, file=f)
+        print(file_hash, file=f)
+        f.write(contents)
+    if lin_cache:
+        lin_cache.store(lin_cache.key(file_hash, filename), contents)
 
 def main() -> None:
     parser = argparse.ArgumentParser(
@@ -1343,6 +1849,9 @@ def main() -> None:
                         action='store_const', const=True, default=False)
     parser.add_argument("--progress",
                         action='store_const', const=True, default=False)
+    parser.add_argument("--no-pipeline", dest="pipelined", action='store_false',
+                        help="Wait for each answer from serapi before sending "
+                        "the next command.")
     args = parser.parse_args()
     includes = ""
     if args.includes:
@@ -1353,7 +1862,7 @@ def main() -> None:
                 includes = includesfile.read()
     thispath = os.path.dirname(os.path.abspath(__file__))
     with SerapiContext([args.sertopbin],
-                       includes, args.prelude) as coq:
+                       includes, args.prelude, pipelined=args.pipelined) as coq:
         def handle_interrupt(*args):
             nonlocal coq
             print("Running coq interrupt")
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3.7
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# A faster reader for the sexps sertop prints. It gives exactly what
+# sexpdata.loads would (lists, Symbols, strs, ints and floats), so the
+# match patterns keep working, but it tokenizes each message with a
+# single regex instead of walking it a character at a time. The few
+# things sertop never prints but sexpdata handles (quotes, square
+# brackets, comments, escapes outside of strings) are handed off to
+# sexpdata.
+
+import re
+
+from typing import Any, BinaryIO, Dict, Iterator, List
+
+import sexpdata
+from sexpdata import Symbol
+
+token_re = re.compile(r'"(?:[^"\\]|\\.)*"|[()]|[^\s()"]+', re.DOTALL)
+string_escape_re = re.compile(r'\\(.)', re.DOTALL)
+# Characters that mean something to sexpdata outside of strings, that
+# the fast path doesn't handle
+unusual_atom_re = re.compile(r"['\[\];\\]")
+
+string_escapes = {"\\" : "\\", '"' : '"', "b" : "\b", "f" : "\f",
+                  "n" : "\n", "r" : "\r", "t" : "\t"}
+def unescape_char(match : 're.Match[str]') -> str:
+    return string_escapes.get(match.group(1), match.group(0))
+
+# Atoms are mostly the same few constructor names, so keep the ones
+# we've converted.
+atom_cache : Dict[str, Any] = {}
+max_atom_cache_size = 1 << 16
+
+def parse_atom(token : str) -> Any:
+    if token == "nil":
+        return []
+    if token == "t":
+        return True
+    try:
+        return int(token)
+    except ValueError:
+        try:
+            return float(token)
+        except ValueError:
+            return Symbol(token)
+
+def loads(text : str, skip_feedback_contents : bool = False) -> Any:
+    if skip_feedback_contents and text.startswith("(Feedback"):
+        text = strip_feedback_contents(text)
+    tokens = token_re.findall(text)
+    # An unterminated string is the only thing that isn't a token
+    if not tokens or ('"' in text and token_re.sub("", text).strip()):
+        return sexpdata.loads(text)
+    stack : List[List[Any]] = []
+    current : List[Any] = []
+    for token in tokens:
+        first = token[0]
+        if first == "(":
+            stack.append(current)
+            current = []
+        elif first == ")":
+            if not stack:
+                return sexpdata.loads(text)
+            finished = current
+            current = stack.pop()
+            current.append(finished)
+        elif first == '"':
+            contents = token[1:-1]
+            if "\\" in contents:
+                contents = string_escape_re.sub(unescape_char, contents)
+            current.append(contents)
+        else:
+            value = atom_cache.get(token)
+            if value is None:
+                if unusual_atom_re.search(token):
+                    return sexpdata.loads(text)
+                value = parse_atom(token)
+                if isinstance(value, list):
+                    current.append([])
+                    continue
+                if len(atom_cache) >= max_atom_cache_size:
+                    atom_cache.clear()
+                atom_cache[token] = value
+            current.append(value)
+    if stack or len(current) != 1:
+        return sexpdata.loads(text)
+    return current[0]
+
+# Feedback messages can carry big payloads that nothing looks at. This
+# keeps the doc, span and route ids, and only the head of the
+# contents, like (contents Processed) or (contents (FileLoaded)).
+# Message feedback is kept whole, since it's how errors and interrupts
+# are reported.
+def strip_feedback_contents(text : str) -> str:
+    contents_match = re.compile(r"\(contents\s*").search(text)
+    if not contents_match:
+        return text
+    payload_start = contents_match.end()
+    if text.startswith("(Message", payload_start):
+        return text
+    if text.startswith("(", payload_start):
+        head = re.compile(r"\(([^\s()]+)").match(text, payload_start)
+        if not head:
+            return text
+        return text[:payload_start] + f"({head.group(1)}))))"
+    head = re.compile(r"[^\s()]+").match(text, payload_start)
+    if not head:
+        return text
+    return text[:payload_start] + head.group(0) + ")))"
+
+# Reads messages from a stream of sertop output, a line at a time,
+# reading the stream in large blocks.
+def read_messages(stream : BinaryIO, skip_feedback_contents : bool = False,
+                  block_size : int = 1 << 16) -> Iterator[Any]:
+    # The blocks of the line we're in the middle of
+    partial : List[bytes] = []
+    while True:
+        block = stream.read1(block_size) # type: ignore
+        if not block:
+            break
+        if b"\n" not in block:
+            partial.append(block)
+            continue
+        lines = block.split(b"\n")
+        partial.append(lines[0])
+        lines[0] = b"".join(partial)
+        partial = [lines.pop()]
+        for line in lines:
+            if line.strip():
+                yield loads(line.decode('utf-8'),
+                            skip_feedback_contents=skip_feedback_contents)
+    last_line = b"".join(partial)
+    if last_line.strip():
+        yield loads(last_line.decode('utf-8'),
+                    skip_feedback_contents=skip_feedback_contents)
@@ -27,11 +27,13 @@ from serapi_instance import get_stem, try_load_lin, load_commands_preserve
 import serapi_instance
 from predict_tactic import static_predictors, loadPredictorByFile, loadPredictorByName
 from models.tactic_predictor import TacticPredictor, Prediction, TacticContext
+from models.memoizing_predictor import MemoizingPredictor
 from yattag import Doc
 from format import format_goal, format_hypothesis, format_tactic, read_tuple, \
     ScrapedTactic, ScrapedCommand
+from binary_scrape import BinaryScrapeReader
 from syntax import syntax_highlight, strip_comments
-from util import multipartition, chunks, stringified_percent, escape_filename
+from util import multipartition, chunks, stringified_percent, escape_filename, eprint
 
 Tag = Callable[..., Doc.Tag]
 Text = Callable[..., None]
@@ -94,12 +96,25 @@ def main(arg_list : List[str]) -> None:
     parser.add_argument('--context-filter', dest="context_filter", type=str,
                         default=None)
     parser.add_argument('--chunk-size', dest="chunk_size", type=int, default=4096)
+    parser.add_argument('--scrape-file', dest="scrape_file", type=Path2, default=None,
+                        help="A binary scrape of all the files, to read them from "
+                        "instead of each file's own text scrape")
     parser.add_argument('--weightsfile', default=None)
     parser.add_argument('--predictor', choices=list(static_predictors.keys()),
                         default=None)
     parser.add_argument("--num-predictions", dest="num_predictions", type=int, default=3)
+    parser.add_argument("--prediction-cache-size", dest="prediction_cache_size",
+                        type=int, default=0,
+                        help="Remember this many of the most recent predictions, "
+                        "to skip running the model on repeated contexts")
     parser.add_argument('--skip-nochange-tac', default=False, const=True, action='store_const',
                         dest='skip_nochange_tac')
+    parser.add_argument('--lin-cache', dest='lin_cache', default=None,
+                        help="a directory of linearized files to share between "
+                        "checkouts")
+    parser.add_argument('--lin-cache-size', dest='lin_cache_size', type=int, default=1024,
+                        help="the most space the linearized file cache can use, "
+                        "in megabytes")
     parser.add_argument('filenames', nargs="+", help="proof file name (*.v)", type=Path2)
     args = parser.parse_args(arg_list)
 
@@ -115,6 +130,8 @@ def main(arg_list : List[str]) -> None:
         print("You must specify either --weightsfile or --predictor!")
         parser.print_help()
         return
+    if args.prediction_cache_size > 0:
+        predictor = MemoizingPredictor(predictor, args.prediction_cache_size)
 
     if not args.output.exists():
         args.output.makedirs()
@@ -133,6 +150,8 @@ def main(arg_list : List[str]) -> None:
     write_summary(args, predictor.getOptions() +
                   [("report type", "static"), ("predictor", args.predictor)],
                   cur_commit, cur_date, file_results)
+    if isinstance(predictor, MemoizingPredictor):
+        eprint(predictor.statsString())
 
 T1 = TypeVar('T1')
 T2 = TypeVar('T2')
@@ -202,11 +221,16 @@ def report_file(args : argparse.Namespace,
             else:
                 yield (point, True)
     try:
-        scrape_path = args.prelude / filename.with_suffix(".v.scrape")
-        interactions = list(read_text_data_singlethreaded(scrape_path))
+        if args.scrape_file:
+            scrape_path = args.scrape_file
+            with BinaryScrapeReader(scrape_path) as reader:
+                interactions = reader.read_file(str(filename))
+        else:
+            scrape_path = args.prelude / filename.with_suffix(".v.scrape")
+            interactions = list(read_text_data_singlethreaded(scrape_path))
         print("Loaded {} interactions for file {}".format(len(interactions), filename))
-    except FileNotFoundError:
-        print("Couldn't find file {}, skipping...".format(scrape_path))
+    except (FileNotFoundError, KeyError):
+        print("Couldn't find file {} in {}, skipping...".format(filename, scrape_path))
         return None
     context_filter = get_context_filter(context_filter_str)
 
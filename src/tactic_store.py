@@ -0,0 +1,189 @@
+#!/usr/bin/env python3.7
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# A file of scraped tactics that's memory mapped, instead of being
+# read into lists of python strings. Every distinct string is stored
+# once, and each sample is a run of ids into the string table:
+#
+#   #prev tactics, prev tactics..., #hyps, hyps..., goal, tactic
+#
+# Samples are only turned back into ScrapedTactics when they're
+# accessed. Pickling a store only pickles its path, so worker
+# processes each map the same file instead of getting copies.
+#
+# The layout is a header, the offsets of the strings in the string
+# blob, the offsets of the samples in the id array, the id array, and
+# then the string blob.
+
+import contextlib
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+
+from typing import (Iterable, Iterator, List, Dict, Sequence, Union, Any,
+                    overload)
+
+from format import ScrapedTactic
+
+magic = b"PV9TACS1"
+header_format = "<8sQQQ"
+header_size = struct.calcsize(header_format)
+
+def write_tactic_store(path : Union[str, os.PathLike],
+                       tactics : Iterable[ScrapedTactic]) -> None:
+    string_ids : Dict[str, int] = {}
+    encoded_strings : List[bytes] = []
+    def intern(s : str) -> int:
+        string_id = string_ids.get(s)
+        if string_id is None:
+            string_id = len(encoded_strings)
+            string_ids[s] = string_id
+            encoded_strings.append(s.encode('utf-8'))
+        return string_id
+    words = array('I')
+    sample_offsets = array('Q', [0])
+    for prev_tactics, hypotheses, goal, tactic in tactics:
+        words.append(len(prev_tactics))
+        words.extend(intern(t) for t in prev_tactics)
+        words.append(len(hypotheses))
+        words.extend(intern(h) for h in hypotheses)
+        words.append(intern(goal))
+        words.append(intern(tactic))
+        sample_offsets.append(len(words))
+    string_offsets = array('Q', [0])
+    for s in encoded_strings:
+        string_offsets.append(string_offsets[-1] + len(s))
+    with open(path, 'wb') as f:
+        f.write(struct.pack(header_format, magic, len(encoded_strings),
+                            len(sample_offsets) - 1, len(words)))
+        f.write(string_offsets.tobytes())
+        f.write(sample_offsets.tobytes())
+        f.write(words.tobytes())
+        for s in encoded_strings:
+            f.write(s)
+
+class TacticStore(Sequence[ScrapedTactic]):
+    def __init__(self, path : Union[str, os.PathLike]) -> None:
+        self.path = path
+        self.__open()
+
+    def __open(self) -> None:
+        with open(self.path, 'rb') as f:
+            self.__mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        file_magic, num_strings, num_samples, num_words = \
+            struct.unpack_from(header_format, self.__mmap)
+        assert file_magic == magic, f"{self.path} isn't a tactic store"
+        view = memoryview(self.__mmap)
+        pos = header_size
+        self.__string_offsets = view[pos:pos + (num_strings + 1) * 8].cast('Q')
+        pos += (num_strings + 1) * 8
+        self.__sample_offsets = view[pos:pos + (num_samples + 1) * 8].cast('Q')
+        pos += (num_samples + 1) * 8
+        self.__words = view[pos:pos + num_words * 4].cast('I')
+        pos += num_words * 4
+        self.__blob_start = pos
+        self.__num_samples = num_samples
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {"path" : self.path}
+    def __setstate__(self, state : Dict[str, Any]) -> None:
+        self.path = state["path"]
+        self.__open()
+
+    def __len__(self) -> int:
+        return self.__num_samples
+
+    @overload
+    def __getitem__(self, idx : int) -> ScrapedTactic: ...
+    @overload
+    def __getitem__(self, idx : slice) -> 'TacticStoreView': ...
+    def __getitem__(self, idx : Union[int, slice]) \
+        -> Union[ScrapedTactic, 'TacticStoreView']:
+        if isinstance(idx, slice):
+            return TacticStoreView(self, array('Q', range(len(self))[idx]))
+        if idx < 0:
+            idx += self.__num_samples
+        if not 0 <= idx < self.__num_samples:
+            raise IndexError(idx)
+        words = self.__words
+        pos = self.__sample_offsets[idx]
+        num_prev = words[pos]
+        prev_tactics = [self.__string(i) for i in words[pos+1:pos+1+num_prev]]
+        pos += 1 + num_prev
+        num_hyps = words[pos]
+        hyps = [self.__string(i) for i in words[pos+1:pos+1+num_hyps]]
+        pos += 1 + num_hyps
+        return ScrapedTactic(prev_tactics, hyps,
+                             self.__string(words[pos]), self.__string(words[pos+1]))
+
+    def __iter__(self) -> Iterator[ScrapedTactic]:
+        for idx in range(self.__num_samples):
+            yield self[idx]
+
+    def select(self, indices : Iterable[int]) -> 'TacticStoreView':
+        return TacticStoreView(self, array('Q', indices))
+
+    def __string(self, string_id : int) -> str:
+        start = self.__blob_start + self.__string_offsets[string_id]
+        end = self.__blob_start + self.__string_offsets[string_id + 1]
+        return self.__mmap[start:end].decode('utf-8')
+
+# Some of the samples of a store, like the ones that pass a filter.
+# Only the indices are kept in memory.
+class TacticStoreView(Sequence[ScrapedTactic]):
+    def __init__(self, store : TacticStore, indices : array) -> None:
+        self.store = store
+        self.indices = indices
+    def __len__(self) -> int:
+        return len(self.indices)
+    def __getitem__(self, idx : Any) -> Any:
+        if isinstance(idx, slice):
+            return TacticStoreView(self.store, self.indices[idx])
+        return self.store[self.indices[idx]]
+    def __iter__(self) -> Iterator[ScrapedTactic]:
+        for idx in self.indices:
+            yield self.store[idx]
+
+def tactic_store_path(scrape_path : Union[str, os.PathLike]) -> str:
+    return str(scrape_path) + ".tactics"
+
+# Open the store for a scrape file, building it first if there isn't
+# one that's newer than the scrape.
+def load_tactic_store(scrape_path : Union[str, os.PathLike],
+                      tactics : Iterable[ScrapedTactic]) -> TacticStore:
+    store_path = tactic_store_path(scrape_path)
+    if not os.path.exists(store_path) or \
+       os.path.getmtime(store_path) < os.path.getmtime(scrape_path):
+        # Other processes might be building the same store at once
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(store_path)), suffix=".tmp")
+        os.close(fd)
+        try:
+            write_tactic_store(tmp_path, tactics)
+            os.replace(tmp_path, store_path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
+    return TacticStore(store_path)
@@ -91,48 +91,78 @@ def get_relevant_k_keywords(examplePairs : Iterable[Tuple[str, int]], k : int) \
     tokens = [x[0] for x in words_and_entropies]
     return tokens
 
+# Picks keywords by repeatedly taking the pool of samples with the
+# most entropy in whether they use its most common tactic, and adding
+# the candidate word that best splits it. Each candidate word gets a
+# bitset of the samples containing it up front, and pools are kept as
+# bitsets too, so scoring a word on a pool is a few big-integer ands
+# and popcounts, instead of re-splitting every sample into words.
 def get_relevant_k_keywords2(examplePairs : Iterable[Tuple[str, int]], k : int,
                              num_threads : Optional[int]) \
     -> List[str]:
-    def leader_entropy(pool : List[Tuple[str, int]]) -> Tuple[int, float]:
-        if len(pool) == 0:
-            return 0, 0
-        tactic_counter : Counter[int] = collections.Counter()
-        for context, tactic in pool:
-            tactic_counter[tactic] += 1
-        leader_tactic, leader_count = tactic_counter.most_common(1)[0]
-        return leader_tactic, entropy([1 if tactic == leader_tactic else 0
-                                       for context, tactic in pool])
-
-    # Given a pools list, split each pool into two pools based on the
-    # presence of the word 'word' in the samples, dropping pools with
-    # no entropy (only one tactic).
-    def split_pools(pools : List[Tuple[List[Tuple[str, int]], int, float]], word : str):
-        new_pools : List[Tuple[List[Tuple[str, int]], int, float]] = []
-        for old_pool, old_leader, old_entropy in pools:
-            subpools = \
-                multipartition(old_pool,
-                               lambda ctxt_and_tactic:
-                               1 if word in get_words(ctxt_and_tactic[0])
-                               else 0)
-            for subpool in subpools:
-                leader, entropy = leader_entropy(subpool)
-                if entropy > 0:
-                    new_pools.append((subpool, leader, entropy))
-        return new_pools
-
     pairs_list = list(examplePairs)
+    num_samples = len(pairs_list)
+    sample_words = [set(get_words(context)) for context, tactic in pairs_list]
 
     # Get a starting set of "potential" tokens from the k^2 most common words
     words_counter : Counter[str] = collections.Counter()
-    for context, tactic in examplePairs:
+    for context, tactic in pairs_list:
         words_counter.update(get_words(context))
     common_words = [word for word, count in words_counter.most_common(k**2)]
 
+    word_samples : Dict[str, List[int]] = {word : [] for word in common_words}
+    for idx, words in enumerate(sample_words):
+        for word in words:
+            if word in word_samples:
+                word_samples[word].append(idx)
+    word_bits = {word : indices_bitset(idxs, num_samples)
+                 for word, idxs in word_samples.items()}
+
+    # A pool is its samples (as indices and a bitset), its leader
+    # tactic, the bitset of its samples with the leader tactic, and its
+    # entropy.
+    Pool = Tuple[List[int], int, int, int, float]
+    def make_pool(idxs : List[int]) -> Pool:
+        if len(idxs) == 0:
+            return (idxs, 0, 0, 0, 0.)
+        tactic_counter : Counter[int] = collections.Counter(
+            pairs_list[idx][1] for idx in idxs)
+        leader, leader_count = tactic_counter.most_common(1)[0]
+        return (idxs, indices_bitset(idxs, num_samples), leader,
+                indices_bitset((idx for idx in idxs if pairs_list[idx][1] == leader),
+                               num_samples),
+                binary_entropy(leader_count, len(idxs)))
+
+    # Split each pool in two based on the presence of 'word' in the
+    # samples, dropping pools with no entropy (only one tactic).
+    def split_pools(pools : List[Pool], word : str) -> List[Pool]:
+        new_pools : List[Pool] = []
+        for idxs, _, _, _, _ in pools:
+            with_word = [idx for idx in idxs if word in sample_words[idx]]
+            without_word = [idx for idx in idxs if word not in sample_words[idx]]
+            for subpool_idxs in [without_word, with_word]:
+                if len(subpool_idxs) == 0:
+                    continue
+                subpool = make_pool(subpool_idxs)
+                if subpool[-1] > 0:
+                    new_pools.append(subpool)
+        return new_pools
+
+    # The entropy left after splitting a pool on a word, weighted by
+    # the size of each side, like word_partitioned_entropy
+    def split_entropy(pool : Pool, word : str) -> float:
+        idxs, pool_bits, _, leader_bits, _ = pool
+        with_word = pool_bits & word_bits[word]
+        num_with = popcount(with_word)
+        num_leader_with = popcount(with_word & leader_bits)
+        num_without = len(idxs) - num_with
+        num_leader_without = popcount(leader_bits) - num_leader_with
+        return (binary_entropy(num_leader_with, num_with) * num_with +
+                binary_entropy(num_leader_without, num_without) * num_without) \
+                / len(idxs)
+
     # Set up the initial pool
-    total_leader, total_leader_entropy = leader_entropy(pairs_list)
-    pools : List[Tuple[List[Tuple[str, int]], int, float]] \
-        = [(pairs_list, total_leader, total_leader_entropy)]
+    pools : List[Pool] = [make_pool(list(range(num_samples)))]
     keywords : List[str] = []
 
     common_keywords_and_counts = words_counter.most_common(int(k / 4))
@@ -145,24 +175,16 @@ def get_relevant_k_keywords2(examplePairs : Iterable[Tuple[str, int]], k : int,
             print("Returning early with {} keywords: "
                   "ran out of  pools".format(len(keywords)))
             return keywords
-        highest_entropy_pool, leader, pool_entropy = \
-            max(pools, key=lambda pool_pair: pool_pair[-1])
-
-        with multiprocessing.Pool(num_threads) as process_pool:
-            word_entropy_pairs = list(
-                process_pool.imap_unordered(
-                    functools.partial(
-                        get_relevant_k_keywords_worker__,
-                        [(context, 1
-                         if tactic == leader
-                         else 0)
-                         for context, tactic in highest_entropy_pool]),
-                    common_words))
-            word, word_partitioned_entropy = min(word_entropy_pairs,
-                                                 key=lambda x: x[1])
-            if word_partitioned_entropy >= pool_entropy:
-                pools.remove((highest_entropy_pool, leader, pool_entropy))
-                continue
+        highest_entropy_pool = max(pools, key=lambda pool: pool[-1])
+        pool_entropy = highest_entropy_pool[-1]
+
+        word, word_partitioned_entropy = min(
+            ((word, split_entropy(highest_entropy_pool, word))
+             for word in common_words),
+            key=lambda x: x[1])
+        if word_partitioned_entropy >= pool_entropy:
+            pools.remove(highest_entropy_pool)
+            continue
         if word in keywords:
             print("Returning early with {} keywords: "
                   "ran out of samples that could be differentiated "
@@ -173,6 +195,27 @@ def get_relevant_k_keywords2(examplePairs : Iterable[Tuple[str, int]], k : int,
         pools = split_pools(pools, word)
     return keywords
 
+def indices_bitset(indices : Iterable[int], size : int) -> int:
+    bitmap = bytearray((size + 7) // 8)
+    for idx in indices:
+        bitmap[idx >> 3] |= 1 << (idx & 7)
+    return int.from_bytes(bitmap, 'little')
+
+def popcount(bits : int) -> int:
+    if hasattr(bits, "bit_count"):
+        return bits.bit_count() # type: ignore
+    return bin(bits).count("1")
+
+# The entropy of a yes/no output that's yes num_positive out of total
+# times, the same as entropy would give for the list of outputs.
+def binary_entropy(num_positive : int, total : int) -> float:
+    entropy = 0.
+    for count in [num_positive, total - num_positive]:
+        if count > 0:
+            probability = count / total
+            entropy += probability * math.log(probability, 2)
+    return (- entropy)
+
 def word_partitioned_entropy(examplePairs : Sequence[Tuple[str, int]], word : str) \
     -> float:
     has_word = [output for input, output in examplePairs if word in get_words(input)]
@@ -276,10 +319,26 @@ class KeywordTokenizer(Tokenizer):
         self.unmangle_dict = {} # type: Dict[int, str]
         self.unmangle_dict[self.unknown_ordinal] = "UNKNOWN"
         self._frozen = False
+        self._keyword_replacements = None # type: Optional[List[Tuple[str, str]]]
+        self._mangle_table = None # type: Optional[MangleTable]
         pass
 
+    # The cached mangling is rebuilt when needed, so it isn't pickled;
+    # this keeps pickles loadable both ways.
+    def __getstate__(self) -> Dict[str, Any]:
+        state = dict(self.__dict__)
+        state.pop("_keyword_replacements", None)
+        state.pop("_mangle_table", None)
+        return state
+    def __setstate__(self, state : Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._keyword_replacements = None
+        self._mangle_table = None
+
     def freezeTokenList(self):
         self._frozen = True
+        self._keyword_replacements = None
+        self._mangle_table = None
 
     def _mangle(self, string : str) -> str:
         for c in string:
@@ -292,7 +351,26 @@ class KeywordTokenizer(Tokenizer):
                     self.next_mangle_ord += 1
         return "".join([chr(self.mangle_dict[c]) for c in string])
 
+    # Once the tokenizer is frozen, characters can't get new ordinals,
+    # so the mangled keywords are worked out once, and strings are
+    # mangled with str.translate. Before that, mangling can still add
+    # characters, so everything is mangled on every call.
     def toTokenList(self, string : str) -> List[int]:
+        if not self._frozen:
+            return self.toTokenListByReplacement(string)
+        if self._keyword_replacements is None or self._mangle_table is None:
+            self._keyword_replacements = \
+                [(self._mangle(token_string), chr(idx))
+                 for idx, token_string in enumerate(self.keywords,
+                                                    start=self.num_reserved_tokens)]
+            self._mangle_table = MangleTable(self.mangle_dict, self.unknown_ordinal)
+        mangled_string = string.translate(self._mangle_table)
+        for mangled_keyword, token in self._keyword_replacements:
+            if mangled_keyword in mangled_string:
+                mangled_string = mangled_string.replace(mangled_keyword, token)
+        return [ord(c) for c in mangled_string]
+
+    def toTokenListByReplacement(self, string : str) -> List[int]:
         mangled_string = self._mangle(string)
 
         for idx, token_string in enumerate(self.keywords,
@@ -322,6 +400,15 @@ class KeywordTokenizer(Tokenizer):
     def listTokens(self) -> List[str]:
         return self.keywords
 
+# Maps characters to their mangled ordinals with str.translate, with
+# any character the tokenizer hasn't seen going to the unknown ordinal.
+class MangleTable(dict):
+    def __init__(self, mangle_dict : Dict[str, int], unknown_ordinal : int) -> None:
+        super().__init__((ord(c), mangled) for c, mangled in mangle_dict.items())
+        self.unknown_ordinal = unknown_ordinal
+    def __missing__(self, key : int) -> int:
+        return self.unknown_ordinal
+
 def make_keyword_tokenizer_relevance(data : List[Tuple[str, int]],
                                      tokenizer_type : Callable[[List[str], int],
                                                                Tokenizer],
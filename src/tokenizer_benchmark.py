@@ -0,0 +1,72 @@
+#!/usr/bin/env python3.7
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# Times tokenizing the terms of a scrape with a frozen KeywordTokenizer,
+# against the unfrozen code path (which mangles everything on every
+# call), and checks that they give the same tokens.
+
+import argparse
+import itertools
+import time
+
+from data import read_text_data
+from tokenizer import KeywordTokenizer, get_topk_keywords
+
+from typing import List
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=
+                                     "Benchmark keyword tokenization")
+    parser.add_argument("scrape_file")
+    parser.add_argument("--num-keywords", dest="num_keywords", default=100, type=int)
+    parser.add_argument("--max-tuples", dest="max_tuples", default=10000, type=int)
+    parser.add_argument("--num-reserved-tokens", dest="num_reserved_tokens",
+                        default=2, type=int)
+    args = parser.parse_args()
+
+    terms : List[str] = []
+    for prev_tactics, hyps, goal, tactic in \
+        itertools.islice(read_text_data(args.scrape_file), args.max_tuples):
+        terms.extend(hyp.split(":", 1)[-1].strip() for hyp in hyps)
+        terms.append(goal)
+    tokenizer = KeywordTokenizer(get_topk_keywords(terms, args.num_keywords),
+                                 args.num_reserved_tokens)
+    # Give every character in the data an ordinal before freezing, the
+    # way training does.
+    for term in terms:
+        tokenizer.toTokenList(term)
+    tokenizer.freezeTokenList()
+
+    start = time.time()
+    replaced = [tokenizer.toTokenListByReplacement(term) for term in terms]
+    replacement_time = time.time() - start
+    start = time.time()
+    frozen = [tokenizer.toTokenList(term) for term in terms]
+    frozen_time = time.time() - start
+
+    assert replaced == frozen, "Frozen tokenization doesn't match!"
+    print(f"{len(terms)} terms, {len(tokenizer.keywords)} keywords")
+    print(f"By replacement: {replacement_time:.3f}s")
+    print(f"Frozen: {frozen_time:.3f}s ({replacement_time / frozen_time:.1f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -213,3 +213,23 @@ def sighandler_context(signal, f):
     yield
     sig.signal(signal, old_handler)
 mybarfmt = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}]'
+
+import importlib
+from typing import Dict, Iterator, Mapping, Union
+# A mapping from names to things that are only imported when they're
+# looked up. Entries are either the thing itself, or a string
+# "module:attribute" naming where to find it, so listing the names (for
+# argparse choices) doesn't import anything.
+class LazyRegistry(Mapping[str, Any]):
+    def __init__(self, entries : Dict[str, Union[str, Any]]) -> None:
+        self.entries = entries
+    def __getitem__(self, name : str) -> Any:
+        entry = self.entries[name]
+        if not isinstance(entry, str):
+            return entry
+        module_name, attribute = entry.split(":")
+        return getattr(importlib.import_module(module_name), attribute)
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.entries)
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3.7
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# A format for weights files that can be loaded without reading the
+# whole file through pickle. The file is a header, then everything that
+# was saved except the tensors, pickled, then the bytes of the tensors,
+# each aligned to 64 bytes. The pickle refers to the tensors by their
+# offset, type and shape, and loading maps the tensor section into
+# memory, so tensors are read from the page cache on first use. Mapped
+# tensors are copy-on-write, so the processes loading a file share its
+# pages until one of them writes to a tensor.
+#
+# Anything torch.save can save can be saved this way: tensors are
+# found wherever they are in the saved object, like torch.save does,
+# and saved as a tensor whether they're a model's state dict, part of
+# a predictor state, or anything else. Tensors numpy can't represent
+# are pickled along with everything else.
+
+import argparse
+import io
+import mmap
+import os
+import pickle
+import struct
+import sys
+
+from typing import Any, BinaryIO, Dict, List, Tuple, Union
+
+import numpy
+import torch
+
+from util import eprint
+
+magic = b"PV9WGHT1"
+# Magic, size of the pickled metadata, offset of the tensor section
+header_format = "<8sQQ"
+header_size = struct.calcsize(header_format)
+tensor_alignment = 64
+
+# Offset in the tensor section, numpy type string, and shape
+TensorId = Tuple[int, str, Tuple[int, ...]]
+
+def is_weights_file(path : Union[str, os.PathLike]) -> bool:
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(magic)) == magic
+    except (FileNotFoundError, IsADirectoryError):
+        return False
+
+def aligned(offset : int) -> int:
+    return (offset + tensor_alignment - 1) // tensor_alignment * tensor_alignment
+
+class WeightsPickler(pickle.Pickler):
+    def __init__(self, f : BinaryIO) -> None:
+        super().__init__(f, protocol=pickle.HIGHEST_PROTOCOL)
+        # The tensors to write, with their offsets in the tensor section
+        self.tensors : List[Tuple[int, numpy.ndarray]] = []
+        self.tensors_size = 0
+        # Tensors saved so far by id, along with the tensor, so that
+        # the id can't be reused while we're pickling.
+        self.tensor_ids : Dict[int, Tuple[torch.Tensor, TensorId]] = {}
+    def persistent_id(self, obj : Any) -> Any:
+        # Parameters, and tensors that are part of a graph, are pickled
+        # as usual so that they come back the same.
+        if type(obj) is not torch.Tensor or obj.requires_grad:
+            return None
+        if id(obj) in self.tensor_ids:
+            return self.tensor_ids[id(obj)][1]
+        try:
+            array = obj.cpu().contiguous().numpy()
+        except (TypeError, RuntimeError):
+            return None
+        offset = aligned(self.tensors_size)
+        tensor_id = (offset, array.dtype.str, tuple(array.shape))
+        self.tensors.append((offset, array))
+        # Empty tensors take a byte, so that every tensor has its own
+        # offset
+        self.tensors_size = offset + max(array.nbytes, 1)
+        self.tensor_ids[id(obj)] = (obj, tensor_id)
+        return tensor_id
+
+class WeightsUnpickler(pickle.Unpickler):
+    def __init__(self, f : BinaryIO, mapped : mmap.mmap,
+                 tensors_offset : int) -> None:
+        super().__init__(f)
+        self.mapped = mapped
+        self.tensors_offset = tensors_offset
+        self.loaded : Dict[int, torch.Tensor] = {}
+    def persistent_load(self, tensor_id : TensorId) -> torch.Tensor:
+        offset, dtype, shape = tensor_id
+        if offset not in self.loaded:
+            count = 1
+            for dim in shape:
+                count *= dim
+            array = numpy.frombuffer(self.mapped, dtype=numpy.dtype(dtype),
+                                     count=count,
+                                     offset=self.tensors_offset + offset)
+            self.loaded[offset] = torch.from_numpy(array.reshape(shape))
+        return self.loaded[offset]
+
+def save_weights(obj : Any, path : Union[str, os.PathLike]) -> None:
+    metadata = io.BytesIO()
+    pickler = WeightsPickler(metadata)
+    pickler.dump(obj)
+    tensors_offset = aligned(header_size + len(metadata.getbuffer()))
+    with open(path, 'wb') as f:
+        f.write(struct.pack(header_format, magic, len(metadata.getbuffer()),
+                            tensors_offset))
+        f.write(metadata.getbuffer())
+        for offset, array in pickler.tensors:
+            f.write(bytes(tensors_offset + offset - f.tell()))
+            f.write(array.tobytes())
+
+def load_weights(path : Union[str, os.PathLike]) -> Any:
+    with open(path, 'rb') as f:
+        file_magic, metadata_size, tensors_offset = \
+            struct.unpack(header_format, f.read(header_size))
+        assert file_magic == magic, f"{path} isn't a weights file"
+        metadata = f.read(metadata_size)
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    return WeightsUnpickler(io.BytesIO(metadata), mapped, tensors_offset).load()
+
+def main(arg_list : List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Convert a weights file saved with torch.save into one "
+        "that can be loaded without unpickling its tensors")
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("--verbose", "-v", action='store_true')
+    args = parser.parse_args(arg_list)
+    eprint(f"Loading {args.input}", guard=args.verbose)
+    saved = torch.load(args.input, map_location='cpu')
+    eprint(f"Writing {args.output}", guard=args.verbose)
+    save_weights(saved, args.output)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])